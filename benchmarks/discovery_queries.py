@@ -0,0 +1,102 @@
+"""Fires a burst of discovery QUERY datagrams at a local DiscoveryServer.
+
+Simulates every device rediscovering the server at once: --clients sockets
+concurrently send their share of --queries, each waiting for the reply (or
+--timeout) before sending the next one. Compares the cached interface table
+against looking up the interfaces for every query, as the server used to.
+Rate limiting is off unless --rate-limit is given, since all queries come
+from 127.0.0.1.
+
+    python benchmarks/discovery_queries.py --queries 10000 --clients 100
+"""
+
+import argparse
+import json
+import socket
+import time
+from threading import Event, Thread
+
+import weavelib.netutils as netutils
+
+from messaging.discovery import DiscoveryServer
+from messaging.metrics import LatencyHistogram
+
+
+def get_message_server_address(request_addr):
+    addr = netutils.relevant_ipv4_address(request_addr)
+    if addr is not None:
+        return {"host": addr, "port": 11023}
+    return None
+
+
+class UncachedDiscoveryServer(DiscoveryServer):
+    def process(self, address, msg):
+        if msg == "QUERY":
+            obj = get_message_server_address(address[0]) or {}
+            return json.dumps(obj).encode("UTF-8")
+
+
+def run(server_cls, port, num_queries, num_clients, timeout):
+    server = server_cls(11023, port=port)
+    started = Event()
+    thread = Thread(target=server.run, args=(started.set,))
+    thread.start()
+    started.wait()
+
+    latency = LatencyHistogram()
+    lost = [0]
+    per_client = num_queries // num_clients
+
+    def query():
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(timeout)
+        for _ in range(per_client):
+            sent_at = time.perf_counter()
+            client.sendto(b"QUERY", ("127.0.0.1", port))
+            try:
+                client.recvfrom(1024)
+            except socket.timeout:
+                lost[0] += 1
+                continue
+            latency.record((time.perf_counter() - sent_at) * 1000000)
+        client.close()
+
+    clients = [Thread(target=query) for _ in range(num_clients)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    server.stop()
+    thread.join()
+    return latency, lost[0], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", type=int, default=10000)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--port", type=int, default=23134)
+    parser.add_argument("--timeout", type=float, default=2.0)
+    parser.add_argument("--rate-limit", type=float, default=None,
+                        help="Queries per second per source address.")
+    args = parser.parse_args()
+
+    DiscoveryServer.RATE_LIMIT = args.rate_limit
+
+    for label, cls in (("uncached", UncachedDiscoveryServer),
+                       ("cached", DiscoveryServer)):
+        latency, lost, elapsed = run(cls, args.port, args.queries,
+                                     args.clients, args.timeout)
+        stats = latency.to_json()
+        print("{:>10}: {} replies, {} lost in {:.3f}s ({:.0f} replies/s), "
+              "latency us p50={} p99={} max={}".format(
+                  label, stats["count"], lost, elapsed,
+                  stats["count"] / elapsed, stats["p50"], stats["p99"],
+                  stats["max"]))
+
+
+if __name__ == "__main__":
+    main()
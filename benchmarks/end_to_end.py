@@ -0,0 +1,463 @@
+"""Measures end-to-end throughput and latency of a local messaging server.
+
+Starts a CoreService and runs each scenario over TCP for every combination of
+--clients and --payload-sizes:
+
+    push       clients push to a fifo queue, each waiting for the result
+               before the next push; latency until the result arrives
+    pop        one producer pushes to a fifo queue that clients pop from;
+               latency from push to delivery
+    multicast  one publisher, clients subscribers; deliveries/s and latency
+               from push to delivery
+    rpc        clients "call" an RPC whose request queue is served by as many
+               workers replying over the sessionized response queue;
+               round-trip latency
+    registry   clients call the registry's list_channels RPC (payload size
+               doesn't apply and is reported as 0)
+
+Results are printed and, with --output, written as JSON. With --baseline they
+are compared with an earlier --output file, and the exit status is 1 if any
+throughput dropped, or p99 latency grew, by more than --tolerance. The ports
+of the message server and of discovery must be free.
+
+No baseline is committed: the numbers only mean something on the machine
+that produced them. To check a change, record one from the revision it is
+based on, on the same machine and with the same arguments, then run the
+change against it:
+
+    git worktree add /tmp/weave-base HEAD
+    (cd /tmp/weave-base && python benchmarks/end_to_end.py --clients 1 8 \
+        --output /tmp/baseline.json)
+    python benchmarks/end_to_end.py --clients 1 8 --baseline /tmp/baseline.json
+
+A baseline recorded in a different environment (Python version, platform or
+CPU count) is still compared, with a warning.
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import sys
+import time
+from threading import Event, Lock, Thread
+from uuid import uuid4
+
+from weavelib.messaging import Message, read_message, serialize_message
+
+from messaging.appmgr import SYSTEM_REGISTRY_BASE_QUEUE, create_rpc_queues
+from messaging.appmgr import get_rpc_request_queue
+from messaging.metrics import LatencyHistogram
+from messaging.service import CoreService, PORT
+
+
+TOKEN = "bench-token"
+APP_URL = "https://github.com/HomeWeave/WeaveEnv.git"  # Gets TOKEN.
+PREFIX = "/_bench"
+SCENARIOS = ["push", "pop", "multicast", "rpc", "registry"]
+SOCKET_TIMEOUT = 30
+
+
+class Client(object):
+    # Speaks the wire protocol directly, so that the client library's own
+    # overhead isn't part of the measurement.
+    def __init__(self, token=None):
+        self.sock = socket.create_connection(("localhost", PORT))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(SOCKET_TIMEOUT)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+        self.token = token
+        self.session_id = str(uuid4())
+
+    def send(self, operation, channel, task=None, **headers):
+        msg = Message(operation, task)
+        msg.headers.update(headers)
+        msg.headers["C"] = channel
+        msg.headers["SESS"] = self.session_id
+        if self.token:
+            msg.headers["AUTH"] = self.token
+        self.wfile.write((serialize_message(msg) + "\n").encode())
+        self.wfile.flush()
+
+    def receive(self):
+        msg = read_message(self.rfile)
+        if msg.headers.get("RES", "OK") != "OK":
+            raise RuntimeError("Request failed: {}".format(msg.headers))
+        return msg
+
+    def close(self):
+        # Also unblocks a thread waiting in receive().
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def make_task(payload_size):
+    return {"t": time.perf_counter(), "p": "x" * payload_size}
+
+
+def since(start):
+    return (time.perf_counter() - start) * 1000000
+
+
+def run_threads(targets):
+    # Runs the targets concurrently; returns the wall-clock seconds taken and
+    # re-raises the first failure.
+    errors = []
+
+    def wrap(target):
+        def run():
+            try:
+                target()
+            except Exception as e:
+                errors.append(e)
+        return run
+
+    threads = [Thread(target=wrap(x)) for x in targets]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return elapsed
+
+
+def create_queue(service, queue_type):
+    name = "{}/{}/{}".format(PREFIX, queue_type, uuid4())
+    owner_app = service.message_server.apps_registry.get_app_by_url(APP_URL)
+    service.message_server.channel_registry.create_queue(
+        name, owner_app, {}, {}, queue_type)
+    return name
+
+
+def remove_channel(service, name):
+    service.message_server.channel_registry.remove_channel(name)
+
+
+def closed_loop(num_clients, num_messages, call):
+    # Each client repeatedly calls call(client), which returns the latency of
+    # one operation in microseconds.
+    per_client = max(1, num_messages // num_clients)
+    histograms = [LatencyHistogram() for _ in range(num_clients)]
+    clients = [Client(TOKEN) for _ in range(num_clients)]
+
+    def target(client, histogram):
+        def run():
+            for _ in range(per_client):
+                histogram.record(call(client))
+        return run
+
+    try:
+        elapsed = run_threads([target(x, y)
+                               for x, y in zip(clients, histograms)])
+    finally:
+        for client in clients:
+            client.close()
+
+    latency = LatencyHistogram()
+    for histogram in histograms:
+        latency.merge(histogram)
+    return latency, elapsed
+
+
+def bench_push(service, num_clients, payload_size, num_messages):
+    queue = create_queue(service, "fifo")
+
+    def push(client):
+        task = make_task(payload_size)
+        client.send("push", queue, task)
+        client.receive()
+        return since(task["t"])
+
+    try:
+        return closed_loop(num_clients, num_messages, push)
+    finally:
+        remove_channel(service, queue)
+
+
+def consume(num_clients, expected, produce, subscribe):
+    # Starts num_clients consumers that call subscribe(client) and then read
+    # messages until `expected` deliveries were seen across all of them, runs
+    # produce(client) and returns the delivery latency and the time until
+    # the last delivery.
+    histograms = [LatencyHistogram() for _ in range(num_clients)]
+    consumers = [Client(TOKEN) for _ in range(num_clients)]
+    counter = [0]
+    counter_lock = Lock()
+    done = Event()
+
+    def consumer(client, histogram):
+        try:
+            while not done.is_set():
+                subscribe(client)
+                msg = client.receive()
+                histogram.record(since(msg.task["t"]))
+                with counter_lock:
+                    counter[0] += 1
+                    if counter[0] >= expected:
+                        done.set()
+        except (IOError, OSError, ValueError):
+            pass  # Closed once done.
+
+    threads = [Thread(target=consumer, args=x)
+               for x in zip(consumers, histograms)]
+    for thread in threads:
+        thread.start()
+
+    producer = Client(TOKEN)
+    start = time.perf_counter()
+    try:
+        produce(producer)
+        if not done.wait(SOCKET_TIMEOUT):
+            raise RuntimeError("Only {} of {} messages were delivered."
+                               .format(counter[0], expected))
+        elapsed = time.perf_counter() - start
+    finally:
+        done.set()
+        producer.close()
+        for client in consumers:
+            client.close()
+        for thread in threads:
+            thread.join()
+
+    latency = LatencyHistogram()
+    for histogram in histograms:
+        latency.merge(histogram)
+    return latency, elapsed
+
+
+def bench_pop(service, num_clients, payload_size, num_messages):
+    queue = create_queue(service, "fifo")
+
+    def produce(client):
+        for _ in range(num_messages):
+            client.send("push", queue, make_task(payload_size))
+            client.receive()
+
+    try:
+        return consume(num_clients, num_messages, produce,
+                       lambda client: client.send("pop", queue))
+    finally:
+        remove_channel(service, queue)
+
+
+def bench_multicast(service, num_clients, payload_size, num_messages):
+    queue = create_queue(service, "multicast")
+    channel = service.message_server.channel_registry.get_channel(queue)
+    num_pushes = max(1, num_messages // num_clients)
+    subscribed = set()
+
+    def subscribe(client):
+        # A multicast pop stays subscribed for the whole session.
+        if client not in subscribed:
+            subscribed.add(client)
+            client.send("pop", queue)
+
+    def produce(client):
+        # Publish only once every subscriber is registered.
+        deadline = time.monotonic() + SOCKET_TIMEOUT
+        while len(channel.requestors) < num_clients:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Subscribers didn't register.")
+            time.sleep(0.001)
+
+        for _ in range(num_pushes):
+            client.send("push", queue, make_task(payload_size))
+            client.receive()
+
+    try:
+        return consume(num_clients, num_pushes * num_clients,
+                       produce, subscribe)
+    finally:
+        remove_channel(service, queue)
+
+
+def bench_rpc(service, num_clients, payload_size, num_messages):
+    registry = service.message_server.channel_registry
+    owner_app = service.message_server.apps_registry.get_app_by_url(APP_URL)
+    base_queue = "{}/rpc/{}".format(PREFIX, uuid4())
+    queues = create_rpc_queues(base_queue, owner_app, {}, {}, registry,
+                               APP_URL, [])
+    workers = [Client(TOKEN) for _ in range(num_clients)]
+
+    def serve(client):
+        try:
+            while True:
+                client.send("pop", queues["request_queue"])
+                request = client.receive()
+                client.send("push", queues["response_queue"], request.task,
+                            COOKIE=request.headers["COOKIE"])
+                client.receive()
+        except (IOError, OSError, ValueError):
+            pass  # Closed once done.
+
+    threads = [Thread(target=serve, args=(x,)) for x in workers]
+    for thread in threads:
+        thread.start()
+
+    def call(client):
+        task = make_task(payload_size)
+        client.send("call", queues["request_queue"], task, COOKIE=str(uuid4()))
+        client.receive()
+        return since(task["t"])
+
+    try:
+        return closed_loop(num_clients, num_messages, call)
+    finally:
+        for client in workers:
+            client.close()
+        for thread in threads:
+            thread.join()
+        for queue in queues.values():
+            remove_channel(service, queue)
+
+
+def bench_registry(service, num_clients, payload_size, num_messages):
+    request_queue = get_rpc_request_queue(SYSTEM_REGISTRY_BASE_QUEUE)
+
+    def call(client):
+        task = {"invocation": {"command": "list_channels", "id": str(uuid4()),
+                               "args": [PREFIX, "", 10], "kwargs": {}}}
+        start = time.perf_counter()
+        client.send("call", request_queue, task, COOKIE=str(uuid4()))
+        client.receive()
+        return since(start)
+
+    return closed_loop(num_clients, num_messages, call)
+
+
+BENCHMARKS = {
+    "push": bench_push,
+    "pop": bench_pop,
+    "multicast": bench_multicast,
+    "rpc": bench_rpc,
+    "registry": bench_registry,
+}
+
+
+def run_scenario(service, scenario, num_clients, payload_size, num_messages):
+    latency, elapsed = BENCHMARKS[scenario](service, num_clients, payload_size,
+                                            num_messages)
+    return {
+        "scenario": scenario,
+        "clients": num_clients,
+        "payload_size": payload_size,
+        "operations": latency.total,
+        "seconds": elapsed,
+        "throughput": latency.total / elapsed if elapsed else 0,
+        "latency_us": latency.to_json(),
+    }
+
+
+def result_key(result):
+    return result["scenario"], result["clients"], result["payload_size"]
+
+
+def compare(results, environment, baseline, tolerance):
+    # Prints the change of every result with a counterpart in the baseline
+    # and returns those that regressed beyond tolerance.
+    old_environment = baseline.get("environment", {})
+    for key in ("python", "platform", "cpus"):
+        if old_environment.get(key) != environment[key]:
+            print("Warning: baseline was recorded with {} {}, not {}.".format(
+                key, old_environment.get(key), environment[key]))
+    baseline_results = {result_key(x): x for x in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = baseline_results.get(result_key(result))
+        if old is None:
+            continue
+
+        changes = []
+        regressed = False
+        if old["throughput"]:
+            change = result["throughput"] / old["throughput"] - 1
+            changes.append("throughput {:+.1%}".format(change))
+            regressed |= change < -tolerance
+        if old["latency_us"]["p99"]:
+            change = result["latency_us"]["p99"] / old["latency_us"]["p99"] - 1
+            changes.append("p99 {:+.1%}".format(change))
+            regressed |= change > tolerance
+
+        if regressed:
+            regressions.append(result)
+        print("{:>10} clients={:<4} payload={:<7} {}{}".format(
+            result["scenario"], result["clients"], result["payload_size"],
+            ", ".join(changes), "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS,
+                        default=SCENARIOS)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--payload-sizes", type=int, nargs="+",
+                        default=[16, 1024, 16384])
+    parser.add_argument("--messages", type=int, default=2000,
+                        help="Operations per scenario run.")
+    parser.add_argument("--output", help="Write results as JSON to this file.")
+    parser.add_argument("--baseline",
+                        help="Results of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Allowed relative regression, e.g. 0.1 for 10%%.")
+    args = parser.parse_args()
+
+    service = CoreService(auth_token=TOKEN)
+    started = Event()
+    service.notify_start = started.set
+    thread = Thread(target=service.on_service_start)
+    thread.start()
+    started.wait()
+
+    results = []
+    try:
+        for scenario in args.scenarios:
+            payload_sizes = [0] if scenario == "registry" else \
+                args.payload_sizes
+            for num_clients in args.clients:
+                for payload_size in payload_sizes:
+                    result = run_scenario(service, scenario, num_clients,
+                                          payload_size, args.messages)
+                    results.append(result)
+                    latency = result["latency_us"]
+                    print("{:>10} clients={:<4} payload={:<7} {:>9.0f} ops/s "
+                          "latency us p50={} p99={} max={}".format(
+                              scenario, num_clients, payload_size,
+                              result["throughput"], latency["p50"],
+                              latency["p99"], latency["max"]))
+    finally:
+        service.on_service_stop()
+        thread.join()
+
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "time": time.time(),
+        },
+        "messages": args.messages,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(report, out, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as inp:
+            baseline = json.load(inp)
+        if compare(results, report["environment"], baseline,
+                   args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
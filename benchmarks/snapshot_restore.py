@@ -0,0 +1,91 @@
+"""Measures how long a warm start takes to restore a snapshot.
+
+    python benchmarks/snapshot_restore.py --channels 10000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from weavelib.messaging import WeaveConnection
+
+from messaging.application_registry import ApplicationRegistry
+from messaging.appmgr import MessagingRPCHub, create_rpc_queues
+from messaging.appmgr import get_rpc_base_queue, RPCInfo
+from messaging.queue_manager import ChannelRegistry
+from messaging.service import DummyMessagingService
+from messaging.snapshot import SnapshotManager
+from messaging.synonyms import SynonymRegistry
+
+
+MESSAGING_SERVER_URL = "https://github.com/HomeWeave/WeaveServer.git"
+
+
+def make_manager(path):
+    app_registry = ApplicationRegistry([
+        ("MessagingServer", MESSAGING_SERVER_URL, "app-token"),
+    ])
+    channel_registry = ChannelRegistry(app_registry)
+    synonym_registry = SynonymRegistry()
+    service = DummyMessagingService("app-token", WeaveConnection.local())
+    rpc_hub = MessagingRPCHub(service, channel_registry, app_registry,
+                              synonym_registry)
+    return SnapshotManager(path, app_registry, channel_registry,
+                           synonym_registry, rpc_hub)
+
+
+def populate(manager, num_channels, num_plugins):
+    apps = manager.app_registry
+    schema = {"type": "object", "properties": {"foo": {"type": "string"}}}
+    urls = ["https://github.com/bench/plugin{}.git".format(i)
+            for i in range(num_plugins)]
+    for i, url in enumerate(urls):
+        apps.register_plugin("plugin" + str(i), url)
+
+    # Half the channels are RPC queue pairs, the rest plain queues.
+    for i in range(num_channels // 4):
+        url = urls[i % num_plugins]
+        name = "rpc" + str(i)
+        base_queue = get_rpc_base_queue(url, name)
+        create_rpc_queues(base_queue, apps.get_app_by_url(url), schema, {},
+                          manager.channel_registry, url, [])
+        manager.rpc_hub.rpc_registry[(url, name)] = RPCInfo(
+            url, name, "desc", {}, base_queue, schema, {})
+
+    for i in range(num_channels - 2 * (num_channels // 4)):
+        url = urls[i % num_plugins]
+        manager.channel_registry.create_queue(
+            "/channels/{}/q{}".format(url, i), apps.get_app_by_url(url),
+            schema, {}, "fifo")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=10000)
+    parser.add_argument("--plugins", type=int, default=80)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "snapshot.json")
+        manager = make_manager(path)
+        populate(manager, args.channels, args.plugins)
+
+        start = time.perf_counter()
+        manager.save()
+        save_time = time.perf_counter() - start
+
+        restored = make_manager(path)
+        start = time.perf_counter()
+        restored.load()
+        restore_time = time.perf_counter() - start
+
+        print("channels: {}, snapshot size: {} bytes".format(
+            len(restored.channel_registry.channel_infos),
+            os.path.getsize(path)))
+        print("save: {:.3f}s, restore: {:.3f}s".format(save_time,
+                                                      restore_time))
+
+
+if __name__ == "__main__":
+    main()
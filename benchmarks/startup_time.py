@@ -0,0 +1,96 @@
+"""Measures CoreService cold-start time.
+
+Each run starts a fresh interpreter that imports messaging.service, builds a
+CoreService, starts it and pushes one message over TCP. It reports:
+
+    import         time to import messaging.service
+    construct      time to build the CoreService
+    first_message  time from interpreter start-up (before the import) until
+                   the server accepted the first pushed message
+
+Medians over --runs runs are printed. The ports of the message server and of
+discovery must be free.
+
+    python benchmarks/startup_time.py --runs 5
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+
+CHANNEL = "/_bench/startup"
+
+
+def child():
+    start = time.perf_counter()
+    from messaging.service import CoreService, PORT
+    imported = time.perf_counter()
+
+    from threading import Event, Thread
+    from weavelib.messaging import read_message
+    from messaging.application_registry import Plugin
+
+    service = CoreService(auth_token="bench-token")
+    constructed = time.perf_counter()
+
+    started = Event()
+    service.notify_start = started.set
+    service.message_server.channel_registry.create_queue(
+        CHANNEL, Plugin("bench", "bench", "bench-token"), {}, {}, "fifo")
+    thread = Thread(target=service.on_service_start)
+    thread.start()
+
+    sock = socket.create_connection(("localhost", PORT))
+    rfile = sock.makefile('rb')
+    sock.sendall('MSG "x"\nSESS 1\nOP push\nC {}\n\n'.format(CHANNEL).encode())
+    msg = read_message(rfile)
+    first_message = time.perf_counter()
+    assert msg.headers.get("RES") == "OK", msg.headers
+    sock.close()
+
+    started.wait()
+    service.on_service_stop()
+    thread.join()
+
+    print(json.dumps({
+        "import": imported - start,
+        "construct": constructed - imported,
+        "first_message": first_message - start,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+        return
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [x for x in [env.get("PYTHONPATH")] if x])
+
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), "--child"], env=env)
+        results.append(json.loads(output.decode().strip().splitlines()[-1]))
+
+    for key in ("import", "construct", "first_message"):
+        values = [x[key] for x in results]
+        print("{:>14}: {:8.1f}ms".format(key,
+                                         statistics.median(values) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -59,6 +59,31 @@ class ApplicationRegistry(object):
             "app_url": app.url,
         }
 
+    def to_json(self):
+        with self.apps_lock:
+            plugins = [x for x in self.apps_by_url.values()
+                       if isinstance(x, Plugin)]
+        return {"plugins": [{"name": x.name, "url": x.url, "token": x.app_token}
+                            for x in plugins]}
+
+    def restore(self, obj):
+        with self.apps_lock:
+            for plugin_obj in obj.get("plugins", []):
+                if plugin_obj["url"] in self.apps_by_url:
+                    continue
+                plugin = Plugin(plugin_obj["name"], plugin_obj["url"],
+                                plugin_obj["token"])
+                self.apps_by_token[plugin.app_token] = plugin
+                self.apps_by_url[plugin.url] = plugin
+
+    def get_nested_app_urls(self, url):
+        # URLs of the apps whose URL extends `url` by whole path segments,
+        # e.g. "https://github.com/x/y.git" for "https://github.com/x". Their
+        # channels live under `url`'s channel prefixes.
+        prefix = url.rstrip('/') + '/'
+        with self.apps_lock:
+            return [x for x in self.apps_by_url if x.startswith(prefix)]
+
     def get_app_by_url(self, url):
         with self.apps_lock:
             try:
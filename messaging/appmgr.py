@@ -1,13 +1,20 @@
 import logging
 import os
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from threading import Event, Lock, RLock
 from uuid import uuid4
 
 from weavelib.exceptions import ObjectNotFound, AuthenticationFailed
 from weavelib.exceptions import Unauthorized, ObjectAlreadyExists
 from weavelib.rpc import RPCServer, ServerAPI, ArgParameter, get_rpc_caller
-from weavelib.rpc import OneOf, Type, ListOf
+from weavelib.rpc import Type, ListOf
 
 from messaging.authorizers import WhitelistAuthorizer, AllowAllAuthorizer
+from messaging.authorizers import split_path
+from messaging.dispatchers import DISPATCHERS
+from messaging.metrics import StageTimings
+from messaging.tracing import TraceLog
 
 
 logger = logging.getLogger(__name__)
@@ -19,6 +26,16 @@ def get_rpc_base_queue(app_url, name):
     return "/plugins/{}/rpcs/{}".format(app_url, name)
 
 
+def get_app_channel(app_url, queue_name, prefix="/channels"):
+    channel = os.path.join(prefix, app_url, queue_name.lstrip('/'))
+    return channel.rstrip('/')
+
+
+def get_app_prefixes(app_url):
+    # All channels created on behalf of an app live under these prefixes.
+    return ["/plugins/{}".format(app_url), "/channels/{}".format(app_url)]
+
+
 def get_rpc_request_queue(base_queue):
     return base_queue.rstrip('/') + "/request"
 
@@ -43,15 +60,28 @@ def create_rpc_queues(base_queue, owner_app, request_schema, response_schema,
         # Response Queue: This is a sessionized queue, so anyone can dequeue,
         # but only the app can enqueue.
         response_authorizers = {
-            "push": WhitelistAuthorizer(app_url),
+            "push": WhitelistAuthorizer([app_url]),
             "pop": AllowAllAuthorizer(),
         }
 
-        # World enqueues into the request queue:
+        # World enqueues into the request queue. With the "call" operation, the
+        # server also routes the reply from the response queue to the caller.
+        request_restored = registry.is_restored(request_queue)
         registry.create_queue(request_queue, owner_app, request_schema, {},
-                              'fifo', authorizers=request_authorizers)
-        registry.create_queue(response_queue, owner_app, response_schema, {},
-                              'sessionized', authorizers=response_authorizers)
+                              'fifo', authorizers=request_authorizers,
+                              options={"response_channel": response_queue},
+                              lazy=True)
+        try:
+            registry.create_queue(response_queue, owner_app, response_schema,
+                                  {}, 'sessionized',
+                                  authorizers=response_authorizers, lazy=True)
+        except Exception:
+            # A request queue restored from a snapshot was only taken over.
+            if request_restored:
+                registry.release_adopted_channel(request_queue)
+            else:
+                registry.remove_channel(request_queue)
+            raise
         return dict(request_queue=request_queue, response_queue=response_queue)
 
 
@@ -92,7 +122,9 @@ class RPCInfo(object):
 
 
 class RootRPCServer(RPCServer):
-    MAX_RPC_WORKERS = 1  # Ensures single-thread to create all queues.
+    # MessagingRPCHub serializes calls per app, so apps registering at the
+    # same time don't wait on each other.
+    MAX_RPC_WORKERS = 16
 
     def __init__(self, name, desc, apis, service, channel_registry, owner_app):
         super(RootRPCServer, self).__init__(name, desc, apis, service)
@@ -111,13 +143,67 @@ class RootRPCServer(RPCServer):
 
         return DummyClient()
 
-# This class should be thread-safe since RootRPCServer has a single worker to
-# process all requests.
+# RootRPCServer runs several workers, so calls can arrive concurrently. Calls
+# that change an app's RPCs or channels go through that app's queue (see
+# app_lock()), so they run one at a time per app, in the order they arrived,
+# while other apps' calls proceed. Reads (rpc_info(), list_channels(), ...)
+# don't queue. rpc_registry is copy-on-write (like
+# ChannelRegistry.channel_map): writers swap in a new dict under
+# rpc_registry_lock, and rpc_info() reads it without taking any lock. The
+# other registries have their own locks.
 class MessagingRPCHub(object):
     APIS_SCHEMA = {"type": "object"}
+    MAX_LIST_PAGE_SIZE = 1000
+    QUEUE_TYPES = ["fifo", "sessionized", "multicast", "partitioned"]
+    QUEUE_TYPE_SCHEMA = {
+        "anyOf": [
+            {"enum": QUEUE_TYPES},
+            {
+                "type": "object",
+                "properties": {
+                    "type": {"enum": QUEUE_TYPES},
+                    "dispatch": {"enum": list(DISPATCHERS.keys())},
+                    "partitions": {"type": "integer", "minimum": 1},
+                    "key_header": {"type": "string"},
+                },
+                "required": ["type"],
+            },
+        ]
+    }
+    URL_LIST_SCHEMA = {"type": "array", "items": {"type": "string"}}
+    BUNDLE_QUEUE_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "channel_name": {"type": "string"},
+            "queue_type": QUEUE_TYPE_SCHEMA,
+            "schema": {"type": "object"},
+            "push_whitelist": URL_LIST_SCHEMA,
+            "pop_whitelist": URL_LIST_SCHEMA,
+        },
+        "required": ["channel_name", "queue_type"],
+    }
+    BUNDLE_RPC_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string"},
+            "description": {"type": "string"},
+            "apis": APIS_SCHEMA,
+            "allowed_requestors": URL_LIST_SCHEMA,
+        },
+        "required": ["name", "apis"],
+    }
+    BUNDLE_SYNONYM_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "synonym": {"type": "string"},
+            "target": {"type": "string"},
+        },
+        "required": ["synonym", "target"],
+    }
 
     def __init__(self, service, channel_registry, app_registry,
-                 synonym_registry):
+                 synonym_registry, stage_timings=None, trace_log=None,
+                 connection_memory=None):
         owner_app = app_registry.get_app_by_url(MESSAGING_SERVER_URL)
         self.rpc = RootRPCServer("app_manager", "Application Manager", [
             ServerAPI("register_rpc", "Register new RPC", [
@@ -138,14 +224,34 @@ class MessagingRPCHub(object):
             ], self.unregister_rpc),
             ServerAPI("register_queue", "Register a new queue", [
                 ArgParameter("channel_name", "Basename of the queue", str),
-                ArgParameter("queue_type", "Type of the queue",
-                             OneOf("fifo", "sessionized", "multicast")),
+                ArgParameter("queue_type", "Type of the queue, optionally " +
+                             "as an object with queue options",
+                             self.QUEUE_TYPE_SCHEMA),
                 ArgParameter("schema", "JSONSchema of the messages pushed", {}),
                 ArgParameter("push_whitelist", "Whitelisted plugin URLs array",
                              ListOf(Type(str))),
                 ArgParameter("pop_whitelist", "Whitelisted plugin URLs array",
                              ListOf(Type(str))),
             ], self.register_queue),
+            ServerAPI("register_bundle", "Register queues, RPCs and " +
+                      "synonyms in one call. Either all of them are " +
+                      "registered or none.", [
+                ArgParameter("queues", "Arguments of register_queue, as " +
+                             "objects", {
+                                 "type": "array",
+                                 "items": self.BUNDLE_QUEUE_SCHEMA
+                             }),
+                ArgParameter("rpcs", "Arguments of register_rpc, as objects",
+                             {
+                                 "type": "array",
+                                 "items": self.BUNDLE_RPC_SCHEMA
+                             }),
+                ArgParameter("synonyms", "Arguments of register_synonym, as " +
+                             "objects", {
+                                 "type": "array",
+                                 "items": self.BUNDLE_SYNONYM_SCHEMA
+                             }),
+            ], self.register_bundle),
             ServerAPI("register_plugin", "Register Plugin", [
                 ArgParameter("name", "Plugin Name", str),
                 ArgParameter("url", "Plugin URL (GitHub)", str),
@@ -161,11 +267,75 @@ class MessagingRPCHub(object):
                 ArgParameter("synonym", "Name of requested synonym", str),
                 ArgParameter("target", "Name of channel to map to", str),
             ], self.register_synonym),
+            ServerAPI("list_channels", "List channels under a prefix.", [
+                ArgParameter("prefix", "Channel prefix, '/' for all", str),
+                ArgParameter("start_after", "Last channel of the previous " +
+                             "page, empty string for the first page", str),
+                ArgParameter("limit", "Maximum channels to return", int),
+            ], self.list_channels),
+            ServerAPI("channel_stats", "Get counters, depth and latency " +
+                      "histograms of channels under a prefix.", [
+                ArgParameter("prefix", "Channel prefix, '/' for all " +
+                             "(system apps only)", str),
+            ], self.channel_stats),
+            ServerAPI("stage_timings", "Get latency histograms of the " +
+                      "stages of handling sampled messages.", [],
+                      self.get_stage_timings),
+            ServerAPI("set_stage_sampling", "Sample every n-th message " +
+                      "for stage timings, 0 to stop, and clear the " +
+                      "histograms.", [
+                ArgParameter("interval", "Sampling interval", int),
+            ], self.set_stage_sampling),
+            ServerAPI("list_traces", "List recently traced messages, " +
+                      "newest first.", [
+                ArgParameter("channel_prefix", "Only traces through " +
+                             "channels under this prefix, '' for all", str),
+                ArgParameter("min_duration_ms", "Only traces that took at " +
+                             "least this long", {"type": "number"}),
+                ArgParameter("limit", "Maximum traces to return", int),
+            ], self.list_traces),
+            ServerAPI("get_trace", "Get the events of a traced message.", [
+                ArgParameter("trace_id", "Value of the TRACE header", str),
+            ], self.get_trace),
+            ServerAPI("set_trace_sampling", "Trace every n-th message " +
+                      "pushed without a TRACE header, and messages with " +
+                      "one at the same rate; 0 to stop.", [
+                ArgParameter("interval", "Sampling interval", int),
+            ], self.set_trace_sampling),
+            ServerAPI("memory_usage", "Get payload bytes held against " +
+                      "the memory budget, and the channels and connections " +
+                      "holding the most.", [
+                ArgParameter("limit", "Maximum channels and connections " +
+                             "to return", int),
+            ], self.get_memory_usage),
+            ServerAPI("add_acl_rule", "Grant an app access to channels " +
+                      "matching a path pattern.", [
+                ArgParameter("pattern", "Channel path, may end with '/*'",
+                             str),
+                ArgParameter("app_url", "App URL to grant access to, or '*'",
+                             str),
+                ArgParameter("operations", "Operations to allow",
+                             ListOf(Type(str))),
+            ], self.add_acl_rule),
+            ServerAPI("remove_acl_rule", "Remove an ACL rule.", [
+                ArgParameter("pattern", "Channel path pattern", str),
+                ArgParameter("app_url", "App URL of the rule", str),
+            ], self.remove_acl_rule),
         ], service, channel_registry, owner_app)
         self.channel_registry = channel_registry
         self.app_registry = app_registry
         self.synonym_registry = synonym_registry
+        self.stage_timings = stage_timings or StageTimings()
+        self.trace_log = trace_log or TraceLog()
+        # Returns [{"connection", "peer", "outbound_bytes"}]; see
+        # MessageServer.get_connection_memory().
+        self.connection_memory = connection_memory or (lambda: [])
         self.rpc_registry = {}
+        self.rpc_names_by_app = defaultdict(set)
+        self.restored_rpcs = set()
+        self.rpc_registry_lock = RLock()
+        self.app_queues = {}  # app_url -> deque of Events, running first.
+        self.app_queues_lock = Lock()
 
     def start(self):
         # TODO: Fix request and response schema everywhere.
@@ -173,7 +343,7 @@ class MessagingRPCHub(object):
                            self.rpc.description,
                            {x: y.info for x, y in self.rpc.apis.items()},
                            SYSTEM_REGISTRY_BASE_QUEUE, {}, {})
-        self.rpc_registry[(MESSAGING_SERVER_URL, self.rpc.name)] = rpc_info
+        self.add_rpc_info(rpc_info)
         self.rpc.start()
 
     def stop(self):
@@ -182,48 +352,79 @@ class MessagingRPCHub(object):
     def register_rpc(self, name, description, apis, allowed_requestors):
         caller_app = get_rpc_caller()
         app_url = caller_app["app_url"]
+        owner_app = self.app_registry.get_app_by_url(app_url)
+
+        with self.app_lock(app_url):
+            return self.create_app_rpc(owner_app, name, description, apis,
+                                       allowed_requestors)
+
+    def create_app_rpc(self, owner_app, name, description, apis,
+                       allowed_requestors):
+        # Caller holds the app's lock.
+        app_url = owner_app.url
         base_queue = get_rpc_base_queue(app_url, name)
         request_schema = self.get_request_schema_from_apis(apis)
         response_schema = {}
-        owner_app = self.app_registry.get_app_by_url(app_url)
 
-        if (app_url, name) in self.rpc_registry:
-            raise ObjectAlreadyExists(name)
+        restored = False
+        with self.rpc_registry_lock:
+            if (app_url, name) in self.rpc_registry:
+                # An RPC restored from a snapshot is taken over by its app.
+                if (app_url, name) not in self.restored_rpcs:
+                    raise ObjectAlreadyExists(name)
+                self.restored_rpcs.discard((app_url, name))
+                restored = True
 
-        res = create_rpc_queues(base_queue, owner_app, request_schema,
-                                response_schema, self.channel_registry, app_url,
-                                allowed_requestors)
+        try:
+            res = create_rpc_queues(base_queue, owner_app, request_schema,
+                                    response_schema, self.channel_registry,
+                                    app_url, allowed_requestors)
+        except Exception:
+            # Given back, as in rollback_bundle(); the restored RPCInfo is
+            # still registered.
+            if restored:
+                with self.rpc_registry_lock:
+                    self.restored_rpcs.add((app_url, name))
+            raise
 
         rpc_info = RPCInfo(app_url, name, description, apis, base_queue,
                            request_schema, response_schema)
+        self.add_rpc_info(rpc_info)
 
-        # Thread safe because MAX_RPC_WORKERS == 1.
-        self.rpc_registry[(app_url, name)] = rpc_info
         logger.info("Registered RPC: %s(%s)", name, app_url)
         return res
 
     def update_rpc(self, name, apis):
         caller_app = get_rpc_caller()
         app_url = caller_app["app_url"]
-        rpc_info = self.find_rpc(app_url, name)
-        request_queue = get_rpc_request_queue(rpc_info.base_queue)
-        response_queue = get_rpc_response_queue(rpc_info.base_queue)
         request_schema = self.get_request_schema_from_apis(apis)
         response_schema = {}
-        self.channel_registry.update_channel_schema(request_queue,
-                                                    request_schema, {})
-        self.channel_registry.update_channel_schema(response_queue,
-                                                    response_schema, {})
+
+        with self.app_lock(app_url):
+            rpc_info = self.find_rpc(app_url, name)
+            request_queue = get_rpc_request_queue(rpc_info.base_queue)
+            response_queue = get_rpc_response_queue(rpc_info.base_queue)
+            self.channel_registry.update_channel_schema(request_queue,
+                                                        request_schema, {})
+            self.channel_registry.update_channel_schema(response_queue,
+                                                        response_schema, {})
         return True
 
     def unregister_rpc(self, name):
         caller_app = get_rpc_caller()
         app_url = caller_app["app_url"]
-        rpc_info = self.rpc_registry.pop((app_url, name))
 
-        base_queue = rpc_info.base_queue
-        self.channel_registry.remove_channel(get_rpc_request_queue(base_queue))
-        self.channel_registry.remove_channel(get_rpc_response_queue(base_queue))
+        with self.app_lock(app_url):
+            rpc_info = self.remove_rpc_info(app_url, name)
+            if rpc_info is None:
+                raise ObjectNotFound("RPC not found: " + name)
+
+            base_queue = rpc_info.base_queue
+            self.channel_registry.remove_channel(
+                get_rpc_request_queue(base_queue))
+            self.channel_registry.remove_channel(
+                get_rpc_response_queue(base_queue))
+
         logger.info("Unregistered RPC: %s(%s)", name, app_url)
         return True
 
@@ -232,7 +433,9 @@ class MessagingRPCHub(object):
         if caller_app["app_type"] != "system":
             raise AuthenticationFailed("Only system apps can register plugins.")
 
-        return self.app_registry.register_plugin(name, url)
+        token = self.app_registry.register_plugin(name, url)
+        self.channel_registry.invalidate_auth_cache()
+        return token
 
     def unregister_plugin(self, url):
         caller_app = get_rpc_caller()
@@ -240,18 +443,22 @@ class MessagingRPCHub(object):
         if caller_app.get("app_type") != "system":
             raise AuthenticationFailed("Only system apps can stop plugins.")
 
-        self.app_registry.unregister_plugin(url)
-
-        # Unregister all the RPC Queues.
-        keys_to_remove = []
-        for (app_url, name), rpc_info in self.rpc_registry.items():
-            if app_url == url:
-                keys_to_remove.append((app_url, name))
-                self.channel_registry.remove_channel(rpc_info.request_queue)
-                self.channel_registry.remove_channel(rpc_info.response_queue)
-
-        for key in keys_to_remove:
-            self.rpc_registry.pop(key)
+        with self.app_lock(url):
+            self.app_registry.unregister_plugin(url)
+            self.channel_registry.invalidate_auth_cache()
+
+            # Remove all the app's RPCs and channels.
+            with self.rpc_registry_lock:
+                for name in list(self.rpc_names_by_app.get(url, ())):
+                    self.remove_rpc_info(url, name)
+                self.rpc_names_by_app.pop(url, None)
+            # Apps whose URL extends this one's have their channels under
+            # its prefixes too; they stay.
+            nested = [prefix for nested_url in
+                      self.app_registry.get_nested_app_urls(url)
+                      for prefix in get_app_prefixes(nested_url)]
+            for prefix in get_app_prefixes(url):
+                self.channel_registry.remove_channels(prefix, nested)
 
         return True
 
@@ -264,37 +471,289 @@ class MessagingRPCHub(object):
         caller_app = get_rpc_caller()
         app_url = caller_app["app_url"]
         owner_app = self.app_registry.get_app_by_url(app_url)
-        channel = os.path.join(prefix, app_url, queue_name.lstrip('/'))
-        channel = channel.rstrip('/')
+
+        with self.app_lock(app_url):
+            return self.create_app_queue(owner_app, queue_name, queue_type,
+                                         schema, push_whitelist, pop_whitelist,
+                                         prefix)
+
+    def create_app_queue(self, owner_app, queue_name, queue_type, schema,
+                         push_whitelist, pop_whitelist, prefix="/channels"):
+        # Caller holds the app's lock.
+        channel = get_app_channel(owner_app.url, queue_name, prefix)
+
+        options = {}
+        if isinstance(queue_type, dict):
+            options = dict(queue_type)
+            queue_type = options.pop("type")
 
         auth = {
             "push": get_authorizer(push_whitelist),
             "pop": get_authorizer(pop_whitelist)
         }
         self.channel_registry.create_queue(channel, owner_app, schema, {},
-                                           queue_type, authorizers=auth)
+                                           queue_type, authorizers=auth,
+                                           options=options, lazy=True)
         return channel
 
     def register_synonym(self, synonym, target):
         caller_app = get_rpc_caller()
-        channel = self.channel_registry.get_channel(target)
+        self.check_synonym_target(caller_app["app_url"], target)
+        return self.synonym_registry.register(synonym, target)
 
-        if caller_app["app_url"] != channel.channel_info.owner_app.url:
+    def check_synonym_target(self, app_url, target):
+        channel_info = self.channel_registry.get_channel_info(target)
+        if app_url != channel_info.owner_app.url:
             raise Unauthorized("Only creator can perform this operation.")
 
-        return self.synonym_registry.register(synonym, target)
+    def register_bundle(self, queues, rpcs, synonyms):
+        # Registers all of an app's queues, then RPCs, then synonyms in one
+        # call. Synonyms may point to queues of the same bundle. If anything
+        # fails, everything created so far is removed and the error is
+        # raised. Channels and RPCs restored from a snapshot were only taken
+        # over, so they are given back instead.
+        caller_app = get_rpc_caller()
+        app_url = caller_app["app_url"]
+        owner_app = self.app_registry.get_app_by_url(app_url)
+        res = {"queues": [], "rpcs": {}, "synonyms": []}
+        # Restored channel names, and RPC name -> restored RPCInfo.
+        adopted = {"channels": set(), "rpcs": {}}
+
+        with self.app_lock(app_url):
+            try:
+                for queue in queues:
+                    self.note_restored_channels(adopted, [get_app_channel(
+                        app_url, queue["channel_name"])])
+                    res["queues"].append(self.create_app_queue(
+                        owner_app, queue["channel_name"], queue["queue_type"],
+                        queue.get("schema", {}),
+                        queue.get("push_whitelist", []),
+                        queue.get("pop_whitelist", [])))
+
+                for rpc in rpcs:
+                    base_queue = get_rpc_base_queue(app_url, rpc["name"])
+                    self.note_restored_channels(adopted, [
+                        get_rpc_request_queue(base_queue),
+                        get_rpc_response_queue(base_queue)])
+                    if (app_url, rpc["name"]) in self.restored_rpcs:
+                        adopted["rpcs"][rpc["name"]] = \
+                            self.rpc_registry[(app_url, rpc["name"])]
+                    res["rpcs"][rpc["name"]] = self.create_app_rpc(
+                        owner_app, rpc["name"], rpc.get("description", ""),
+                        rpc["apis"], rpc.get("allowed_requestors", []))
+
+                for synonym in synonyms:
+                    self.check_synonym_target(app_url, synonym["target"])
+                res["synonyms"] = self.synonym_registry.register_all(
+                    [(x["synonym"], x["target"]) for x in synonyms])
+            except Exception:
+                self.rollback_bundle(app_url, res, adopted)
+                raise
+
+        return res
+
+    def note_restored_channels(self, adopted, channels):
+        adopted["channels"].update(
+            x for x in channels if self.channel_registry.is_restored(x))
+
+    def rollback_bundle(self, app_url, res, adopted):
+        # Undoes what register_bundle() did: res has what it registered,
+        # adopted what of it existed before.
+        channels = list(res["queues"])
+        for name, rpc_queues in res["rpcs"].items():
+            channels.extend(rpc_queues.values())
+            rpc_info = adopted["rpcs"].get(name)
+            if rpc_info is None:
+                self.remove_rpc_info(app_url, name)
+                continue
+            with self.rpc_registry_lock:
+                self.add_rpc_info(rpc_info)
+                self.restored_rpcs.add((app_url, name))
+
+        for channel in channels:
+            if channel in adopted["channels"]:
+                self.channel_registry.release_adopted_channel(channel)
+                continue
+            try:
+                self.channel_registry.remove_channel(channel)
+            except ObjectNotFound:
+                pass
+
+    def list_channels(self, prefix, start_after, limit):
+        limit = max(1, min(limit, self.MAX_LIST_PAGE_SIZE))
+        channels = self.channel_registry.list_channels(prefix, start_after,
+                                                       limit)
+        return {
+            "channels": channels,
+            "total": self.channel_registry.count_channels(prefix),
+            "next": channels[-1] if len(channels) == limit else None,
+        }
+
+    def channel_stats(self, prefix):
+        # Plugins only see the stats of their own channels, compared on whole
+        # path segments as in check_acl_pattern().
+        caller_app = get_rpc_caller()
+        if caller_app["app_type"] == "system":
+            return self.channel_registry.get_stats(prefix)
+
+        app_url = caller_app["app_url"]
+        segments = split_path(prefix)
+        if not any(segments[:len(own)] == own for own in
+                   map(split_path, get_app_prefixes(app_url))):
+            raise Unauthorized("Only system apps can see other apps' stats.")
+
+        nested = [split_path(x) for nested_url in
+                  self.app_registry.get_nested_app_urls(app_url)
+                  for x in get_app_prefixes(nested_url)]
+        return {name: stats for name, stats in
+                self.channel_registry.get_stats(prefix).items()
+                if not any(split_path(name)[:len(x)] == x for x in nested)}
+
+    def get_stage_timings(self):
+        return self.stage_timings.to_json()
+
+    def set_stage_sampling(self, interval):
+        if get_rpc_caller()["app_type"] != "system":
+            raise Unauthorized("Only system apps can change sampling.")
+        self.stage_timings.set_sample_interval(interval)
+        self.stage_timings.reset()
+        return True
+
+    def list_traces(self, channel_prefix, min_duration_ms, limit):
+        limit = max(1, min(limit, self.MAX_LIST_PAGE_SIZE))
+        return self.trace_log.query(channel_prefix, min_duration_ms / 1000.0,
+                                    limit)
+
+    def get_trace(self, trace_id):
+        events = self.trace_log.get_trace(trace_id)
+        if events is None:
+            raise ObjectNotFound("Trace not found: " + trace_id)
+        return events
+
+    def set_trace_sampling(self, interval):
+        if get_rpc_caller()["app_type"] != "system":
+            raise Unauthorized("Only system apps can change sampling.")
+        self.trace_log.set_sample_interval(interval)
+        return True
+
+    def get_memory_usage(self, limit):
+        limit = max(1, min(limit, self.MAX_LIST_PAGE_SIZE))
+        connections = sorted(self.connection_memory(),
+                             key=lambda x: x["outbound_bytes"], reverse=True)
+        return {
+            "budget": self.channel_registry.memory_budget.to_json(),
+            "channels": [{"channel": name, "queued_bytes": size}
+                         for name, size in
+                         self.channel_registry.get_memory_usage(limit)],
+            "connections": connections[:limit],
+        }
+
+    def add_acl_rule(self, pattern, app_url, operations):
+        self.check_acl_pattern(pattern)
+        return self.channel_registry.add_acl_rule(pattern, app_url, operations)
+
+    def remove_acl_rule(self, pattern, app_url):
+        self.check_acl_pattern(pattern)
+        return self.channel_registry.remove_acl_rule(pattern, app_url)
+
+    def check_acl_pattern(self, pattern):
+        # Plugins can only grant access to their own channels.
+        caller_app = get_rpc_caller()
+        if caller_app["app_type"] == "system":
+            return
+
+        # Compared on whole path segments, as app URLs contain "/" too. The
+        # channels of apps whose URL extends the caller's are under the
+        # caller's prefix, but aren't the caller's to share.
+        app_url = caller_app["app_url"]
+        segments = split_path(pattern)
+        recursive = segments[-1] == "*"
+        if recursive:
+            segments.pop()
+
+        own_segments = split_path(os.path.join("/channels", app_url))
+        if segments[:len(own_segments)] != own_segments or \
+                (len(segments) == len(own_segments) and not recursive):
+            raise Unauthorized("Only system apps can set this ACL rule.")
+
+        for nested_url in self.app_registry.get_nested_app_urls(app_url):
+            nested = split_path(os.path.join("/channels", nested_url))
+            if segments[:len(nested)] == nested or \
+                    (recursive and nested[:len(segments)] == segments):
+                raise Unauthorized("ACL rule covers another app's channels.")
+
+    def to_json(self):
+        return {"rpcs": [x.to_json() for x in self.rpc_registry.values()
+                         if x.app_url != MESSAGING_SERVER_URL]}
+
+    def restore(self, obj):
+        with self.rpc_registry_lock:
+            for rpc_obj in obj.get("rpcs", []):
+                app_url, name = rpc_obj["app_url"], rpc_obj["name"]
+                rpc_info = RPCInfo(app_url, name, rpc_obj["description"],
+                                   rpc_obj["apis"],
+                                   get_rpc_base_queue(app_url, name),
+                                   rpc_obj["request_schema"],
+                                   rpc_obj["response_schema"])
+                self.add_rpc_info(rpc_info)
+                self.restored_rpcs.add((app_url, name))
+
+    def add_rpc_info(self, rpc_info):
+        key = (rpc_info.app_url, rpc_info.name)
+        with self.rpc_registry_lock:
+            rpc_registry = dict(self.rpc_registry)
+            rpc_registry[key] = rpc_info
+            self.rpc_registry = rpc_registry
+            self.rpc_names_by_app[rpc_info.app_url].add(rpc_info.name)
+
+    def remove_rpc_info(self, app_url, name):
+        with self.rpc_registry_lock:
+            rpc_registry = dict(self.rpc_registry)
+            rpc_info = rpc_registry.pop((app_url, name), None)
+            self.rpc_registry = rpc_registry
+            self.rpc_names_by_app[app_url].discard(name)
+            self.restored_rpcs.discard((app_url, name))
+            return rpc_info
+
+    @contextmanager
+    def app_lock(self, app_url):
+        # Queues the call behind the app's calls in progress (FIFO, unlike a
+        # Lock), and runs it once they are done. Calls are never turned away.
+        # An app's queue lives only while it has calls, so unregistered apps
+        # leave nothing behind.
+        turn = Event()
+        with self.app_queues_lock:
+            queue = self.app_queues.setdefault(app_url, deque())
+            queue.append(turn)
+            if len(queue) == 1:
+                turn.set()
+
+        turn.wait()
+        try:
+            yield
+        finally:
+            with self.app_queues_lock:
+                queue.popleft()
+                if queue:
+                    queue[0].set()
+                else:
+                    del self.app_queues[app_url]
 
     def find_rpc(self, url, name):
         try:
             return self.rpc_registry[(url, name)]
         except KeyError:
-            raise ObjectNotFound("RPC not found: " + rpc_name)
+            raise ObjectNotFound("RPC not found: " + name)
 
     def get_request_schema_from_apis(self, apis):
+        # Each API's schema fixes "command" to the API's name, so validators
+        # that understand the discriminator (see SchemaValidator) check only
+        # the API being invoked.
         return {
             "type": "object",
             "properties": {
                 "invocation": {
+                    "discriminator": {"propertyName": "command"},
                     "anyOf": [ServerAPI.from_info(x).schema
                               for x in apis.values()]
                 }
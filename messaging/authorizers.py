@@ -1,24 +1,48 @@
+from threading import Lock
+
+
 class BaseAuthorizer(object):
     def authorize(self, app_url, operation, channel):
         raise NotImplementedError
 
+    def to_json(self):
+        raise NotImplementedError
+
 
 class AllowAllAuthorizer(BaseAuthorizer):
     def authorize(self, app_url, operation, channel):
         return True
 
+    def to_json(self):
+        return {"type": "allow_all"}
+
 
 class WhitelistAuthorizer(BaseAuthorizer):
     def __init__(self, whitelisted_urls):
-        self.allowed_app_urls = whitelisted_urls
+        if isinstance(whitelisted_urls, str):
+            whitelisted_urls = [whitelisted_urls]
+        self.allowed_app_urls = frozenset(whitelisted_urls)
 
     def authorize(self, app_url, operation, channel):
         return app_url in self.allowed_app_urls
 
+    def to_json(self):
+        return {"type": "whitelist", "urls": sorted(self.allowed_app_urls)}
+
 
 class ChainedAuthorizer(BaseAuthorizer):
     def __init__(self, authorizers):
-        self.authorizers = authorizers
+        # Whitelists are merged into a single set lookup.
+        whitelisted_urls = set()
+        self.authorizers = []
+        for authorizer in authorizers:
+            if isinstance(authorizer, WhitelistAuthorizer):
+                whitelisted_urls.update(authorizer.allowed_app_urls)
+            else:
+                self.authorizers.append(authorizer)
+
+        if whitelisted_urls:
+            self.authorizers.insert(0, WhitelistAuthorizer(whitelisted_urls))
 
     def authorize(self, app_url, operation, channel):
         for authorizer in self.authorizers:
@@ -26,3 +50,143 @@ class ChainedAuthorizer(BaseAuthorizer):
                 return True
 
         return False
+
+    def to_json(self):
+        return {"type": "chained",
+                "authorizers": [x.to_json() for x in self.authorizers]}
+
+
+def authorizer_from_json(obj):
+    authorizer_type = obj.get("type")
+    if authorizer_type == "allow_all":
+        return AllowAllAuthorizer()
+    elif authorizer_type == "whitelist":
+        return WhitelistAuthorizer(obj["urls"])
+    elif authorizer_type == "chained":
+        return ChainedAuthorizer([authorizer_from_json(x)
+                                  for x in obj["authorizers"]])
+    raise ValueError("Unknown authorizer: " + str(authorizer_type))
+
+
+ALLOW_ALL = AllowAllAuthorizer()
+
+
+class ACLTrieNode(object):
+    __slots__ = ("children", "app_child", "exact_grants", "prefix_grants")
+
+    def __init__(self):
+        self.children = {}
+        self.app_child = None  # Matches the requesting app's own URL.
+        self.exact_grants = {}  # app_url -> frozenset of operations.
+        self.prefix_grants = {}
+
+
+def split_path(path):
+    return path.strip('/').split('/')
+
+
+def is_granted(grants, app_url, operation):
+    return (operation in grants.get(app_url, ()) or
+            operation in grants.get(PrefixACLAuthorizer.ANY_APP, ()))
+
+
+# Grants apps access to channels by path. A rule pattern is a channel path,
+# optionally ending with "/*" to cover everything below it. A "{app_url}"
+# segment matches the URL of the app being authorized, so
+# "/channels/{app_url}/*" granted to ANY_APP lets every app use its own
+# channels. Rules live in a trie, so authorizing costs time proportional to
+# the depth of the channel path rather than the number of rules.
+class PrefixACLAuthorizer(BaseAuthorizer):
+    ANY_APP = "*"
+    APP_URL_PLACEHOLDER = "{app_url}"
+
+    def __init__(self):
+        self.root = ACLTrieNode()
+        self.rules = {}
+        self.lock = Lock()
+
+    def add_rule(self, pattern, app_url, operations):
+        with self.lock:
+            path, recursive = self.find_path(pattern, create=True)
+            node = path[-1][1]
+            grants = node.prefix_grants if recursive else node.exact_grants
+            ops = grants.get(app_url, frozenset()) | frozenset(operations)
+            grants[app_url] = ops
+            self.rules[(pattern, app_url)] = ops
+
+    def remove_rule(self, pattern, app_url):
+        with self.lock:
+            if self.rules.pop((pattern, app_url), None) is None:
+                return False
+            path, recursive = self.find_path(pattern, create=False)
+            node = path[-1][1]
+            grants = node.prefix_grants if recursive else node.exact_grants
+            grants.pop(app_url, None)
+
+            # Prune nodes that no longer lead to any rule.
+            for (_, parent), (segment, node) in zip(path[-2::-1],
+                                                    path[:0:-1]):
+                if node.children or node.app_child is not None or \
+                        node.exact_grants or node.prefix_grants:
+                    break
+                if segment == self.APP_URL_PLACEHOLDER:
+                    parent.app_child = None
+                else:
+                    del parent.children[segment]
+        return True
+
+    def list_rules(self):
+        with self.lock:
+            return [{"pattern": pattern, "app_url": app_url,
+                     "operations": sorted(ops)}
+                    for (pattern, app_url), ops in self.rules.items()]
+
+    def find_path(self, pattern, create):
+        # Returns [(segment, node), ...] from the root to the pattern's node,
+        # and whether the pattern is recursive. Called with self.lock held.
+        segments = split_path(pattern)
+        recursive = segments[-1] == '*'
+        if recursive:
+            segments.pop()
+
+        path = [(None, self.root)]
+        for segment in segments:
+            node = path[-1][1]
+            if segment == self.APP_URL_PLACEHOLDER:
+                if node.app_child is None and create:
+                    node.app_child = ACLTrieNode()
+                node = node.app_child
+            else:
+                if segment not in node.children and create:
+                    node.children[segment] = ACLTrieNode()
+                node = node.children.get(segment)
+            path.append((segment, node))
+        return path, recursive
+
+    def authorize(self, app_url, operation, channel):
+        if app_url is None:
+            return False
+
+        segments = split_path(channel)
+        app_segments = split_path(app_url)
+        stack = [(self.root, 0)]
+        while stack:
+            node, pos = stack.pop()
+            if pos == len(segments):
+                if is_granted(node.exact_grants, app_url, operation):
+                    return True
+                continue
+
+            if is_granted(node.prefix_grants, app_url, operation):
+                return True
+
+            child = node.children.get(segments[pos])
+            if child is not None:
+                stack.append((child, pos + 1))
+
+            end = pos + len(app_segments)
+            if node.app_child is not None and \
+                    segments[pos:end] == app_segments:
+                stack.append((node.app_child, end))
+
+        return False
@@ -1,7 +1,13 @@
+import ipaddress
 import json
 import logging
+import os
+import selectors
 import socket
-from threading import Event
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+from uuid import uuid4
 
 import weavelib.netutils as netutils
 
@@ -9,11 +15,19 @@ import weavelib.netutils as netutils
 logger = logging.getLogger(__name__)
 
 
-def get_message_server_address(request_addr):
-    addr = netutils.relevant_ipv4_address(request_addr)
-    if addr is not None:
-        return {"host": addr, "port": 11023}
-    return None
+def get_cpu_load():
+    # 1-minute load average per CPU, or None where it isn't available.
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def compute_weight(status, max_weight):
+    # Relative share of new clients this instance is asking for: max_weight
+    # when idle, going down to 1 as the CPU load per core reaches 1.
+    cpu_load = status.get("cpu_load") or 0
+    return max(1, int(round(max_weight * (1 - min(cpu_load, 1)))))
 
 
 def safe_close(sock):
@@ -23,41 +37,274 @@ def safe_close(sock):
         pass
 
 
+class InterfaceTable(object):
+    # Caches the local IPv4 interfaces and which of their addresses answers a
+    # given source address. refresh() re-reads the interfaces and drops the
+    # cached answers only if they changed. Sources outside of every known
+    # subnet fall back to netutils.relevant_ipv4_address().
+    MAX_CACHED_SOURCES = 4096
+
+    def __init__(self):
+        self.lock = Lock()
+        self.interfaces = None
+        self.networks = []  # [(IPv4Network, local address)]
+        self.answers = OrderedDict()  # source address -> local address
+
+    def refresh(self):
+        interfaces = list(netutils.iter_ipv4_addresses())
+        with self.lock:
+            if interfaces == self.interfaces:
+                return False
+
+            networks = []
+            for info in interfaces:
+                try:
+                    network = ipaddress.IPv4Network(
+                        "{}/{}".format(info["addr"], info["netmask"]),
+                        strict=False)
+                except (KeyError, TypeError, ValueError):
+                    continue
+                networks.append((network, info["addr"]))
+
+            self.interfaces = interfaces
+            self.networks = networks
+            self.answers = OrderedDict()
+
+        logger.info("Discovery interfaces: %s", [x for _, x in networks])
+        return True
+
+    def lookup(self, source):
+        with self.lock:
+            try:
+                self.answers.move_to_end(source)
+                return self.answers[source]
+            except KeyError:
+                pass
+            networks = self.networks
+
+        res = None
+        try:
+            source_addr = ipaddress.IPv4Address(source)
+        except ValueError:
+            networks = []
+        for network, addr in networks:
+            if source_addr in network:
+                res = addr
+                break
+        else:
+            res = netutils.relevant_ipv4_address(source)
+
+        with self.lock:
+            self.answers[source] = res
+            if len(self.answers) > self.MAX_CACHED_SOURCES:
+                self.answers.popitem(last=False)
+        return res
+
+
+class RateLimiter(object):
+    # Token bucket per source address: `rate` queries per second, up to
+    # `burst` at once.
+    MAX_TRACKED_SOURCES = 10000
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # source -> [tokens, last update]
+
+    def allow(self, source, now):
+        bucket = self.buckets.get(source)
+        if bucket is None:
+            if len(self.buckets) >= self.MAX_TRACKED_SOURCES:
+                self.prune(now)
+            bucket = self.buckets[source] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst,
+                            bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def prune(self, now):
+        # Sources that have been quiet long enough to refill are forgotten.
+        refill_time = self.burst / self.rate
+        self.buckets = {source: bucket for source, bucket in
+                        self.buckets.items()
+                        if now - bucket[1] < refill_time}
+
+
 class DiscoveryServer(object):
     SERVER_PORT = 23034
     ACTIVE_POLL_TIME = 15
+    INTERFACE_REFRESH_TIME = 10
+    MAX_BATCH_SIZE = 256  # Datagrams read per wake-up.
+    RATE_LIMIT = 5  # Queries per second per source; None to disable.
+    RATE_LIMIT_BURST = 20
+    # Room for a burst of queries (e.g. every device rediscovering after a
+    # network outage); the kernel may cap it.
+    RECEIVE_BUFFER_SIZE = 1 << 20
 
-    def __init__(self, message_server_port):
+    MAX_WEIGHT = 100
+    STATUS_CACHE_TIME = 1  # Seconds a status_provider() result is reused.
+    # Clients read replies into a buffer of this size; anything past it would
+    # be cut off.
+    MAX_REPLY_SIZE = 1024
+
+    # status_provider() returns load figures of the instance (e.g. connection
+    # count and queue depth) to include in replies; endpoints lists other ways
+    # of reaching it, such as {"type": "unix", "path": ...}. max_weight caps
+    # the weight advertised (see compute_weight()), so that a smaller
+    # instance asks for a smaller share of clients.
+    def __init__(self, message_server_port, port=None, status_provider=None,
+                 endpoints=None, instance_id=None, max_weight=None):
+        self.message_server_port = message_server_port
+        self.port = port or self.SERVER_PORT
+        self.status_provider = status_provider
+        self.endpoints = list(endpoints or [])
+        self.instance_id = instance_id or str(uuid4())
+        self.max_weight = max(1, min(int(max_weight or self.MAX_WEIGHT),
+                                     self.MAX_WEIGHT))
+        self.status = None
+        self.status_time = None
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                             self.RECEIVE_BUFFER_SIZE)
+        self.sock.setblocking(False)
+        # stop() writes to wakeup_sock to interrupt the select().
+        self.wakeup_sock, self.wakeup_write_sock = socket.socketpair()
+        self.interfaces = InterfaceTable()
+        self.rate_limiter = None
+        if self.RATE_LIMIT:
+            self.rate_limiter = RateLimiter(self.RATE_LIMIT,
+                                            self.RATE_LIMIT_BURST)
         self.active = True
         self.dead_event = Event()
+        self.reply_size_warned = False
 
     def run(self, success_callback=None):
-        self.sock.bind(('', self.SERVER_PORT))
-        self.sock.settimeout(self.ACTIVE_POLL_TIME)
+        self.sock.bind(('', self.port))
+        self.interfaces.refresh()
+        last_refresh = time.monotonic()
         if success_callback:
             success_callback()
 
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+        selector.register(self.wakeup_sock, selectors.EVENT_READ)
         try:
             while self.active:
-                try:
-                    data, address = self.sock.recvfrom(1024)
-                except socket.timeout:
-                    continue
-                msg = data.decode()
-                res = self.process(address, msg)
-                if res:
-                    self.sock.sendto(res, address)
+                timeout = min(self.ACTIVE_POLL_TIME,
+                              self.INTERFACE_REFRESH_TIME)
+                if selector.select(timeout) and self.active:
+                    self.handle_batch()
+
+                if time.monotonic() - last_refresh > \
+                        self.INTERFACE_REFRESH_TIME:
+                    self.interfaces.refresh()
+                    last_refresh = time.monotonic()
         finally:
-            safe_close(self.sock)
+            selector.close()
+            self.close()
             self.dead_event.set()
 
+    def close(self):
+        # Closes the sockets of a server that isn't running (run() does it
+        # when it returns).
+        safe_close(self.sock)
+        safe_close(self.wakeup_sock)
+        safe_close(self.wakeup_write_sock)
+
+    def handle_batch(self):
+        now = time.monotonic()
+        for _ in range(self.MAX_BATCH_SIZE):
+            try:
+                data, address = self.sock.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # E.g. ICMP port unreachable from an earlier reply.
+                continue
+
+            if self.rate_limiter and \
+                    not self.rate_limiter.allow(address[0], now):
+                continue
+
+            try:
+                msg = data.decode()
+            except UnicodeDecodeError:
+                continue
+
+            res = self.process(address, msg)
+            if res:
+                try:
+                    self.sock.sendto(res, address)
+                except (BlockingIOError, InterruptedError):
+                    logger.warning("Dropped discovery reply to %s", address)
+                except OSError:
+                    pass
+
     def process(self, address, msg):
         if msg == "QUERY":
-            obj = get_message_server_address(address[0]) or {}
-            return json.dumps(obj).encode("UTF-8")
+            addr = self.interfaces.lookup(address[0])
+            obj = {}
+            if addr is not None:
+                status = self.get_status()
+                obj = {
+                    "host": addr,
+                    "port": self.message_server_port,
+                    "id": self.instance_id,
+                    "endpoints": [{"type": "tcp", "host": addr,
+                                   "port": self.message_server_port}] +
+                                 self.endpoints,
+                    "load": status,
+                    "weight": compute_weight(status, self.max_weight),
+                }
+            return self.encode_reply(obj)
+
+    def encode_reply(self, obj):
+        # A reply that doesn't fit in MAX_REPLY_SIZE drops the advertised
+        # endpoints from the last (keeping the TCP one), then the load
+        # figures. host and port, which older clients read, always stay.
+        data = json.dumps(obj).encode("UTF-8")
+        if len(data) <= self.MAX_REPLY_SIZE:
+            return data
+
+        if not self.reply_size_warned:
+            logger.warning("Discovery reply of %d bytes trimmed to fit %d.",
+                           len(data), self.MAX_REPLY_SIZE)
+            self.reply_size_warned = True
+
+        endpoints = obj["endpoints"]
+        while len(data) > self.MAX_REPLY_SIZE and len(endpoints) > 1:
+            endpoints = endpoints[:-1]
+            obj["endpoints"] = endpoints
+            data = json.dumps(obj).encode("UTF-8")
+        if len(data) > self.MAX_REPLY_SIZE:
+            obj["load"] = {}
+            data = json.dumps(obj).encode("UTF-8")
+        return data
+
+    def get_status(self):
+        # Cached, so that a burst of queries doesn't recompute it each time.
+        now = time.monotonic()
+        if self.status is None or now - self.status_time > \
+                self.STATUS_CACHE_TIME:
+            status = {"cpu_load": get_cpu_load()}
+            if self.status_provider:
+                try:
+                    status.update(self.status_provider())
+                except Exception:
+                    logger.exception("Unable to get server status.")
+            self.status = status
+            self.status_time = now
+        return self.status
 
     def stop(self):
         self.active = False
-        safe_close(self.sock)
+        try:
+            self.wakeup_write_sock.send(b"\0")
+        except (IOError, OSError):
+            pass
         self.dead_event.wait()
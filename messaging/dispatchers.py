@@ -0,0 +1,151 @@
+from collections import defaultdict
+from itertools import count
+
+from weavelib.exceptions import BadArguments, ProtocolError
+
+
+class Waiter(object):
+    def __init__(self, session_id, out, consumer_id, capacity):
+        self.session_id = session_id
+        self.out = out
+        self.consumer_id = consumer_id
+        self.capacity = capacity
+
+    @staticmethod
+    def from_message(dequeue_msg, out):
+        session_id = dequeue_msg.headers["SESS"]
+        consumer_id = dequeue_msg.headers.get("CONSUMER", session_id)
+        try:
+            capacity = int(dequeue_msg.headers.get("CAPACITY", 1))
+        except (TypeError, ValueError):
+            raise ProtocolError("'CAPACITY' must be an integer.")
+        if capacity < 1:
+            raise ProtocolError("'CAPACITY' must be positive.")
+        return Waiter(session_id, out, consumer_id, capacity)
+
+
+# Dispatchers pick which waiting consumer receives the next message of a queue.
+# Callers hold the queue's lock, so dispatchers need not be thread-safe.
+#
+# Per-consumer state is kept while any session of the consumer is known to the
+# queue, and dropped by on_remove() once the last one is gone, so that it
+# doesn't grow with every session that ever popped.
+class BaseDispatcher(object):
+    def __init__(self):
+        self.delivery_counts = defaultdict(int)
+        self.session_consumers = {}  # session_id -> consumer_id
+        self.consumer_sessions = defaultdict(set)
+
+    def select(self, waiters):
+        raise NotImplementedError
+
+    def on_pop(self, waiter):
+        if waiter.session_id not in self.session_consumers:
+            self.session_consumers[waiter.session_id] = waiter.consumer_id
+            self.consumer_sessions[waiter.consumer_id].add(waiter.session_id)
+
+    def on_delivered(self, waiter):
+        self.delivery_counts[waiter.consumer_id] += 1
+
+    def on_remove(self, session_id):
+        # Called when a session goes away, whether it was waiting or not.
+        consumer_id = self.session_consumers.pop(session_id, None)
+        if consumer_id is None:
+            return
+        sessions = self.consumer_sessions[consumer_id]
+        sessions.discard(session_id)
+        if not sessions:
+            del self.consumer_sessions[consumer_id]
+            self.forget_consumer(consumer_id)
+
+    def forget_consumer(self, consumer_id):
+        self.delivery_counts.pop(consumer_id, None)
+
+
+class RoundRobinDispatcher(BaseDispatcher):
+    def __init__(self):
+        super().__init__()
+        self.sequence = count()
+        self.last_served = {}
+
+    def select(self, waiters):
+        return min(waiters,
+                   key=lambda w: self.last_served.get(w.consumer_id, -1))
+
+    def on_delivered(self, waiter):
+        super().on_delivered(waiter)
+        self.last_served[waiter.consumer_id] = next(self.sequence)
+
+    def forget_consumer(self, consumer_id):
+        super().forget_consumer(consumer_id)
+        self.last_served.pop(consumer_id, None)
+
+
+class WeightedDispatcher(BaseDispatcher):
+    # Smooth weighted round-robin: each pick credits every waiting consumer
+    # its capacity and charges the picked one the total. Credit only builds
+    # up while waiting, so a consumer that joins late doesn't catch up on
+    # what the others were sent before it.
+    def __init__(self):
+        super().__init__()
+        self.credits = defaultdict(int)
+
+    def select(self, waiters):
+        total = 0
+        for waiter in waiters:
+            self.credits[waiter.consumer_id] += waiter.capacity
+            total += waiter.capacity
+        chosen = max(waiters, key=lambda w: self.credits[w.consumer_id])
+        self.credits[chosen.consumer_id] -= total
+        return chosen
+
+    def forget_consumer(self, consumer_id):
+        super().forget_consumer(consumer_id)
+        self.credits.pop(consumer_id, None)
+
+
+class LeastOutstandingDispatcher(BaseDispatcher):
+    def __init__(self):
+        super().__init__()
+        self.outstanding = defaultdict(int)
+        self.busy_sessions = {}
+
+    def select(self, waiters):
+        return min(waiters, key=lambda w: self.outstanding[w.consumer_id])
+
+    def on_pop(self, waiter):
+        # A session popping again means it is done with its previous message.
+        super().on_pop(waiter)
+        self.release_session(waiter.session_id)
+
+    def on_delivered(self, waiter):
+        super().on_delivered(waiter)
+        self.busy_sessions[waiter.session_id] = waiter.consumer_id
+        self.outstanding[waiter.consumer_id] += 1
+
+    def on_remove(self, session_id):
+        # A session that disconnects mid-message is done with it too.
+        self.release_session(session_id)
+        super().on_remove(session_id)
+
+    def release_session(self, session_id):
+        consumer_id = self.busy_sessions.pop(session_id, None)
+        if consumer_id is not None:
+            self.outstanding[consumer_id] -= 1
+            if not self.outstanding[consumer_id]:
+                del self.outstanding[consumer_id]
+
+
+DISPATCHERS = {
+    "round_robin": RoundRobinDispatcher,
+    "weighted": WeightedDispatcher,
+    "least_outstanding": LeastOutstandingDispatcher,
+}
+DEFAULT_DISPATCHER = "round_robin"
+
+
+def get_dispatcher_cls(name):
+    try:
+        return DISPATCHERS[name or DEFAULT_DISPATCHER]
+    except KeyError:
+        raise BadArguments("Unknown dispatch policy: " + str(name))
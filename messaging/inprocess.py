@@ -0,0 +1,111 @@
+import logging
+from contextlib import contextmanager
+from copy import copy
+from threading import Lock, Thread, current_thread
+
+from weavelib.exceptions import WeaveException
+from weavelib.messaging import WeaveConnection, exception_to_message
+
+from .server import Connection, OutboundQueue
+
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessServerConnection(Connection):
+    # Server side of an InProcessConnection: there is no socket, so closing
+    # only drops the waiters and stops the client's response thread.
+    def __init__(self, response_queue):
+        super(InProcessServerConnection, self).__init__(None, None, None,
+                                                        response_queue)
+
+    def close(self):
+        self.remove_all_waiters()
+        self.response_queue.put(None)
+
+
+# A WeaveConnection to a MessageServer running in the same process. Messages
+# are handed to MessageServer.handle_message() as objects, and responses are
+# delivered from a Queue, so nothing is serialized or goes through a socket.
+# Tasks are not copied: a task pushed to a multicast channel is the same object
+# for all receivers, so receivers must not modify it.
+#
+# Of WeaveConnection, only send() (called by Sender and Receiver) is replaced,
+# and only process_message() (which delivers a response to its session) is
+# called; is_supported() checks that the installed weavelib has it.
+class InProcessConnection(WeaveConnection):
+    def __init__(self, message_server):
+        super(InProcessConnection, self).__init__()
+        self.message_server = message_server
+        self.response_queue = OutboundQueue(message_server.memory_budget)
+        self.server_conn = InProcessServerConnection(self.response_queue)
+        self.response_thread = Thread(target=self.process_responses)
+        # A session's messages are handled one at a time; different sessions
+        # (e.g. the RPC hub's workers) are handled in parallel.
+        self.session_locks = {}  # session -> [lock, sends holding/waiting]
+        self.session_locks_lock = Lock()
+
+    @staticmethod
+    def is_supported():
+        return callable(getattr(WeaveConnection, "process_message", None))
+
+    def connect(self):
+        self.message_server.add_connection(self.server_conn)
+        self.response_thread.start()
+
+    def send(self, msg):
+        # The server replaces the AUTH header, so it gets its own copy.
+        msg = copy(msg)
+        msg.headers = dict(msg.headers)
+        with self.session_lock(msg.headers.get("SESS")):
+            try:
+                self.message_server.handle_message(self.server_conn, msg,
+                                                   self.response_queue)
+            except WeaveException as e:
+                response = exception_to_message(e)
+                response.headers["SESS"] = msg.headers.get("SESS")
+                self.response_queue.put(response)
+
+    @contextmanager
+    def session_lock(self, session_id):
+        # A session's entry lives only while it has sends in progress.
+        with self.session_locks_lock:
+            entry = self.session_locks.get(session_id)
+            if entry is None:
+                entry = self.session_locks[session_id] = [Lock(), 0]
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.session_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.session_locks[session_id]
+
+    def process_responses(self):
+        while True:
+            msg = self.response_queue.get()
+            if msg is None:
+                self.response_queue.task_done()
+                break
+
+            try:
+                self.process_message(msg)
+            except Exception:
+                logger.exception("Unable to process message.")
+            finally:
+                self.response_queue.task_done()
+
+    def close(self):
+        try:
+            self.message_server.remove_connection(self.server_conn)
+        except KeyError:
+            pass  # Already closed by MessageServer.shutdown().
+        self.server_conn.close()
+        if current_thread() is not self.response_thread:
+            if self.response_thread.is_alive():
+                self.response_thread.join()
+            # Releases the budget held by responses nobody will process.
+            self.response_queue.discard()
@@ -0,0 +1,438 @@
+import argparse
+import json
+import socket
+import sys
+import time
+from collections import Counter
+from threading import Event, Lock, Thread
+from uuid import uuid4
+
+from weavelib.exceptions import BadArguments, WeaveException
+from weavelib.messaging import Message, read_message, serialize_message
+
+from .appmgr import SYSTEM_REGISTRY_BASE_QUEUE, get_rpc_request_queue
+from .metrics import LatencyHistogram
+
+
+DEFAULT_PORT = 11023
+REGISTRY_REQUEST_QUEUE = get_rpc_request_queue(SYSTEM_REGISTRY_BASE_QUEUE)
+QUEUE_TYPES = ["fifo", "sessionized", "multicast", "partitioned"]
+
+# A scenario file is a JSON object like:
+#
+#   {
+#     "duration": 60,
+#     "report_interval": 1,
+#     "auth_token": "...",
+#     "channels": [
+#       {"register": "load/{}", "queue_type": "fifo", "count": 10,
+#        "producers": 4, "consumers": 2, "rate": 50, "payload_size": 256},
+#       {"register": "load/keyed", "queue_type": "partitioned", "keys": 64},
+#       {"channel": "/channels/existing", "producers": 1}
+#     ]
+#   }
+#
+# Each channel entry either names an existing "channel" or a queue to
+# "register" through the registry (which needs auth_token). With "count" > 1
+# the entry is repeated, and "{}" in the name is replaced by the index. Each
+# producer and consumer has its own connection; producers push "rate"
+# messages per second each, or as fast as the server accepts them if no rate
+# is given. Pushes to a partitioned channel cycle through "keys" distinct
+# values of its KEY header.
+CHANNEL_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "channel": {"type": "string"},
+        "register": {"type": "string"},
+        "queue_type": {"enum": QUEUE_TYPES},
+        "count": {"type": "integer", "minimum": 1},
+        "producers": {"type": "integer", "minimum": 0},
+        "consumers": {"type": "integer", "minimum": 0},
+        "rate": {"type": "number", "exclusiveMinimum": True, "minimum": 0},
+        "payload_size": {"type": "integer", "minimum": 0},
+        "keys": {"type": "integer", "minimum": 1},
+    },
+    "anyOf": [{"required": ["channel"]}, {"required": ["register"]}],
+}
+SCENARIO_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "duration": {"type": "number", "exclusiveMinimum": True, "minimum": 0},
+        "report_interval": {"type": "number", "exclusiveMinimum": True,
+                            "minimum": 0},
+        "auth_token": {"type": "string"},
+        "channels": {"type": "array", "items": CHANNEL_SCHEMA, "minItems": 1},
+    },
+    "required": ["channels"],
+}
+
+
+def load_scenario(obj):
+    from .schema import SchemaValidator
+    error = SchemaValidator(SCENARIO_SCHEMA).get_error(obj)
+    if error is not None:
+        raise BadArguments("Invalid scenario: " + error.message)
+
+    scenario = {
+        "duration": obj.get("duration", 60),
+        "report_interval": obj.get("report_interval", 1),
+        "auth_token": obj.get("auth_token"),
+        "channels": [],
+    }
+    for spec in obj["channels"]:
+        count = spec.get("count", 1)
+        for index in range(count):
+            channel = {
+                "queue_type": spec.get("queue_type", "fifo"),
+                "producers": spec.get("producers", 1),
+                "consumers": spec.get("consumers", 1),
+                "rate": spec.get("rate"),
+                "payload_size": spec.get("payload_size", 16),
+            }
+            if channel["queue_type"] == "partitioned":
+                channel["keys"] = spec.get("keys", 16)
+            if "channel" in spec:
+                channel["channel"] = spec["channel"].format(index)
+            else:
+                channel["register"] = spec["register"].format(index)
+            scenario["channels"].append(channel)
+    return scenario
+
+
+class LoadClient(object):
+    # One connection speaking the wire protocol.
+    def __init__(self, host, port, token=None):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+        self.token = token
+        self.session_id = str(uuid4())
+
+    def send(self, operation, channel, task=None, **headers):
+        msg = Message(operation, task)
+        msg.headers.update(headers)
+        msg.headers["C"] = channel
+        msg.headers["SESS"] = self.session_id
+        if self.token:
+            msg.headers["AUTH"] = self.token
+        self.wfile.write((serialize_message(msg) + "\n").encode())
+        self.wfile.flush()
+
+    def receive(self):
+        return read_message(self.rfile)
+
+    def call_registry(self, command, *args):
+        invocation = {"command": command, "id": str(uuid4()),
+                      "args": list(args), "kwargs": {}}
+        self.send("call", REGISTRY_REQUEST_QUEUE, {"invocation": invocation},
+                  COOKIE=str(uuid4()))
+        msg = self.receive()
+        result = msg.task if isinstance(msg.task, dict) else {}
+        if msg.headers.get("RES", "OK") != "OK" or "error" in result:
+            raise BadArguments("{} failed: {}".format(
+                command, result.get("error") or msg.headers.get("RES")))
+        return result.get("result")
+
+    def close(self):
+        # Also unblocks a thread waiting in receive().
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class LoadStats(object):
+    # Counters and latency histograms of the current reporting interval;
+    # take() returns them and starts the next interval.
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.sent = 0
+        self.delivered = 0
+        self.errors = Counter()
+        self.push_latency = LatencyHistogram()
+        self.delivery_latency = LatencyHistogram()
+
+    def record_push(self, latency):
+        with self.lock:
+            self.sent += 1
+            self.push_latency.record(latency)
+
+    def record_delivery(self, latency):
+        with self.lock:
+            self.delivered += 1
+            self.delivery_latency.record(latency)
+
+    def record_error(self, kind):
+        with self.lock:
+            self.errors[kind] += 1
+
+    def take(self):
+        snapshot = LoadStats()
+        with self.lock:
+            snapshot.sent = self.sent
+            snapshot.delivered = self.delivered
+            snapshot.errors = self.errors
+            snapshot.push_latency = self.push_latency
+            snapshot.delivery_latency = self.delivery_latency
+            self.reset()
+        return snapshot
+
+    def merge(self, other):
+        self.sent += other.sent
+        self.delivered += other.delivered
+        self.errors.update(other.errors)
+        self.push_latency.merge(other.push_latency)
+        self.delivery_latency.merge(other.delivery_latency)
+
+    def to_json(self, elapsed):
+        return {
+            "seconds": elapsed,
+            "sent": self.sent,
+            "delivered": self.delivered,
+            "errors": dict(self.errors),
+            "sent_per_second": self.sent / elapsed if elapsed else 0,
+            "delivered_per_second": self.delivered / elapsed if elapsed else 0,
+            "push_latency_us": self.push_latency.to_json(),
+            "delivery_latency_us": self.delivery_latency.to_json(),
+        }
+
+
+class ClientGroup(object):
+    # Connections closed together. A connection added after close() is
+    # closed right away, so that a worker that was still connecting stops too.
+    def __init__(self):
+        self.clients = []
+        self.closed = False
+        self.lock = Lock()
+
+    def add(self, client):
+        with self.lock:
+            if not self.closed:
+                self.clients.append(client)
+                return client
+        client.close()
+        raise IOError("Load generator stopped.")
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            clients, self.clients = self.clients, []
+        for client in clients:
+            client.close()
+
+
+def format_stats(stats, elapsed):
+    return ("sent {:.0f}/s delivered {:.0f}/s errors {} | push us p50={} "
+            "p99={} | delivery us p50={} p99={}").format(
+                stats.sent / elapsed, stats.delivered / elapsed,
+                sum(stats.errors.values()), stats.push_latency.percentile(50),
+                stats.push_latency.percentile(99),
+                stats.delivery_latency.percentile(50),
+                stats.delivery_latency.percentile(99))
+
+
+class LoadGenerator(object):
+    # Latencies are measured from when a message was due to be sent rather
+    # than when it was, so a server that falls behind the rate shows up in
+    # them instead of just slowing the producers down.
+    SUBSCRIBE_WAIT = 0.5  # Lets multicast subscriptions register.
+    DRAIN_WAIT = 1  # Lets deliveries in flight arrive before stopping.
+
+    def __init__(self, host, port, scenario):
+        self.host = host
+        self.port = port
+        self.scenario = scenario
+        self.stats = LoadStats()
+        self.stop_event = Event()
+        self.producer_clients = ClientGroup()
+        self.consumer_clients = ClientGroup()
+
+    def connect(self, clients=None):
+        client = LoadClient(self.host, self.port,
+                            self.scenario["auth_token"])
+        if clients is not None:
+            clients.add(client)
+        return client
+
+    def register_channels(self):
+        # Registered queues get a per-run path, so that reruns don't clash.
+        run_id = uuid4().hex[:8]
+        client = None
+        try:
+            for channel in self.scenario["channels"]:
+                if "channel" in channel:
+                    continue
+                if client is None:
+                    client = self.connect()
+                name = "loadgen/{}/{}".format(run_id,
+                                              channel["register"].strip("/"))
+                channel["channel"] = client.call_registry(
+                    "register_queue", name, channel["queue_type"], {}, [], [])
+        finally:
+            if client is not None:
+                client.close()
+
+    def produce(self, client, channel, cookies):
+        rate = channel["rate"]
+        interval = 1.0 / rate if rate else 0
+        payload = "x" * channel["payload_size"]
+        due = time.perf_counter()
+        count = 0
+        while not self.stop_event.is_set():
+            if interval:
+                delay = due - time.perf_counter()
+                if delay > 0 and self.stop_event.wait(delay):
+                    break
+            else:
+                due = time.perf_counter()
+
+            headers = {}
+            if cookies:
+                headers["COOKIE"] = cookies[count % len(cookies)]
+            if "keys" in channel:
+                headers["KEY"] = str(count % channel["keys"])
+            client.send("push", channel["channel"], {"t": due, "p": payload},
+                        **headers)
+            msg = client.receive()
+            if msg.headers.get("RES") == "OK":
+                self.stats.record_push((time.perf_counter() - due) * 1000000)
+            else:
+                self.stats.record_error(msg.headers.get("RES", "unknown"))
+
+            due += interval
+            count += 1
+
+    def consume(self, client, channel, cookie):
+        # Runs until the connection is closed.
+        headers = {"COOKIE": cookie} if cookie else {}
+        subscribed = False
+        while True:
+            if not subscribed:
+                client.send("pop", channel["channel"], **headers)
+                # Multicast keeps delivering to the session after one pop.
+                subscribed = channel["queue_type"] == "multicast"
+
+            msg = client.receive()
+            if msg.headers.get("RES", "OK") != "OK":
+                # E.g. not allowed to pop; retrying won't help.
+                self.stats.record_error(msg.headers["RES"])
+                return
+            try:
+                sent_at = msg.task["t"]
+            except (KeyError, TypeError):
+                self.stats.record_error("unexpected message")
+                continue
+            self.stats.record_delivery((time.perf_counter() - sent_at) *
+                                       1000000)
+
+    def run_worker(self, clients, target, *args):
+        def run():
+            try:
+                target(self.connect(clients), *args)
+            except (IOError, OSError, ValueError):
+                if not self.stop_event.is_set():
+                    self.stats.record_error("connection")
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self, report=print):
+        self.register_channels()
+
+        consumers = []
+        producers = []
+        for channel in self.scenario["channels"]:
+            cookies = []
+            if channel["queue_type"] == "sessionized":
+                cookies = [str(uuid4()) for _ in range(channel["consumers"])]
+            for index in range(channel["consumers"]):
+                cookie = cookies[index] if cookies else None
+                consumers.append(self.run_worker(self.consumer_clients,
+                                                 self.consume, channel,
+                                                 cookie))
+            if channel["queue_type"] == "sessionized" and not cookies:
+                cookies = [str(uuid4())]
+            producers.append((channel, cookies))
+
+        if consumers:
+            time.sleep(self.SUBSCRIBE_WAIT)
+
+        start = time.perf_counter()
+        producers = [self.run_worker(self.producer_clients, self.produce,
+                                     channel, cookies)
+                     for channel, cookies in producers
+                     for _ in range(channel["producers"])]
+
+        total = LoadStats()
+        deadline = start + self.scenario["duration"]
+        last_report = start
+        try:
+            while True:
+                now = time.perf_counter()
+                timeout = min(deadline - now,
+                              self.scenario["report_interval"] -
+                              (now - last_report))
+                if timeout > 0:
+                    time.sleep(timeout)
+                now = time.perf_counter()
+                if now - last_report >= self.scenario["report_interval"] or \
+                        now >= deadline:
+                    stats = self.stats.take()
+                    total.merge(stats)
+                    report("{:8.1f}s  {}".format(
+                        now - start, format_stats(stats, now - last_report)))
+                    last_report = now
+                if now >= deadline:
+                    break
+        finally:
+            # A producer waiting for a reply that doesn't come only stops once
+            # its connection is closed.
+            self.stop_event.set()
+            self.producer_clients.close()
+            for thread in producers:
+                thread.join()
+            if consumers:
+                time.sleep(self.DRAIN_WAIT)
+            self.consumer_clients.close()
+            for thread in consumers:
+                thread.join()
+
+        elapsed = time.perf_counter() - start
+        total.merge(self.stats.take())
+        return total.to_json(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates load against a running messaging server.")
+    parser.add_argument("scenario", help="Scenario file (JSON).")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--token", help="Overrides auth_token of the scenario.")
+    parser.add_argument("--duration", type=float,
+                        help="Overrides duration of the scenario (seconds).")
+    parser.add_argument("--output", help="Write the summary as JSON here.")
+    args = parser.parse_args()
+
+    try:
+        with open(args.scenario) as inp:
+            scenario = load_scenario(json.load(inp))
+        if args.token:
+            scenario["auth_token"] = args.token
+        if args.duration:
+            scenario["duration"] = args.duration
+
+        summary = LoadGenerator(args.host, args.port, scenario).run()
+    except (IOError, OSError, ValueError, WeaveException) as e:
+        print("weave-loadgen: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+
+    print(json.dumps(summary, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(summary, out, indent=2, sort_keys=True)
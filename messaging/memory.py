@@ -0,0 +1,84 @@
+from threading import Lock
+
+from weavelib.exceptions import BadArguments, InternalError
+
+
+class MemoryBudget(object):
+    # Payload bytes held by the server: messages queued in channels and
+    # responses waiting in connections' outbound queues. Without a limit it
+    # only keeps count. With one, a push that doesn't fit is rejected; with
+    # policy "shed", the oldest messages queued in the largest channels are
+    # dropped first (down to LOW_WATERMARK of the limit, so that shedding
+    # doesn't happen on every push), and the push is rejected only if that
+    # didn't make room. Outbound queues count towards the limit but are never
+    # shed, as clients wait for every response.
+    POLICIES = ("reject", "shed")
+    LOW_WATERMARK = 0.9
+
+    def __init__(self, limit=None, policy="reject"):
+        if policy not in self.POLICIES:
+            raise BadArguments("Bad memory policy: " + str(policy))
+        self.limit = limit
+        self.policy = policy
+        self.shedder = None  # f(bytes) -> bytes freed; see ChannelRegistry.
+        self.used = 0
+        self.peak = 0
+        self.rejected = 0
+        self.shed = 0
+        self.lock = Lock()
+        self.shed_lock = Lock()
+
+    def reserve(self, size):
+        with self.lock:
+            self.used += size
+            if self.used > self.peak:
+                self.peak = self.used
+
+    def release(self, size):
+        with self.lock:
+            self.used -= size
+
+    def check(self, size):
+        # Called before a message of `size` bytes is pushed. Reserves them,
+        # so that concurrent pushes can't together overshoot the limit, or
+        # raises InternalError if they don't fit. The caller releases them
+        # once the message is gone.
+        if self.try_reserve(size):
+            return
+
+        # Only one thread sheds at a time; the others don't wait for it.
+        if self.policy == "shed" and self.shedder is not None and \
+                self.shed_lock.acquire(blocking=False):
+            try:
+                target = self.used + size - int(self.limit *
+                                                self.LOW_WATERMARK)
+                freed = self.shedder(target)
+            finally:
+                self.shed_lock.release()
+            with self.lock:
+                self.shed += freed
+            if self.try_reserve(size):
+                return
+
+        with self.lock:
+            self.rejected += 1
+        raise InternalError("Server is out of memory for messages.")
+
+    def try_reserve(self, size):
+        with self.lock:
+            if self.limit is not None and self.used + size > self.limit:
+                return False
+            self.used += size
+            if self.used > self.peak:
+                self.peak = self.used
+            return True
+
+    def to_json(self):
+        return {
+            "limit": self.limit,
+            "policy": self.policy,
+            "used": self.used,
+            "peak": self.peak,
+            "rejected": self.rejected,
+            "shed": self.shed,
+        }
@@ -0,0 +1,202 @@
+import time
+from threading import Lock
+
+
+def payload_size(task):
+    # Approximate size of a message payload in bytes, as it would be sent.
+    # Called for every pushed message and every queued response, so it adds up
+    # lengths instead of serializing: exact for compact JSON without escaped
+    # characters, and strings cost the same however long they are.
+    if task is None:
+        return 0
+    if isinstance(task, (str, bytes)):
+        return len(task)
+    return json_size(task)
+
+
+def json_size(obj):
+    if isinstance(obj, str):
+        return len(obj) + 2
+    if isinstance(obj, dict):
+        # Braces, commas, and each key's quotes and colon.
+        return 1 + sum(len(str(key)) + 3 + json_size(value)
+                       for key, value in obj.items()) + max(len(obj), 1)
+    if isinstance(obj, (list, tuple)):
+        return 1 + sum(json_size(item) for item in obj) + max(len(obj), 1)
+    if obj is None or obj is True:
+        return 4
+    if obj is False:
+        return 5
+    if isinstance(obj, float):
+        return len(repr(obj))
+    return len(str(obj))
+
+
+class LatencyHistogram(object):
+    # HDR-style log-linear histogram of integer values (microseconds). Values
+    # below 2^SUB_BUCKET_BITS get a bucket each; above that, every power of two
+    # is split into 2^(SUB_BUCKET_BITS - 1) buckets, so reported values are
+    # within ~6% of the recorded ones. Counts live in a flat list indexed by
+    # bucket.
+    SUB_BUCKET_BITS = 5
+    MAX_VALUE = 2 ** 36 - 1  # ~19 hours in microseconds.
+
+    def __init__(self):
+        self.half_count = 1 << (self.SUB_BUCKET_BITS - 1)
+        self.counts = [0] * (self.bucket_index(self.MAX_VALUE) + 1)
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def bucket_index(self, value):
+        shift = value.bit_length() - self.SUB_BUCKET_BITS
+        if shift <= 0:
+            return value
+        return shift * self.half_count + (value >> shift)
+
+    def bucket_value(self, index):
+        # Lowest value that maps to the bucket.
+        if index < (1 << self.SUB_BUCKET_BITS):
+            return index
+        shift = index // self.half_count - 1
+        return (index - shift * self.half_count) << shift
+
+    def record(self, value):
+        value = min(max(int(value), 0), self.MAX_VALUE)
+        self.counts[self.bucket_index(value)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        # Adds the values recorded by another histogram, e.g. one per thread.
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        if not self.total:
+            return 0
+        target = max(1, int(round(self.total * percent / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_value(index), self.max)
+        return self.max
+
+    def to_json(self):
+        return {
+            "count": self.total,
+            "mean": self.sum / self.total if self.total else 0,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+        }
+
+
+class ChannelMetrics(object):
+    # Counters are plain attribute updates on the message path; they may miss
+    # an increment under heavy contention, which is fine for monitoring.
+    def __init__(self):
+        self.pushes = 0
+        self.pops = 0
+        self.drops = 0
+        self.rejected = 0  # Pushes refused by the memory budget.
+        self.bytes = 0
+        self.latency = LatencyHistogram()  # Enqueue to delivery, in us.
+
+    def on_push(self, msg):
+        self.pushes += 1
+        self.bytes += msg.payload_bytes  # Set by SynchronousQueue.push().
+        msg.enqueue_time = time.monotonic()
+
+    def on_delivered(self, msg):
+        self.pops += 1
+        enqueue_time = getattr(msg, "enqueue_time", None)
+        if enqueue_time is not None:
+            self.latency.record((time.monotonic() - enqueue_time) * 1000000)
+
+    def on_drop(self, msg):
+        self.drops += 1
+
+    def on_reject(self, msg):
+        self.rejected += 1
+
+    def to_json(self):
+        return {
+            "pushes": self.pushes,
+            "pops": self.pops,
+            "drops": self.drops,
+            "rejected": self.rejected,
+            "bytes": self.bytes,
+            "latency_us": self.latency.to_json(),
+        }
+
+
+class StageClock(object):
+    # Travels with a sampled message (as msg.stage_clock). lap() records the
+    # time since the previous lap as the given stage.
+    def __init__(self, timings):
+        self.timings = timings
+        self.last = time.perf_counter()
+
+    def restart(self):
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings.record(stage, (now - self.last) * 1000000)
+        self.last = now
+
+
+class StageTimings(object):
+    # Histograms (in us) of how long each stage of handling a message took,
+    # for every sample_interval-th message; 0 turns sampling off. Messages
+    # that aren't sampled cost a counter increment.
+    def __init__(self, sample_interval=0):
+        self.sample_interval = sample_interval
+        self.counter = 0
+        self.samples = 0
+        self.histograms = {}  # stage -> LatencyHistogram
+        self.lock = Lock()
+
+    def start(self):
+        # A StageClock if the next message is to be sampled, otherwise None.
+        if not self.sample_interval:
+            return None
+        self.counter += 1
+        if self.counter % self.sample_interval:
+            return None
+        self.samples += 1
+        return StageClock(self)
+
+    def record(self, stage, value):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.record(value)
+
+    def set_sample_interval(self, sample_interval):
+        self.sample_interval = max(0, int(sample_interval))
+
+    def reset(self):
+        with self.lock:
+            self.samples = 0
+            self.histograms = {}
+
+    def to_json(self):
+        with self.lock:
+            return {
+                "sample_interval": self.sample_interval,
+                "samples": self.samples,
+                "stages_us": {stage: histogram.to_json() for stage, histogram
+                              in self.histograms.items()},
+            }
@@ -0,0 +1,133 @@
+def split_channel_name(channel_name):
+    return channel_name.split('/')
+
+
+def split_prefix(prefix):
+    prefix = prefix.rstrip('/')
+    return split_channel_name(prefix) if prefix else []
+
+
+class NamespaceNode(object):
+    __slots__ = ("children", "channel_name", "count")
+
+    def __init__(self):
+        self.children = {}
+        self.channel_name = None
+        self.count = 0  # Number of channels in this subtree.
+
+
+# Trie of channel names split on "/". Prefixes are matched on whole path
+# segments: "/channels/a" (or "/channels/a/") covers "/channels/a" and
+# "/channels/a/b" but not "/channels/ab"; "" or "/" covers everything.
+# Not thread-safe; ChannelRegistry guards writes with its channel_map_lock.
+class ChannelNamespace(object):
+    def __init__(self):
+        self.root = NamespaceNode()
+
+    def add(self, channel_name):
+        path = [self.root]
+        for segment in split_channel_name(channel_name):
+            path.append(path[-1].children.setdefault(segment, NamespaceNode()))
+
+        if path[-1].channel_name is not None:
+            return False
+
+        path[-1].channel_name = channel_name
+        for node in path:
+            node.count += 1
+        return True
+
+    def remove(self, channel_name):
+        path = self.find_path(split_channel_name(channel_name))
+        if not path or path[-1][1].channel_name is None:
+            return False
+
+        path[-1][1].channel_name = None
+        self.detach(path, 1)
+        return True
+
+    def remove_prefix(self, prefix, exclude_prefixes=()):
+        # Channels under any of exclude_prefixes are kept.
+        path = self.find_path(split_prefix(prefix))
+        if not path:
+            return []
+
+        if exclude_prefixes:
+            excluded = [split_prefix(x) for x in exclude_prefixes]
+            removed = [name for name in self.iter_subtree(path[-1][1])
+                       if not any(split_channel_name(name)[:len(x)] == x
+                                  for x in excluded)]
+            for name in removed:
+                self.remove(name)
+            return removed
+
+        removed = list(self.iter_subtree(path[-1][1]))
+        if len(path) == 1:
+            self.root = NamespaceNode()
+        else:
+            self.detach(path, path[-1][1].count)
+        return removed
+
+    def count(self, prefix):
+        path = self.find_path(split_prefix(prefix))
+        return path[-1][1].count if path else 0
+
+    def list(self, prefix, start_after=None, limit=None):
+        path = self.find_path(split_prefix(prefix))
+        if not path:
+            return []
+
+        prefix_segments = [segment for segment, _ in path[1:]]
+        depth = len(prefix_segments)
+        after = split_channel_name(start_after) if start_after else None
+        if after is not None and after[:depth] != prefix_segments:
+            # The cursor is outside of the prefix, so it sorts either before
+            # or after everything under it.
+            if prefix_segments < after[:depth]:
+                return []
+            after = None
+
+        res = []
+        for channel_name in self.iter_subtree(path[-1][1], after, depth):
+            if limit is not None and len(res) >= limit:
+                break
+            res.append(channel_name)
+        return res
+
+    def find_path(self, segments):
+        # Returns [(segment, node), ...] from the root, or None.
+        path = [(None, self.root)]
+        for segment in segments:
+            node = path[-1][1].children.get(segment)
+            if node is None:
+                return None
+            path.append((segment, node))
+        return path
+
+    def detach(self, path, count):
+        for _, node in path:
+            node.count -= count
+
+        # Prune nodes that no longer lead to any channel.
+        for (_, parent), (segment, node) in zip(path[-2::-1], path[:0:-1]):
+            if node.count:
+                break
+            del parent.children[segment]
+
+    def iter_subtree(self, node, after=None, depth=0):
+        # Yields channel names in segment order. With `after` (a split channel
+        # name), only names that sort strictly after it are produced; `node`
+        # is then the one at after[:depth] and is itself never produced.
+        if after is None:
+            if node.channel_name is not None:
+                yield node.channel_name
+            for segment in sorted(node.children):
+                yield from self.iter_subtree(node.children[segment])
+            return
+
+        for segment in sorted(node.children):
+            child = node.children[segment]
+            if depth >= len(after) or segment > after[depth]:
+                yield from self.iter_subtree(child)
+            elif segment == after[depth]:
+                yield from self.iter_subtree(child, after, depth + 1)
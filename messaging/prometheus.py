@@ -0,0 +1,211 @@
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+QUANTILES = [("0.5", "p50"), ("0.9", "p90"), ("0.99", "p99"),
+             ("0.999", "p999")]
+
+
+def format_labels(**labels):
+    return "{" + ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\")
+                         .replace("\n", "\\n").replace('"', '\\"'))
+        for key, value in labels.items()) + "}"
+
+
+class MetricsWriter(object):
+    # Prometheus text format. Samples are (labels, value) where labels is a
+    # string from format_labels() (or ""), so that a channel's labels are
+    # escaped once for all of its metrics.
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, metric_type, help_text, samples):
+        self.lines.append("# HELP {} {}".format(name, help_text))
+        self.lines.append("# TYPE {} {}".format(name, metric_type))
+        self.lines.extend("{}{} {}".format(name, labels, value)
+                          for labels, value in samples)
+
+    def add_summary(self, name, help_text, label_name, histograms):
+        # histograms: {label value: LatencyHistogram.to_json()}
+        self.lines.append("# HELP {} {}".format(name, help_text))
+        self.lines.append("# TYPE {} summary".format(name))
+        for label, stats in histograms.items():
+            for quantile, key in QUANTILES:
+                self.lines.append("{}{} {}".format(
+                    name, format_labels(**{label_name: label,
+                                           "quantile": quantile}),
+                    stats[key]))
+            labels = format_labels(**{label_name: label})
+            self.lines.append("{}_sum{} {}".format(
+                name, labels, stats["mean"] * stats["count"]))
+            self.lines.append("{}_count{} {}".format(name, labels,
+                                                     stats["count"]))
+
+    def add_totals(self, name, help_text, samples):
+        # A summary with only _sum and _count; samples are
+        # (labels, sum, count).
+        self.lines.append("# HELP {} {}".format(name, help_text))
+        self.lines.append("# TYPE {} summary".format(name))
+        for labels, total, count in samples:
+            self.lines.append("{}_sum{} {}".format(name, labels, total))
+            self.lines.append("{}_count{} {}".format(name, labels, count))
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class MetricsExporter(object):
+    # Reads the server's state without stopping it: the channel map and the
+    # registries' dicts are read as they are, and per-channel figures are
+    # plain counters, not histograms, so a scrape stays cheap with thousands
+    # of channels. Rates are left to Prometheus (rate() over the counters).
+    def __init__(self, message_server, rpc_hub=None):
+        self.message_server = message_server
+        self.rpc_hub = rpc_hub
+
+    def render(self):
+        writer = MetricsWriter()
+        self.add_connections(writer)
+        self.add_channels(writer)
+        self.add_registries(writer)
+        self.add_memory(writer)
+        writer.add_summary("weave_stage_latency_microseconds",
+                           "Time taken by each stage of handling sampled " +
+                           "messages.", "stage",
+                           self.message_server.stage_timings.to_json()[
+                               "stages_us"])
+        return writer.render()
+
+    def add_connections(self, writer):
+        server = self.message_server
+        with server.active_connections_lock:
+            connections = list(server.active_connections)
+
+        writer.add("weave_connections", "gauge", "Open connections.",
+                   [("", len(connections))])
+        writer.add("weave_connection_outbound_queue_depth", "gauge",
+                   "Responses waiting to be written to a connection.",
+                   [(format_labels(connection=x.id, peer=x.peer),
+                     x.get_outbound_depth()) for x in connections])
+        writer.add("weave_connection_outbound_bytes", "gauge",
+                   "Payload bytes of responses waiting to be written to a " +
+                   "connection.",
+                   [(format_labels(connection=x.id, peer=x.peer),
+                     x.get_outbound_bytes()) for x in connections])
+
+    def add_channels(self, writer):
+        # Only channels that are loaded; reclaimed ones have no activity.
+        channels = self.message_server.channel_registry.channel_map
+        families = [
+            ("weave_channel_depth", "gauge", "Messages queued in a channel.",
+             lambda x: x.get_queue_size()),
+            ("weave_channel_waiters", "gauge",
+             "Sessions waiting to pop from a channel.",
+             lambda x: x.get_requestors_size()),
+            ("weave_channel_pushes_total", "counter",
+             "Messages pushed to a channel.", lambda x: x.metrics.pushes),
+            ("weave_channel_pops_total", "counter",
+             "Messages delivered from a channel.", lambda x: x.metrics.pops),
+            ("weave_channel_drops_total", "counter",
+             "Messages dropped by a channel.", lambda x: x.metrics.drops),
+            ("weave_channel_rejected_total", "counter",
+             "Pushes refused by the memory budget.",
+             lambda x: x.metrics.rejected),
+            ("weave_channel_bytes_total", "counter",
+             "Payload bytes pushed to a channel.", lambda x: x.metrics.bytes),
+            ("weave_channel_queued_bytes", "gauge",
+             "Payload bytes of the messages queued in a channel.",
+             lambda x: x.get_memory_usage()),
+        ]
+
+        labelled = [(format_labels(channel=name), channel)
+                    for name, channel in channels.items()]
+        for name, metric_type, help_text, getter in families:
+            writer.add(name, metric_type, help_text,
+                       [(labels, getter(channel))
+                        for labels, channel in labelled])
+
+        # Without quantiles, which would mean scanning every histogram.
+        writer.add_totals("weave_channel_delivery_latency_microseconds",
+                          "Time messages waited in a channel before " +
+                          "delivery.",
+                          [(labels, channel.metrics.latency.sum,
+                            channel.metrics.latency.total)
+                           for labels, channel in labelled])
+
+    def add_registries(self, writer):
+        server = self.message_server
+        sizes = [
+            ("apps", len(server.apps_registry.apps_by_url)),
+            ("channels", len(server.channel_registry.channel_infos)),
+            ("loaded_channels", len(server.channel_registry.channel_map)),
+            ("synonyms", len(server.synonym_registry.synonyms)),
+        ]
+        if self.rpc_hub is not None:
+            sizes.append(("rpcs", len(self.rpc_hub.rpc_registry)))
+
+        writer.add("weave_registry_entries", "gauge",
+                   "Entries in each registry.",
+                   [(format_labels(registry=name), size)
+                    for name, size in sizes])
+
+    def add_memory(self, writer):
+        budget = self.message_server.memory_budget
+        writer.add("weave_memory_used_bytes", "gauge",
+                   "Payload bytes held by channels and outbound queues.",
+                   [("", budget.used)])
+        if budget.limit is not None:
+            writer.add("weave_memory_limit_bytes", "gauge",
+                       "Memory budget for message payloads.",
+                       [("", budget.limit)])
+        writer.add("weave_memory_rejected_total", "counter",
+                   "Pushes rejected for lack of memory.",
+                   [("", budget.rejected)])
+        writer.add("weave_memory_shed_bytes_total", "counter",
+                   "Payload bytes of queued messages dropped for lack of " +
+                   "memory.", [("", budget.shed)])
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        try:
+            body = self.server.exporter.render().encode("UTF-8")
+        except Exception:
+            logger.exception("Unable to render metrics.")
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logger.debug(fmt, *args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    # Serves GET /metrics. Listens on localhost unless told otherwise.
+    daemon_threads = True
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, port, exporter, host="127.0.0.1"):
+        super().__init__((host, port), MetricsHandler)
+        self.exporter = exporter
+
+    def run(self):
+        self.serve_forever(poll_interval=self.POLL_INTERVAL)
+
+    def shutdown(self):
+        super().shutdown()
+        self.server_close()
@@ -1,116 +1,486 @@
+import json
 import logging
+import time
+from functools import lru_cache
 from threading import RLock
 
-from jsonschema import Draft4Validator, SchemaError
-
 from weavelib.exceptions import ObjectNotFound, ObjectAlreadyExists
 from weavelib.exceptions import ObjectClosed, SchemaValidationFailed
 from weavelib.exceptions import InternalError, BadArguments
+from weavelib.messaging import Message
 
 from .queues import RoundRobinQueue, SessionizedQueue, Multicast
+from .queues import PartitionedQueue
+from .dispatchers import get_dispatcher_cls
+from .authorizers import ChainedAuthorizer, PrefixACLAuthorizer
+from .authorizers import authorizer_from_json
+from .memory import MemoryBudget
+from .namespace import ChannelNamespace
 
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=1024)
+def is_valid_schema(schema_json):
+    # jsonschema is slow to import, so it's only loaded once needed.
+    from jsonschema import Draft4Validator, SchemaError
+    try:
+        Draft4Validator.check_schema(json.loads(schema_json))
+    except SchemaError:
+        return False
+    return True
+
+
+def check_schema(schema):
+    # Channels mostly share a handful of schemas (e.g. on a warm start), so
+    # the result is cached by the schema's canonical JSON.
+    if schema == {}:
+        return
+    try:
+        schema_json = json.dumps(schema, sort_keys=True)
+    except (TypeError, ValueError):
+        raise SchemaValidationFailed(schema)
+    if not is_valid_schema(schema_json):
+        raise SchemaValidationFailed(schema)
+
+
+class AcceptAllValidator(object):
+    # Validator of the empty schema. Saves loading jsonschema for channels
+    # that don't have a schema.
+    def get_error(self, instance):
+        return None
+
+
 class ChannelInfo(object):
     def __init__(self, channel_name, owner_app, request_schema, response_schema,
                  authorizers=None):
-        try:
-            Draft4Validator.check_schema(request_schema)
-        except SchemaError:
-            raise SchemaValidationFailed(request_schema)
-        try:
-            Draft4Validator.check_schema(response_schema)
-        except SchemaError:
-            raise SchemaValidationFailed(response_schema)
+        check_schema(request_schema)
+        check_schema(response_schema)
 
         self.channel_name = channel_name
         self.request_schema = request_schema
         self.response_schema = response_schema
+        # The channel's own rules, as snapshotted. ChannelRegistry chains
+        # them with its ACL in chained_authorizers, which check_auth uses.
         self.authorizers = authorizers or {}
+        self.chained_authorizers = self.authorizers
         self.owner_app = owner_app
 
+    @property
+    def request_schema(self):
+        return self._request_schema
+
+    @request_schema.setter
+    def request_schema(self, schema):
+        self._request_schema = schema
+        self._request_validator = None  # Compiled on first use.
+
+    @property
+    def request_validator(self):
+        validator = self._request_validator
+        if validator is None:
+            if self._request_schema == {}:
+                validator = AcceptAllValidator()
+            else:
+                from .schema import SchemaValidator
+                validator = SchemaValidator(self._request_schema)
+            self._request_validator = validator
+        return validator
+
     def create_channel(self):
         raise NotImplementedError
 
+    def to_json(self):
+        return {
+            "channel_name": self.channel_name,
+            "owner_app": self.owner_app.url,
+            "request_schema": self.request_schema,
+            "response_schema": self.response_schema,
+            "authorizers": {op: authorizer.to_json()
+                            for op, authorizer in self.authorizers.items()},
+        }
+
 
 class QueueInfo(ChannelInfo):
     def __init__(self, queue_name, owner_app, request_schema, response_schema,
-                 queue_type, authorizers=None):
+                 queue_type, authorizers=None, options=None):
         super().__init__(queue_name, owner_app, request_schema, response_schema,
                          authorizers=authorizers)
+        self.queue_type = queue_type
+        self.options = options or {}
         channel_map = {
             "fifo": RoundRobinQueue,
             "sessionized": SessionizedQueue,
-            "multicast": Multicast
+            "multicast": Multicast,
+            "partitioned": PartitionedQueue,
         }
         self.queue_cls = channel_map.get(queue_type)
         if not self.queue_cls:
             raise BadArguments(queue_type)
+        self.dispatcher_cls = get_dispatcher_cls(self.options.get("dispatch"))
+
+    def create_dispatcher(self):
+        return self.dispatcher_cls()
 
     def create_channel(self):
         return self.queue_cls(self)
 
+    def to_json(self):
+        res = super().to_json()
+        res.update(queue_type=self.queue_type, options=self.options)
+        return res
+
+    @staticmethod
+    def from_json(obj, owner_app):
+        authorizers = {op: authorizer_from_json(authorizer)
+                       for op, authorizer in obj["authorizers"].items()}
+        return QueueInfo(obj["channel_name"], owner_app, obj["request_schema"],
+                         obj["response_schema"], obj["queue_type"],
+                         authorizers, obj["options"])
+
 
 class ChannelRegistry(object):
-    def __init__(self, app_registry):
+    # channel_map holds the live channel objects and is never mutated once
+    # published. Writers build a new map under channel_map_lock and swap it in,
+    # so get_channel() (called for every message) reads the current snapshot
+    # without taking any lock.
+    #
+    # channel_infos has the ChannelInfo of every registered channel. Channels
+    # created lazily, restored from a snapshot or reclaimed after idle_timeout
+    # seconds without activity only have a ChannelInfo, and are materialized
+    # on first use.
+    #
+    # generation is bumped whenever channel objects are dropped from
+    # channel_map, so that references cached outside of the registry (see
+    # MessageServer) can be checked for staleness without a lock.
+    #
+    # Every channel accounts the messages it holds against memory_budget,
+    # which sheds from the channels holding the most if its policy says so.
+    def __init__(self, app_registry, idle_timeout=None, memory_budget=None):
         self.channel_map = {}
+        self.channel_infos = {}
         self.channel_map_lock = RLock()
+        self.namespace = ChannelNamespace()
         self.app_registry = app_registry
+        self.acl = PrefixACLAuthorizer()
+        self.restored_channels = set()
+        self.idle_timeout = idle_timeout
+        self.generation = 0
         self.active = True
+        self.memory_budget = memory_budget or MemoryBudget()
+        self.memory_budget.shedder = self.shed_memory
 
     def create_queue(self, queue_name, owner_app, request_schema,
-                     response_schema, queue_type, authorizers=None):
+                     response_schema, queue_type, authorizers=None,
+                     options=None, lazy=False):
+        # With lazy=True, only the ChannelInfo is registered and None is
+        # returned; the channel is materialized when it is first used.
         channel_info = QueueInfo(queue_name, owner_app, request_schema,
-                               response_schema, queue_type, authorizers)
+                                 response_schema, queue_type, authorizers,
+                                 options)
+        self.set_authorizers(channel_info, authorizers)
 
         with self.channel_map_lock:
             if not self.active:
                 raise ObjectClosed("Server shutting down.")
 
-            if channel_info.channel_name in self.channel_map:
-                raise ObjectAlreadyExists(channel_info.channel_name)
+            channel_name = channel_info.channel_name
+            if channel_name in self.channel_infos:
+                if not self.adopt_restored_channel(channel_info):
+                    raise ObjectAlreadyExists(channel_name)
+            else:
+                self.channel_infos[channel_name] = channel_info
+                self.namespace.add(channel_name)
+                logger.info("Created channel: %s", channel_name)
+
+            if lazy:
+                return None
+            return self.materialize(channel_name)
+
+    def materialize(self, channel_name):
+        with self.channel_map_lock:
+            channel = self.channel_map.get(channel_name)
+            if channel is not None:
+                return channel
+
+            try:
+                channel_info = self.channel_infos[channel_name]
+            except KeyError:
+                raise ObjectNotFound(channel_name)
+
+            if not self.active:
+                raise ObjectClosed("Server shutting down.")
 
             channel = channel_info.create_channel()
-            self.channel_map[channel_info.channel_name] = channel
+            channel.memory_budget = self.memory_budget
+            if not channel.connect():
+                raise InternalError("Can't connect to channel: " +
+                                    str(channel))
 
-        if not channel.connect():
-            raise InternalError("Can't connect to channel: " + str(channel))
+            channel_map = dict(self.channel_map)
+            channel_map[channel_name] = channel
+            self.channel_map = channel_map
+            return channel
 
-        logger.info("Created channel: %s", channel)
-        return channel
+    def adopt_restored_channel(self, channel_info):
+        # The owner of a channel restored from a snapshot re-creating it takes
+        # it over with whatever schema and authorizers it asks for now.
+        channel_name = channel_info.channel_name
+        if channel_name not in self.restored_channels:
+            return False
 
-    def update_channel_schema(self, channel_name, request_schema,
-                              response_schema):
+        existing_info = self.channel_infos[channel_name]
+        if existing_info.owner_app.url != channel_info.owner_app.url or \
+                existing_info.queue_type != channel_info.queue_type:
+            return False
+
+        self.restored_channels.discard(channel_name)
+        existing_info.owner_app = channel_info.owner_app
+        existing_info.request_schema = channel_info.request_schema
+        existing_info.response_schema = channel_info.response_schema
+        self.set_authorizers(existing_info, channel_info.authorizers)
+        self.invalidate_channel_auth_cache(channel_name)
+        logger.info("Adopted restored channel: %s", channel_name)
+        return True
+
+    def is_restored(self, channel_name):
+        # True for a channel restored from a snapshot that its owner hasn't
+        # re-created yet.
+        return channel_name in self.restored_channels
+
+    def release_adopted_channel(self, channel_name):
+        # Undoes adopt_restored_channel() when the call re-creating the
+        # channel fails: it waits for its owner again, messages and all.
+        with self.channel_map_lock:
+            if channel_name in self.channel_infos:
+                self.restored_channels.add(channel_name)
+
+    def to_json(self, include_messages=False, exclude_prefixes=()):
+        with self.channel_map_lock:
+            channel_infos = sorted(self.channel_infos.items())
+        channel_map = self.channel_map
+
+        channels = []
+        for name, channel_info in channel_infos:
+            if any(name.startswith(x) for x in exclude_prefixes):
+                continue
+            obj = channel_info.to_json()
+            channel = channel_map.get(name)
+            if include_messages and channel is not None:
+                obj["messages"] = [{"task": msg.task, "headers": msg.headers}
+                                   for msg in channel.dump_messages()]
+            channels.append(obj)
+        return {"channels": channels, "acl_rules": self.acl.list_rules()}
+
+    def restore(self, obj):
+        for rule in obj.get("acl_rules", []):
+            self.acl.add_rule(rule["pattern"], rule["app_url"],
+                              rule["operations"])
+
+        channel_infos = []
+        messages = {}
+        for channel_obj in obj.get("channels", []):
+            try:
+                owner_app = self.app_registry.get_app_by_url(
+                    channel_obj["owner_app"])
+            except ObjectNotFound:
+                logger.warning("Not restoring channel %s: unknown owner.",
+                               channel_obj["channel_name"])
+                continue
+
+            channel_info = QueueInfo.from_json(channel_obj, owner_app)
+            self.set_authorizers(channel_info, channel_info.authorizers)
+            channel_infos.append(channel_info)
+
+            for msg_obj in channel_obj.get("messages", []):
+                msg = Message("enqueue", msg_obj["task"])
+                msg.headers.update(msg_obj["headers"])
+                messages.setdefault(channel_info.channel_name, []).append(msg)
+
+        restored = 0
+        with self.channel_map_lock:
+            for channel_info in channel_infos:
+                name = channel_info.channel_name
+                if name in self.channel_infos:
+                    continue
+                self.channel_infos[name] = channel_info
+                self.namespace.add(name)
+                self.restored_channels.add(name)
+                restored += 1
+
+        # Only channels holding messages need to exist right away.
+        for name, channel_messages in messages.items():
+            self.materialize(name).load_messages(channel_messages)
+
+        logger.info("Restored %d channels.", restored)
+        return restored
+
+    def get_channel_info(self, channel_name):
         with self.channel_map_lock:
             try:
-                channel_info = self.channel_map[channel_name].channel_info
+                return self.channel_infos[channel_name]
             except KeyError:
                 raise ObjectNotFound(channel_name)
 
+    def update_channel_schema(self, channel_name, request_schema,
+                              response_schema):
+        check_schema(request_schema)
+        check_schema(response_schema)
+        channel_info = self.get_channel_info(channel_name)
+
         # TODO: This might need to be protected by a lock.
         channel_info.request_schema = request_schema
         channel_info.response_schema = response_schema
         logger.info(channel_info.request_schema)
         return True
 
+    def update_channel_authorizers(self, channel_name, authorizers):
+        channel_info = self.get_channel_info(channel_name)
+        self.set_authorizers(channel_info, authorizers)
+        self.invalidate_channel_auth_cache(channel_name)
+        return True
+
+    def with_acl(self, authorizers):
+        # ACL rules can grant access on top of the channel's own rules. Ops
+        # without an authorizer are open to everyone anyway.
+        return {op: ChainedAuthorizer([self.acl, authorizer])
+                for op, authorizer in authorizers.items()}
+
+    def set_authorizers(self, channel_info, authorizers):
+        channel_info.authorizers = authorizers or {}
+        channel_info.chained_authorizers = self.with_acl(
+            channel_info.authorizers)
+
+    def add_acl_rule(self, pattern, app_url, operations):
+        self.acl.add_rule(pattern, app_url, operations)
+        self.invalidate_auth_cache()
+        return True
+
+    def remove_acl_rule(self, pattern, app_url):
+        if not self.acl.remove_rule(pattern, app_url):
+            raise ObjectNotFound(pattern)
+        self.invalidate_auth_cache()
+        return True
+
+    def invalidate_channel_auth_cache(self, channel_name):
+        # Channels that are not materialized have no cache.
+        channel = self.channel_map.get(channel_name)
+        if channel is not None:
+            channel.invalidate_auth_cache()
+
+    def invalidate_auth_cache(self):
+        for channel in self.channel_map.values():
+            channel.invalidate_auth_cache()
+
     def remove_channel(self, channel_name):
         with self.channel_map_lock:
-            try:
-                channel = self.channel_map.pop(channel_name)
-            except KeyError:
+            if self.channel_infos.pop(channel_name, None) is None:
                 raise ObjectNotFound(channel_name)
-        channel.disconnect()
+            self.namespace.remove(channel_name)
+            self.restored_channels.discard(channel_name)
+
+            channel_map = dict(self.channel_map)
+            channel = channel_map.pop(channel_name, None)
+            self.channel_map = channel_map
+            self.generation += 1
+
+        if channel is not None:
+            channel.disconnect()
+            channel.release_memory()
         return True
 
-    def get_channel(self, channel_name):
-        # TODO: Change to reader-writer lock.
+    def remove_channels(self, prefix, exclude_prefixes=()):
         with self.channel_map_lock:
-            try:
-                return self.channel_map[channel_name]
-            except KeyError:
-                raise ObjectNotFound(channel_name)
+            names = self.namespace.remove_prefix(prefix, exclude_prefixes)
+            for name in names:
+                del self.channel_infos[name]
+            self.restored_channels.difference_update(names)
+
+            channel_map = dict(self.channel_map)
+            channels = [channel_map.pop(name) for name in names
+                        if name in channel_map]
+            self.channel_map = channel_map
+            self.generation += 1
+
+        for channel in channels:
+            channel.disconnect()
+            channel.release_memory()
+        logger.info("Removed %d channels under %s", len(names), prefix)
+        return names
+
+    def reclaim_idle_channels(self):
+        # Drops channel objects that saw no push or pop for idle_timeout
+        # seconds and hold no messages or waiters, keeping only their
+        # ChannelInfo.
+        if not self.idle_timeout:
+            return 0
+
+        deadline = time.monotonic() - self.idle_timeout
+        with self.channel_map_lock:
+            evicted = [name for name, channel in self.channel_map.items()
+                       if channel.last_active < deadline and
+                       channel.try_evict()]
+            if not evicted:
+                return 0
+
+            channel_map = dict(self.channel_map)
+            for name in evicted:
+                del channel_map[name]
+            self.channel_map = channel_map
+            self.generation += 1
+
+        logger.info("Reclaimed %d idle channels.", len(evicted))
+        return len(evicted)
+
+    def get_stats(self, prefix):
+        # Only materialized channels have stats; the others are idle anyway.
+        names = self.list_channels(prefix)
+        channel_map = self.channel_map
+        return {name: channel_map[name].get_stats() for name in names
+                if name in channel_map}
+
+    def get_total_depth(self):
+        # Messages waiting in all channels.
+        return sum(channel.get_queue_size()
+                   for channel in self.channel_map.values())
+
+    def get_memory_usage(self, limit=None):
+        # [(channel name, queued bytes)], largest first.
+        usage = [(name, channel.get_memory_usage())
+                 for name, channel in self.channel_map.items()]
+        usage = sorted((x for x in usage if x[1]), key=lambda x: x[1],
+                       reverse=True)
+        return usage if limit is None else usage[:limit]
+
+    def shed_memory(self, nbytes):
+        # Called by memory_budget when it's full. Drops the oldest messages
+        # of the channels holding the most until nbytes are freed.
+        channels = sorted(self.channel_map.items(),
+                          key=lambda x: x[1].get_memory_usage(), reverse=True)
+        freed = 0
+        for name, channel in channels:
+            if freed >= nbytes:
+                break
+            channel_freed = channel.shed(nbytes - freed)
+            if channel_freed:
+                logger.warning("Shed %d bytes from %s.", channel_freed, name)
+            freed += channel_freed
+        return freed
+
+    def list_channels(self, prefix, start_after=None, limit=None):
+        with self.channel_map_lock:
+            return self.namespace.list(prefix, start_after, limit)
+
+    def count_channels(self, prefix):
+        with self.channel_map_lock:
+            return self.namespace.count(prefix)
+
+    def get_channel(self, channel_name):
+        try:
+            return self.channel_map[channel_name]
+        except KeyError:
+            return self.materialize(channel_name)
 
     def shutdown(self):
         with self.channel_map_lock:
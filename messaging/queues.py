@@ -1,23 +1,48 @@
 import json
-from collections import defaultdict
+import time
+import zlib
+from collections import defaultdict, deque, OrderedDict
 from threading import Lock
 
-from jsonschema import validate, ValidationError
-
 from weavelib.exceptions import AuthenticationFailed, Unauthorized
-from weavelib.exceptions import SchemaValidationFailed
+from weavelib.exceptions import SchemaValidationFailed, BadArguments
+from weavelib.exceptions import ProtocolError, InternalError
 
 from .messaging_utils import get_required_field
-from .authorizers import AllowAllAuthorizer
+from .authorizers import ALLOW_ALL
+from .dispatchers import Waiter
+from .memory import MemoryBudget
+from .metrics import ChannelMetrics, payload_size
+
+
+# Headers passed on to whoever a message is delivered to.
+DELIVERED_HEADERS = frozenset(["AUTH", "TRACE"])
 
 
 def filter_headers(headers, fields):
     return {k: v for k, v in headers.items() if k.upper() in fields}
 
 
+class ChannelEvicted(Exception):
+    # Raised when a channel reclaimed by ChannelRegistry is used through a
+    # stale reference. The caller should look the channel up again.
+    pass
+
+
 class BaseChannel(object):
+    # When True, a session stays registered with the channel between pops and
+    # is only removed (via remove_requestor) when its connection closes.
+    session_membership = False
+
     def __init__(self, channel_info):
         self.channel_info = channel_info
+        self.auth_cache = {}  # (app_url, op) -> bool
+        self.last_active = time.monotonic()
+        self.evicted = False
+        self.metrics = ChannelMetrics()
+        # Replaced by ChannelRegistry with the server-wide budget.
+        self.memory_budget = MemoryBudget()
+        self.queued_bytes = 0  # Payload bytes of the messages held.
 
     def connect(self):
         return True
@@ -26,27 +51,87 @@ class BaseChannel(object):
         return True
 
     def validate_schema(self, msg):
-        try:
-            validate(msg.task, self.channel_info.request_schema)
-        except ValidationError:
+        error = self.channel_info.request_validator.get_error(msg.task)
+        if error is not None:
             msg = "Schema: {}, on instance: {}, for channel: {}".format(
                 self.channel_info.request_schema, msg.task, self)
             raise SchemaValidationFailed(msg)
 
     def check_auth(self, op, headers):
-        authorizer = self.channel_info.authorizers.get(op, AllowAllAuthorizer())
-
         # headers.get("AUTH") == ApplicationRegistry.get_app_info().
-        app_info = headers.get("AUTH", {})
+        app_url = headers.get("AUTH", {}).get("app_url")
+
+        # A decision is stored in the cache it was looked up in: if
+        # invalidate_auth_cache() swaps in a new one meanwhile, a decision
+        # made with the old rules goes away with the old cache.
+        cache = self.auth_cache
+        key = (app_url, op)
+        res = cache.get(key)
+        if res is None:
+            authorizer = self.channel_info.chained_authorizers.get(op,
+                                                                   ALLOW_ALL)
+            res = authorizer.authorize(app_url, op,
+                                       self.channel_info.channel_name)
+            cache[key] = res
 
-        default_app_url = object()
-        app_url = app_info.get("app_url", default_app_url)
-        res = authorizer.authorize(app_url, op, self.channel_info.channel_name)
         if not res:
-            if app_url is default_app_url:
+            if app_url is None:
                 raise AuthenticationFailed()
             raise Unauthorized("Action is not authorized.")
 
+    def invalidate_auth_cache(self):
+        self.auth_cache = {}
+
+    def try_evict(self):
+        return False
+
+    def get_stats(self):
+        stats = self.metrics.to_json()
+        stats.update(depth=self.get_queue_size(),
+                     waiters=self.get_requestors_size(),
+                     queued_bytes=self.get_memory_usage())
+        return stats
+
+    def hold(self, msg):
+        # Called with self.lock held when a message is queued. The bytes of a
+        # pushed message were reserved by push(), and are taken over here.
+        # Messages restored from a snapshot weren't pushed, so they have no
+        # size or reservation yet.
+        size = getattr(msg, "payload_bytes", None)
+        if size is None:
+            size = msg.payload_bytes = payload_size(msg.task)
+        self.queued_bytes += size
+        if getattr(msg, "reserved_budget", None) is self.memory_budget:
+            msg.reserved_budget = None
+        else:
+            self.memory_budget.reserve(size)
+
+    def release(self, msg):
+        # Called with self.lock held when a queued message leaves.
+        self.queued_bytes -= msg.payload_bytes
+        self.memory_budget.release(msg.payload_bytes)
+
+    def get_memory_usage(self):
+        return self.queued_bytes
+
+    def release_memory(self):
+        # Called once the channel is removed; whatever it still holds no
+        # longer counts against the server's budget.
+        budget, self.memory_budget = self.memory_budget, MemoryBudget()
+        size, self.queued_bytes = self.queued_bytes, 0
+        budget.release(size)
+
+    def shed(self, nbytes):
+        # Drops the oldest queued messages until at least nbytes are freed.
+        # Returns the number of bytes freed.
+        return 0
+
+    def get_queue_size(self):
+        return 0
+
+    def get_requestors_size(self):
+        return 0
+
     def __repr__(self):
         return (self.__class__.__name__ +
                 "({})".format(self.channel_info.channel_name))
@@ -65,22 +150,49 @@ class SynchronousQueue(BaseChannel):
         self.active = False
 
     def push(self, msg):
+        clock = getattr(msg, "stage_clock", None)
         self.validate_schema(msg)
+        if clock is not None:
+            clock.lap("validate_schema")
         self.check_auth('push', msg.headers)
-        self.on_push(msg)
+        if clock is not None:
+            clock.lap("check_auth")
+        self.last_active = time.monotonic()
+        msg.payload_bytes = payload_size(msg.task)
+        budget = self.memory_budget
+        try:
+            budget.check(msg.payload_bytes)
+        except InternalError:
+            self.metrics.on_reject(msg)
+            raise
+        msg.reserved_budget = budget
+        try:
+            self.metrics.on_push(msg)
+            self.on_push(msg)
+        finally:
+            # Not queued: delivered right away, or not taken at all.
+            if msg.reserved_budget is not None:
+                msg.reserved_budget = None
+                budget.release(msg.payload_bytes)
+        if clock is not None:
+            # Queue locks and handing the message to a waiting session.
+            clock.lap("dispatch")
 
     def on_push(self, msg):
         raise NotImplementedError
 
     def pop(self, msg, out):
         self.check_auth('pop', msg.headers)
+        self.last_active = time.monotonic()
+        self.on_pop(msg, self.post_process_out(out))
 
+    def post_process_out(self, out):
+        # The AUTH header of delivered messages is sent as JSON.
         def post_process_out_message(task, headers):
             if "AUTH" in headers:
                 headers["AUTH"] = json.dumps(headers["AUTH"])
             out(task, headers)
-
-        self.on_pop(msg, post_process_out_message)
+        return post_process_out_message
 
     def on_pop(self, dequeue_msg, out):
         raise NotImplementedError
@@ -88,6 +200,24 @@ class SynchronousQueue(BaseChannel):
     def remove_requestor(self, requestor_id):
         raise NotImplementedError
 
+    def try_evict(self):
+        with self.lock:
+            if not self.is_idle():
+                return False
+            self.evicted = True
+            return True
+
+    def is_idle(self):
+        # Called with self.lock held.
+        raise NotImplementedError
+
+    def dump_messages(self):
+        return []
+
+    def load_messages(self, messages):
+        for msg in messages:
+            self.on_push(msg)
+
 
 # TODO: Handle case when there's an IOError when writing the msg out.
 
@@ -95,34 +225,51 @@ class SynchronousQueue(BaseChannel):
 class RoundRobinQueue(SynchronousQueue):
     def __init__(self, queue_info):
         super().__init__(queue_info)
-        self.retain_headers = {"AUTH"}
+        self.retain_headers = set(DELIVERED_HEADERS)
+        if queue_info.options.get("response_channel"):
+            # RPC request queue: providers reply to the caller's COOKIE.
+            self.retain_headers.add("COOKIE")
         self.queue = []
-        self.requestors = []
-        self.requestors_by_session_id = {}
+        self.requestors_by_session_id = OrderedDict()
+        self.dispatcher = queue_info.create_dispatcher()
         self.lock = Lock()
 
     def on_push(self, obj):
         active_pop_requestor = None
         with self.lock:
-            if self.requestors:
-                active_pop_requestor = self.requestors.pop(0)
+            if self.evicted:
+                raise ChannelEvicted()
+            if self.requestors_by_session_id:
+                active_pop_requestor = self.dispatcher.select(
+                    self.requestors_by_session_id.values())
+                self.requestors_by_session_id.pop(
+                    active_pop_requestor.session_id)
+                self.dispatcher.on_delivered(active_pop_requestor)
             else:
                 self.queue.append(obj)
+                self.hold(obj)
 
         if active_pop_requestor:
+            self.metrics.on_delivered(obj)
             headers = filter_headers(obj.headers, self.retain_headers)
-            active_pop_requestor(obj.task, headers)
+            active_pop_requestor.out(obj.task, headers)
 
     def on_pop(self, dequeue_msg, out):
+        waiter = Waiter.from_message(dequeue_msg, out)
         with self.lock:
+            if self.evicted:
+                raise ChannelEvicted()
+            self.dispatcher.on_pop(waiter)
             if self.queue:
                 msg = self.queue.pop(0)
+                self.release(msg)
+                self.dispatcher.on_delivered(waiter)
             else:
                 msg = None
-                self.requestors.append(out)
-                self.requestors_by_session_id[dequeue_msg.headers["SESS"]] = out
+                self.requestors_by_session_id[waiter.session_id] = waiter
 
         if msg:
+            self.metrics.on_delivered(msg)
             out(msg.task, filter_headers(msg.headers, self.retain_headers))
             return True
         return False
@@ -133,13 +280,46 @@ class RoundRobinQueue(SynchronousQueue):
 
     def get_requestors_size(self):
         with self.lock:
-            return len(self.requestors)
+            return len(self.requestors_by_session_id)
+
+    def get_delivery_counts(self):
+        with self.lock:
+            return dict(self.dispatcher.delivery_counts)
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats.update(deliveries=self.get_delivery_counts())
+        return stats
+
+    def dump_messages(self):
+        with self.lock:
+            return list(self.queue)
+
+    def is_idle(self):
+        return not self.queue and not self.requestors_by_session_id
+
+    def release_memory(self):
+        with self.lock:
+            super().release_memory()
+
+    def shed(self, nbytes):
+        dropped = []
+        freed = 0
+        with self.lock:
+            while self.queue and freed < nbytes:
+                msg = self.queue.pop(0)
+                self.release(msg)
+                freed += msg.payload_bytes
+                dropped.append(msg)
+
+        for msg in dropped:
+            self.metrics.on_drop(msg)
+        return freed
 
     def remove_requestor(self, session_id):
         with self.lock:
-            requestor = self.requestors_by_session_id.pop(session_id, None)
-            if requestor:
-                self.requestors.remove(requestor)
+            self.requestors_by_session_id.pop(session_id, None)
+            self.dispatcher.on_remove(session_id)
 
 
 class SessionizedQueue(SynchronousQueue):
@@ -150,42 +330,171 @@ class SessionizedQueue(SynchronousQueue):
 
         def new_fifo_queue():
             queue = RoundRobinQueue(queue_info)
+            queue.metrics = self.metrics
+            queue.memory_budget = self.memory_budget
             queue.connect()
             return queue
 
         self.queues = defaultdict(new_fifo_queue)
         self.session_id_to_cookie_map = {}
+        # Callers waiting on a reply through the server's "call" operation.
+        # Replies to them are handed over directly, without creating a queue
+        # for the cookie.
+        self.reply_waiters = {}  # cookie -> Waiter
         self.lock = Lock()
 
+    # A cookie's queue is dropped (and evicted, so that whoever still holds
+    # it retries with a new one) as soon as it holds no messages or waiters,
+    # and a session is forgotten as soon as its pop is answered, so that
+    # short-lived cookies such as those of RPC calls leave nothing behind.
     def on_push(self, msg):
         cookie = get_required_field(msg.headers, "COOKIE")
+        while True:
+            with self.lock:
+                if self.evicted:
+                    raise ChannelEvicted()
+                waiter = self.reply_waiters.pop(cookie, None)
+                if waiter is not None:
+                    self.session_id_to_cookie_map.pop(waiter.session_id, None)
+                else:
+                    queue = self.queues[cookie]
+
+            if waiter is not None:
+                self.metrics.on_delivered(msg)
+                waiter.out(msg.task, filter_headers(msg.headers,
+                                                    DELIVERED_HEADERS))
+                return
+
+            try:
+                return queue.on_push(msg)
+            except ChannelEvicted:
+                continue  # The cookie's queue was dropped meanwhile.
+
+    def expect_reply(self, call_msg, out):
+        # Registers a one-off pop for the reply to call_msg, which is pushed
+        # with the same COOKIE. Must be called before the request is sent, so
+        # the reply can't be missed. The COOKIE must not be in use by another
+        # call or by regular pops, nor the session by another call or pop.
+        self.check_auth('pop', call_msg.headers)
+        cookie = get_required_field(call_msg.headers, "COOKIE")
+        waiter = Waiter.from_message(call_msg, self.post_process_out(out))
+        with self.lock:
+            if self.evicted:
+                raise ChannelEvicted()
+            if cookie in self.reply_waiters or cookie in self.queues:
+                raise ProtocolError("COOKIE is already in use.")
+            if waiter.session_id in self.session_id_to_cookie_map:
+                raise ProtocolError("Session is already waiting on a reply.")
+
+            self.reply_waiters[cookie] = waiter
+            self.session_id_to_cookie_map[waiter.session_id] = cookie
+
+    def cancel_reply(self, session_id):
         with self.lock:
-            queue = self.queues[cookie]
-        queue.on_push(msg)
+            cookie = self.session_id_to_cookie_map.get(session_id)
+            waiter = self.reply_waiters.get(cookie)
+            if waiter is not None and waiter.session_id == session_id:
+                del self.reply_waiters[cookie]
+                del self.session_id_to_cookie_map[session_id]
 
     def on_pop(self, dequeue_msg, out):
         cookie = get_required_field(dequeue_msg.headers, "COOKIE")
-        with self.lock:
-            queue = self.queues[cookie]
+        session_id = dequeue_msg.headers["SESS"]
 
-        item_was_popped = queue.on_pop(dequeue_msg, out)
+        def deliver(task, headers):
+            self.on_served(cookie, session_id)
+            out(task, headers)
 
-        with self.lock:
-            if not item_was_popped:
-                session_id = dequeue_msg.headers["SESS"]
+        while True:
+            with self.lock:
+                if self.evicted:
+                    raise ChannelEvicted()
+                queue = self.queues[cookie]
+                # Registered before popping, as the pop may be answered
+                # right away.
                 self.session_id_to_cookie_map[session_id] = cookie
 
+            try:
+                return queue.on_pop(dequeue_msg, deliver)
+            except ChannelEvicted:
+                continue
+
+    def on_served(self, cookie, session_id):
         with self.lock:
-            if not queue.get_queue_size() and not queue.get_requestors_size():
-                self.queues.pop(cookie)
+            if self.session_id_to_cookie_map.get(session_id) == cookie:
+                del self.session_id_to_cookie_map[session_id]
+            self.drop_queue(cookie)
+
+    def drop_queue(self, cookie):
+        # Called with self.lock held.
+        queue = self.queues.get(cookie)
+        if queue is not None and queue.try_evict():
+            del self.queues[cookie]
 
     def remove_requestor(self, session_id):
         with self.lock:
             cookie = self.session_id_to_cookie_map.pop(session_id, None)
-            self.queues[cookie].remove_requestor(session_id)
+            waiter = self.reply_waiters.get(cookie)
+            if waiter is not None and waiter.session_id == session_id:
+                del self.reply_waiters[cookie]
+                return
+            queue = self.queues.get(cookie)
+        if queue is not None:
+            queue.remove_requestor(session_id)
+            with self.lock:
+                self.drop_queue(cookie)
+
+    def dump_messages(self):
+        with self.lock:
+            queues = list(self.queues.values())
+        return [msg for queue in queues for msg in queue.dump_messages()]
+
+    def is_idle(self):
+        return not self.queues and not self.session_id_to_cookie_map and \
+            not self.reply_waiters
+
+    def get_queue_size(self):
+        with self.lock:
+            queues = list(self.queues.values())
+        return sum(queue.get_queue_size() for queue in queues)
+
+    def get_requestors_size(self):
+        with self.lock:
+            return len(self.session_id_to_cookie_map)
+
+    def get_memory_usage(self):
+        # Messages are held by the per-cookie queues.
+        with self.lock:
+            queues = list(self.queues.values())
+        return sum(queue.get_memory_usage() for queue in queues)
+
+    def release_memory(self):
+        with self.lock:
+            self.memory_budget = MemoryBudget()
+            queues = list(self.queues.values())
+        for queue in queues:
+            queue.release_memory()
+
+    def shed(self, nbytes):
+        with self.lock:
+            queues = list(self.queues.values())
+        queues.sort(key=lambda x: x.get_memory_usage(), reverse=True)
+
+        freed = 0
+        for queue in queues:
+            if freed >= nbytes:
+                break
+            freed += queue.shed(nbytes - freed)
+
+        with self.lock:
+            for cookie in list(self.queues):
+                self.drop_queue(cookie)
+        return freed
 
 
 class Multicast(SynchronousQueue):
+    session_membership = True
+
     def __init__(self, multicast_info):
         super().__init__(multicast_info)
         self.active = False
@@ -196,15 +505,217 @@ class Multicast(SynchronousQueue):
         current_requestor = get_required_field(msg.headers, 'SESS')
 
         with self.lock:
+            if self.evicted:
+                raise ChannelEvicted()
             requestors = list(self.requestors.items())
 
+        delivered = False
         for requestor_id, out_fn in requestors:
             if requestor_id != current_requestor:
-                out_fn(msg.task, filter_headers(msg.headers, {"AUTH"}))
+                self.metrics.on_delivered(msg)
+                out_fn(msg.task, filter_headers(msg.headers,
+                                                DELIVERED_HEADERS))
+                delivered = True
+
+        if not delivered:
+            self.metrics.on_drop(msg)
 
     def pop(self, dequeue_msg, out_fn):
         requestor_id = get_required_field(dequeue_msg.headers, 'SESS')
         self.check_auth('pop', dequeue_msg.headers)
 
+        self.last_active = time.monotonic()
+
         with self.lock:
+            if self.evicted:
+                raise ChannelEvicted()
             self.requestors[requestor_id] = out_fn
+
+    def remove_requestor(self, session_id):
+        with self.lock:
+            self.requestors.pop(session_id, None)
+
+    def is_idle(self):
+        return not self.requestors
+
+    def get_requestors_size(self):
+        with self.lock:
+            return len(self.requestors)
+
+
+class PartitionedQueue(SynchronousQueue):
+    session_membership = True
+    DEFAULT_PARTITIONS = 16
+    DEFAULT_KEY_HEADER = "KEY"
+
+    def __init__(self, queue_info):
+        super().__init__(queue_info)
+        options = queue_info.options
+        num_partitions = options.get("partitions", self.DEFAULT_PARTITIONS)
+        if not isinstance(num_partitions, int) or num_partitions < 1:
+            raise BadArguments("Bad partition count: " + str(num_partitions))
+
+        self.key_header = options.get("key_header", self.DEFAULT_KEY_HEADER)
+        self.retain_headers = DELIVERED_HEADERS | {self.key_header.upper()}
+        self.partitions = [deque() for _ in range(num_partitions)]
+        self.owners = [None] * num_partitions
+
+        # Partition whose message a session is processing. It stays blocked
+        # for every other session until the current one pops again, so that
+        # rebalancing never reorders messages of a key.
+        self.inflight = {}
+        self.members = OrderedDict()  # session_id -> owned partitions.
+        self.requestors_by_session_id = {}
+        self.lock = Lock()
+
+    def get_partition(self, key):
+        return zlib.crc32(str(key).encode("UTF-8")) % len(self.partitions)
+
+    def on_push(self, msg):
+        key = get_required_field(msg.headers, self.key_header)
+        partition = self.get_partition(key)
+
+        with self.lock:
+            if self.evicted:
+                raise ChannelEvicted()
+            self.partitions[partition].append(msg)
+            self.hold(msg)
+            owner = self.owners[partition]
+            deliveries = []
+            if owner in self.requestors_by_session_id:
+                deliveries = self.dispatch_to(owner)
+
+        self.deliver(deliveries)
+
+    def on_pop(self, dequeue_msg, out):
+        session_id = get_required_field(dequeue_msg.headers, "SESS")
+        with self.lock:
+            if self.evicted:
+                raise ChannelEvicted()
+            released = self.inflight.pop(session_id, None)
+            self.requestors_by_session_id[session_id] = out
+            if session_id not in self.members:
+                self.members[session_id] = []
+                deliveries = self.rebalance()
+            else:
+                deliveries = self.dispatch_to(session_id)
+
+            # The partition just released might have been handed over to
+            # another waiting session.
+            if released is not None:
+                owner = self.owners[released]
+                if owner != session_id and \
+                        owner in self.requestors_by_session_id:
+                    deliveries.extend(self.dispatch_to(owner))
+
+        self.deliver(deliveries)
+        return any(session == session_id for session, _, _ in deliveries)
+
+    def remove_requestor(self, session_id):
+        with self.lock:
+            self.requestors_by_session_id.pop(session_id, None)
+            self.inflight.pop(session_id, None)
+            if self.members.pop(session_id, None) is None:
+                return
+            deliveries = self.rebalance()
+
+        self.deliver(deliveries)
+
+    def rebalance(self):
+        # Sticky assignment: partitions keep their owner as long as it is
+        # still a member and under its fair share.
+        members = list(self.members.keys())
+        for owned in self.members.values():
+            del owned[:]
+
+        if not members:
+            self.owners = [None] * len(self.partitions)
+            return []
+
+        base, extra = divmod(len(self.partitions), len(members))
+        quota = {x: base + (1 if i < extra else 0)
+                 for i, x in enumerate(members)}
+
+        orphans = []
+        for partition, owner in enumerate(self.owners):
+            if owner in self.members and quota[owner]:
+                quota[owner] -= 1
+                self.members[owner].append(partition)
+            else:
+                orphans.append(partition)
+
+        for partition in orphans:
+            owner = next(x for x in members if quota[x])
+            quota[owner] -= 1
+            self.owners[partition] = owner
+            self.members[owner].append(partition)
+
+        deliveries = []
+        for session_id in list(self.requestors_by_session_id.keys()):
+            deliveries.extend(self.dispatch_to(session_id))
+        return deliveries
+
+    def dispatch_to(self, session_id):
+        inflight_partitions = set(self.inflight.values())
+        for partition in self.members.get(session_id, []):
+            if partition in inflight_partitions:
+                continue
+            if self.partitions[partition]:
+                msg = self.partitions[partition].popleft()
+                self.release(msg)
+                out = self.requestors_by_session_id.pop(session_id)
+                self.inflight[session_id] = partition
+
+                # Move to the back so that the session's other partitions
+                # get their turn.
+                owned = self.members[session_id]
+                owned.remove(partition)
+                owned.append(partition)
+                return [(session_id, out, msg)]
+        return []
+
+    def deliver(self, deliveries):
+        for _, out, msg in deliveries:
+            self.metrics.on_delivered(msg)
+            out(msg.task, filter_headers(msg.headers, self.retain_headers))
+
+    def get_queue_size(self):
+        with self.lock:
+            return sum(len(x) for x in self.partitions)
+
+    def get_requestors_size(self):
+        with self.lock:
+            return len(self.requestors_by_session_id)
+
+    def dump_messages(self):
+        with self.lock:
+            return [msg for partition in self.partitions for msg in partition]
+
+    def is_idle(self):
+        return not self.members and not any(self.partitions)
+
+    def release_memory(self):
+        with self.lock:
+            super().release_memory()
+
+    def shed(self, nbytes):
+        # From the longest partitions first. Messages of a key stay in order;
+        # only the oldest of them are lost.
+        dropped = []
+        freed = 0
+        with self.lock:
+            partitions = sorted(self.partitions, key=len, reverse=True)
+            for partition in partitions:
+                while partition and freed < nbytes:
+                    msg = partition.popleft()
+                    self.release(msg)
+                    freed += msg.payload_bytes
+                    dropped.append(msg)
+
+        for msg in dropped:
+            self.metrics.on_drop(msg)
+        return freed
+
+    def get_assignments(self):
+        with self.lock:
+            return {k: sorted(v) for k, v in self.members.items()}
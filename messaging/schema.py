@@ -0,0 +1,81 @@
+from jsonschema import Draft4Validator, ValidationError
+from jsonschema.exceptions import best_match
+from jsonschema.validators import extend
+
+
+DRAFT4_ANY_OF = Draft4Validator.VALIDATORS["anyOf"]
+
+
+def get_discriminator_index(schema):
+    # Maps each value of the discriminator property to the "anyOf" subschema
+    # that accepts it, or returns None if some subschema doesn't pin the
+    # property to a single value with "enum".
+    prop = schema["discriminator"].get("propertyName")
+    index = {}
+    for subschema in schema["anyOf"]:
+        try:
+            values = subschema["properties"][prop]["enum"]
+        except (KeyError, TypeError):
+            return None
+        if len(values) != 1 or not isinstance(values[0], str) or \
+                values[0] in index:
+            return None
+        index[values[0]] = subschema
+    return prop, index
+
+
+# Validates instances against a Draft 4 schema. An "anyOf" annotated with an
+# OpenAPI-style {"discriminator": {"propertyName": "..."}}, where each
+# alternative fixes the property with a one-value "enum", goes straight to the
+# matching alternative instead of trying each in turn. Other validators ignore
+# the annotation and still see a plain "anyOf".
+class SchemaValidator(object):
+    def __init__(self, schema):
+        self.discriminated = {}  # id(schema) -> (property, value -> subschema)
+        self.index_schema(schema)
+        validator_cls = extend(Draft4Validator, {"anyOf": self.any_of})
+        self.validator = validator_cls(schema)
+        self.schema = schema  # Keeps ids in self.discriminated valid.
+
+    def index_schema(self, schema):
+        if isinstance(schema, list):
+            for item in schema:
+                self.index_schema(item)
+            return
+        if not isinstance(schema, dict):
+            return
+
+        if isinstance(schema.get("discriminator"), dict) and \
+                isinstance(schema.get("anyOf"), list):
+            index = get_discriminator_index(schema)
+            if index is not None:
+                self.discriminated[id(schema)] = index
+
+        for value in schema.values():
+            self.index_schema(value)
+
+    def any_of(self, validator, any_of, instance, schema):
+        index = self.discriminated.get(id(schema))
+        if index is None or not validator.is_type(instance, "object") or \
+                index[0] not in instance:
+            yield from DRAFT4_ANY_OF(validator, any_of, instance, schema)
+            return
+
+        prop, subschemas = index
+        value = instance[prop]
+        subschema = subschemas.get(value) if isinstance(value, str) else None
+        if subschema is None:
+            yield ValidationError(
+                "{!r} is not a valid {!r}, expected one of {!r}".format(
+                    value, prop, sorted(subschemas)))
+            return
+        yield from validator.descend(instance, subschema)
+
+    def get_error(self, instance):
+        # The most relevant ValidationError, or None if instance is valid.
+        return best_match(self.validator.iter_errors(instance))
+
+    def validate(self, instance):
+        error = self.get_error(instance)
+        if error is not None:
+            raise error
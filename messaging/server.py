@@ -1,38 +1,95 @@
 import logging
 try:
-    from queue import Queue
+    from queue import Queue, Empty
 except ImportError:
-    from Queue import Queue
+    from Queue import Queue, Empty
 import socket
+import time
+from itertools import count
 from socketserver import ThreadingTCPServer, StreamRequestHandler
 from threading import RLock, Lock, Thread
 
-from weavelib.exceptions import WeaveException, ObjectNotFound
+from weavelib.exceptions import WeaveException, ObjectNotFound, ObjectClosed
 from weavelib.exceptions import AuthenticationFailed
 from weavelib.exceptions import ProtocolError, BadOperation
 from weavelib.messaging import read_message, serialize_message, Message
 from weavelib.messaging import exception_to_message
 
 from .messaging_utils import get_required_field
+from .metrics import StageTimings, payload_size
+from .queues import ChannelEvicted
+from .tracing import TraceLog
 
 
 logger = logging.getLogger(__name__)
 
 
+class OutboundQueue(Queue):
+    # A connection's responses waiting to be written. Their payload bytes
+    # count against the server's memory budget until they are taken off.
+    def __init__(self, memory_budget):
+        super().__init__()
+        self.memory_budget = memory_budget
+        self.bytes = 0
+        self.discarded = False
+
+    def put(self, item, block=True, timeout=None):
+        # The queue is unbounded, so this never blocks. Once discarded, puts
+        # are dropped: nobody would write them or release their bytes.
+        with self.not_full:
+            if self.discarded:
+                return
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    # _put() and _get() are called by Queue with its mutex held.
+    def _put(self, item):
+        size = 0 if item is None else payload_size(item.task)
+        self.bytes += size
+        self.memory_budget.reserve(size)
+        self.queue.append((item, size))
+
+    def _get(self):
+        item, size = self.queue.popleft()
+        self.bytes -= size
+        self.memory_budget.release(size)
+        return item
+
+    def discard(self):
+        # Drops whatever is left once the writer is gone, and any later puts.
+        with self.mutex:
+            self.discarded = True
+        while True:
+            try:
+                self.get_nowait()
+            except Empty:
+                return
+            self.task_done()
+
+
 class MessageHandler(StreamRequestHandler):
     def handle(self):
-        response_queue = Queue()
+        response_queue = OutboundQueue(self.server.memory_budget)
         thread = Thread(target=self.process_queue, args=(response_queue,))
         thread.start()
 
-        conn = Connection(self.request, self.rfile, self.wfile)
+        conn = Connection(self.request, self.rfile, self.wfile, response_queue)
         self.server.add_connection(conn)
 
         try:
             while True:
                 session_id = "NO-SESSION-ID"
                 try:
+                    clock = self.server.stage_timings.start()
+                    if clock is not None:
+                        # Time parsing the message, not waiting for it.
+                        self.rfile.peek(1)
+                        clock.restart()
                     msg = read_message(self.rfile)
+                    if clock is not None:
+                        clock.lap("read")
+                        msg.stage_clock = clock
                     session_id = get_required_field(msg.headers, "SESS")
                     self.server.handle_message(conn, msg, response_queue)
                 except WeaveException as e:
@@ -45,7 +102,10 @@ class MessageHandler(StreamRequestHandler):
         finally:
             response_queue.put(None)
             thread.join()
+            # Drop the waiters first so nothing is delivered to the queue
+            # once it is discarded.
             conn.close()
+            response_queue.discard()
             self.server.remove_connection(conn)
 
     def process_queue(self, response_queue):
@@ -54,8 +114,18 @@ class MessageHandler(StreamRequestHandler):
             if msg is None:
                 break
 
+            clock = getattr(msg, "stage_clock", None)
+            if clock is not None:
+                clock.lap("writer_queue")
             try:
                 self.reply(serialize_message(msg))
+                if clock is not None:
+                    clock.lap("write")
+                trace_id = msg.headers.get("TRACE")
+                if trace_id is not None:
+                    self.server.trace_log.record(
+                        trace_id, "write", operation=msg.operation,
+                        session=msg.headers.get("SESS"))
             except IOError:
                 break
             finally:
@@ -66,21 +136,126 @@ class MessageHandler(StreamRequestHandler):
         self.wfile.flush()
 
 
+def get_peer_name(sock):
+    try:
+        return "{}:{}".format(*sock.getpeername()[:2])
+    except (AttributeError, OSError, TypeError):
+        return "in-process"
+
+
 class Connection(object):
-    def __init__(self, sock, rfile, wfile):
+    MAX_CACHED_CHANNELS = 1024
+    ids = count(1)
+
+    def __init__(self, sock, rfile, wfile, response_queue=None):
+        self.id = next(self.ids)
+        self.peer = get_peer_name(sock)
         self.sock = sock
         self.rfile = rfile
         self.wfile = wfile
+        self.response_queue = response_queue
         self.pop_waiters = {}
+        # Sessions whose last pop was answered -> the channel that answered
+        # it. The channel is told when the connection closes, so that it can
+        # forget them (see BaseDispatcher.on_remove).
+        self.served_sessions = {}
         self.pop_waiter_lock = Lock()
 
+        # Channel name (or synonym) -> channel object, valid as long as the
+        # registries' generations match channel_cache_generation. Sessions of
+        # an in-process connection use it from several threads, so a channel
+        # is only cached under the generation it was resolved in.
+        self.channel_cache = {}
+        self.channel_cache_generation = None
+        self.channel_cache_lock = Lock()
+
+    def get_cached_channel(self, channel_name, generation):
+        with self.channel_cache_lock:
+            if generation != self.channel_cache_generation:
+                self.channel_cache = {}
+                self.channel_cache_generation = generation
+                self.forget_dropped_channels()
+                return None
+            return self.channel_cache.get(channel_name)
+
+    def forget_dropped_channels(self):
+        # Called when the registries change. Channels evicted or removed
+        # since have forgotten their sessions already, and mustn't be kept
+        # alive by served_sessions until the connection closes.
+        with self.pop_waiter_lock:
+            self.served_sessions = {
+                session_id: channel
+                for session_id, channel in self.served_sessions.items()
+                if channel.active and not channel.evicted}
+
+    def cache_channel(self, channel_name, channel, generation):
+        with self.channel_cache_lock:
+            if generation != self.channel_cache_generation:
+                return  # Resolved before the registries changed.
+            if len(self.channel_cache) >= self.MAX_CACHED_CHANNELS:
+                self.channel_cache = {}
+            self.channel_cache[channel_name] = channel
+
     def add_waiter(self, session_id, channel):
         with self.pop_waiter_lock:
             self.pop_waiters[session_id] = channel
 
+    def add_call_waiter(self, session_id, channel):
+        # Unlike a pop, a call can't be re-issued by the same session while
+        # one is in progress: the second would replace the first's waiter,
+        # which then is never removed from its channel.
+        with self.pop_waiter_lock:
+            if session_id in self.pop_waiters:
+                return False
+            self.pop_waiters[session_id] = channel
+            return True
+
     def remove_waiter(self, session_id):
         with self.pop_waiter_lock:
-            self.pop_waiters.pop(session_id)
+            self.pop_waiters.pop(session_id, None)
+
+    def on_served(self, session_id, channel):
+        with self.pop_waiter_lock:
+            self.pop_waiters.pop(session_id, None)
+            self.served_sessions[session_id] = channel
+
+    def close_waiters(self, reason):
+        # Removes every session still waiting on a pop from its channel and
+        # sends it `reason` (a WeaveException) instead of a message.
+        with self.pop_waiter_lock:
+            waiters = self.pop_waiters
+            self.pop_waiters = {}
+
+        for session_id, channel in waiters.items():
+            channel.remove_requestor(session_id)
+            if self.response_queue is not None:
+                msg = exception_to_message(reason)
+                msg.headers["SESS"] = session_id
+                self.response_queue.put(msg)
+
+    def get_outbound_depth(self):
+        # Responses queued but not yet written.
+        if self.response_queue is None:
+            return 0
+        return self.response_queue.qsize()
+
+    def get_outbound_bytes(self):
+        return getattr(self.response_queue, "bytes", 0)
+
+    def drain(self, deadline):
+        # Waits until queued responses are written out, or until deadline
+        # (a time.monotonic() value). Returns whether everything was written.
+        response_queue = self.response_queue
+        if response_queue is None:
+            return True
+
+        with response_queue.all_tasks_done:
+            while response_queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                response_queue.all_tasks_done.wait(remaining)
+        return True
 
     def close(self):
         def safe_close(obj):
@@ -97,17 +272,31 @@ class Connection(object):
         safe_close(self.rfile)
         safe_close(self.wfile)
 
+        self.remove_all_waiters()
+
+    def remove_all_waiters(self):
         with self.pop_waiter_lock:
-            for session_id, channel in self.pop_waiters.items():
-                channel.remove_requestor(session_id)
+            sessions = list(self.served_sessions.items())
+            sessions.extend(self.pop_waiters.items())
+            self.served_sessions = {}
+            self.pop_waiters = {}
+
+        for session_id, channel in sessions:
+            channel.remove_requestor(session_id)
 
 
 class MessageServer(ThreadingTCPServer):
     allow_reuse_address = True
     daemon_threads = True
+    POLL_INTERVAL = 0.1  # Upper bound on how long shutdown() waits to stop
+                         # accepting connections.
+    DRAIN_TIMEOUT = 0.5
 
+    # stage_sample_interval: see StageTimings; trace_sample_interval: see
+    # TraceLog.
     def __init__(self, port, apps_registry, channel_registry, synonym_registry,
-                 notify_start):
+                 notify_start, stage_sample_interval=0,
+                 trace_sample_interval=0):
         super().__init__(("", port), MessageHandler)
         self.notify_start = notify_start
         self.sent_start_notification = False
@@ -116,38 +305,144 @@ class MessageServer(ThreadingTCPServer):
         self.synonym_registry = synonym_registry
         self.active_connections = set()
         self.active_connections_lock = RLock()
+        self.accepting = True
+        self.stage_timings = StageTimings(stage_sample_interval)
+        self.memory_budget = channel_registry.memory_budget
+        self.trace_log = TraceLog(trace_sample_interval)
 
     def handle_message(self, conn, msg, out_queue):
+        if not self.accepting:
+            raise ObjectClosed("Server shutting down.")
+
         session_id = get_required_field(msg.headers, "SESS")
         channel_name = get_required_field(msg.headers, "C")
-        channel_name = self.synonym_registry.translate(channel_name)
-        channel = self.channel_registry.get_channel(channel_name)
+        clock = getattr(msg, "stage_clock", None)
+        channel = self.resolve_channel(conn, channel_name)
+        if clock is not None:
+            clock.lap("resolve")
 
         self.preprocess(msg)
+        if clock is not None:
+            clock.lap("preprocess")
 
-        def handle_pop(task, headers):
-            conn.remove_waiter(session_id)
-            msg = Message("inform", task)
-            msg.headers.update(headers)
-            msg.headers["SESS"] = session_id
-            out_queue.put(msg)
-
+        while True:
+            try:
+                return self.handle_channel_message(conn, channel, msg,
+                                                   out_queue, session_id)
+            except ChannelEvicted:
+                # Reclaimed while idle between lookup and use; materialize it
+                # again.
+                generation = self.get_generation()
+                channel = self.channel_registry.materialize(
+                    channel.channel_info.channel_name)
+                conn.cache_channel(channel_name, channel, generation)
+
+    def get_generation(self):
+        return (self.synonym_registry.generation,
+                self.channel_registry.generation)
+
+    def resolve_channel(self, conn, channel_name):
+        generation = self.get_generation()
+        channel = conn.get_cached_channel(channel_name, generation)
+        if channel is None:
+            real_name = self.synonym_registry.translate(channel_name)
+            channel = self.channel_registry.get_channel(real_name)
+            conn.cache_channel(channel_name, channel, generation)
+        return channel
+
+    def handle_channel_message(self, conn, channel, msg, out_queue,
+                               session_id):
+        # make_out(out_channel) builds the function that delivers messages
+        # popped from out_channel to this session.
+        def make_out(out_channel):
+            channel_name = out_channel.channel_info.channel_name
+
+            def handle_pop(task, headers):
+                if not out_channel.session_membership:
+                    conn.on_served(session_id, out_channel)
+                trace_id = headers.get("TRACE")
+                if trace_id is not None:
+                    self.trace_log.record(trace_id, "dispatch",
+                                          channel=channel_name,
+                                          session=session_id)
+                msg = Message("inform", task)
+                msg.headers.update(headers)
+                msg.headers["SESS"] = session_id
+                out_queue.put(msg)
+            return handle_pop
+
+        channel_name = channel.channel_info.channel_name
         if msg.operation == "pop":
             conn.add_waiter(session_id, channel)
-            channel.pop(msg, handle_pop)
+            channel.pop(msg, make_out(channel))
         elif msg.operation == "push":
             if msg.task is None:
                 raise ProtocolError("Task is required for push.")
 
+            trace_id = self.start_trace(msg, channel_name, session_id)
             channel.push(msg)
 
+            clock = getattr(msg, "stage_clock", None)
             msg = Message("result")
             msg.headers["RES"] = "OK"
             msg.headers["SESS"] = session_id
+            if trace_id is not None:
+                msg.headers["TRACE"] = trace_id
+            if clock is not None:
+                msg.stage_clock = clock
             out_queue.put(msg)
+        elif msg.operation == "call":
+            self.handle_call(conn, channel, msg, session_id, make_out)
         else:
             raise BadOperation(msg.operation)
 
+    def start_trace(self, msg, channel_name, session_id):
+        trace_id = self.trace_log.start(msg)
+        if trace_id is not None:
+            self.trace_log.record(trace_id, "enqueue", channel=channel_name,
+                                  session=session_id)
+        return trace_id
+
+    def handle_call(self, conn, channel, msg, session_id, make_out):
+        # Pushes an RPC request and delivers the provider's reply (pushed to
+        # the response channel with the call's COOKIE) to this session, in
+        # place of a push, its result and a separate pop.
+        options = getattr(channel.channel_info, "options", {})
+        response_channel_name = options.get("response_channel")
+        if not response_channel_name:
+            raise BadOperation("call is only supported on RPC channels.")
+        if msg.task is None:
+            raise ProtocolError("Task is required for call.")
+
+        response_channel = self.channel_registry.get_channel(
+            response_channel_name)
+        trace_id = self.start_trace(msg, channel.channel_info.channel_name,
+                                    session_id)
+        handle_reply = make_out(response_channel)
+        if trace_id is not None:
+            # The reply belongs to the call's trace even if the provider
+            # doesn't pass the header on.
+            deliver_reply = handle_reply
+
+            def handle_reply(task, headers):
+                headers["TRACE"] = trace_id
+                deliver_reply(task, headers)
+
+        if not conn.add_call_waiter(session_id, response_channel):
+            raise ProtocolError("Session is already waiting on a reply.")
+        try:
+            response_channel.expect_reply(msg, handle_reply)
+        except Exception:
+            conn.remove_waiter(session_id)
+            raise
+
+        try:
+            channel.push(msg)
+        except Exception:
+            response_channel.cancel_reply(session_id)
+            conn.remove_waiter(session_id)
+            raise
+
     def preprocess(self, msg):
         if "AUTH" in msg.headers:
             app_token = msg.headers["AUTH"]
@@ -157,7 +452,7 @@ class MessageServer(ThreadingTCPServer):
                 raise AuthenticationFailed()
 
     def run(self):
-        self.serve_forever()
+        self.serve_forever(poll_interval=self.POLL_INTERVAL)
 
     def service_actions(self):
         if not self.sent_start_notification:
@@ -172,12 +467,38 @@ class MessageServer(ThreadingTCPServer):
         with self.active_connections_lock:
             self.active_connections.remove(conn)
 
-    def shutdown(self):
-        self.channel_registry.shutdown()
+    def get_connection_count(self):
+        return len(self.active_connections)
 
+    def get_connection_memory(self):
         with self.active_connections_lock:
-            for conn in self.active_connections:
-                conn.close()
-
+            connections = list(self.active_connections)
+        return [{"connection": x.id, "peer": x.peer,
+                 "outbound_bytes": x.get_outbound_bytes()}
+                for x in connections]
+
+    def shutdown(self, drain_timeout=None):
+        # Stops accepting connections and messages, tells sessions waiting on
+        # a pop that the server is going away, and gives responses already
+        # queued up to drain_timeout seconds to be written before closing
+        # every connection.
+        if drain_timeout is None:
+            drain_timeout = self.DRAIN_TIMEOUT
+        deadline = time.monotonic() + drain_timeout
+
+        self.accepting = False
         super().shutdown()
         super().server_close()
+        self.channel_registry.shutdown()
+
+        with self.active_connections_lock:
+            connections = list(self.active_connections)
+
+        reason = ObjectClosed("Server shutting down.")
+        for conn in connections:
+            conn.close_waiters(reason)
+        for conn in connections:
+            if not conn.drain(deadline):
+                logger.warning("Dropped undelivered responses on shutdown.")
+        for conn in connections:
+            conn.close()
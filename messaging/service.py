@@ -1,16 +1,20 @@
 from threading import Thread, Event
 from uuid import uuid4
 
-from weavelib.messaging import WeaveConnection
 from weavelib.services import BackgroundProcessServiceStart, BaseService
 from weavelib.services import MessagingEnabled
+from weavelib.messaging import WeaveConnection
 
 from messaging.server import MessageServer
+from messaging.inprocess import InProcessConnection
+from messaging.memory import MemoryBudget
 from messaging.discovery import DiscoveryServer
+from messaging.prometheus import MetricsExporter, MetricsServer
 from messaging.application_registry import ApplicationRegistry
 from messaging.queue_manager import ChannelRegistry
-from messaging.appmgr import MessagingRPCHub
+from messaging.appmgr import MessagingRPCHub, SYSTEM_REGISTRY_BASE_QUEUE
 from messaging.synonyms import SynonymRegistry
+from messaging.snapshot import SnapshotManager
 
 
 PORT = 11023
@@ -27,13 +31,38 @@ class DummyMessagingService(MessagingEnabled):
 
 class CoreService(BackgroundProcessServiceStart, BaseService):
     def __init__(self, **kwargs):
+        # Optional warm start: registries are saved to snapshot_path on stop
+        # (and every snapshot_interval seconds, if set), and restored from it
+        # on start.
+        snapshot_path = kwargs.pop('snapshot_path', None)
+        self.snapshot_interval = kwargs.pop('snapshot_interval', None)
+        snapshot_messages = kwargs.pop('snapshot_messages', False)
+        # Channels unused for this many seconds are reclaimed until next use.
+        channel_idle_timeout = kwargs.pop('channel_idle_timeout', None)
+        # Other ways to reach this server (e.g. {"type": "unix", "path": ...}),
+        # advertised by discovery.
+        discovery_endpoints = kwargs.pop('discovery_endpoints', None)
+        # Upper bound (1-100) of the weight advertised by discovery, for an
+        # instance that should get a smaller share of new clients.
+        discovery_max_weight = kwargs.pop('discovery_max_weight', None)
+        # Seconds given to queued responses to reach clients on stop.
+        self.shutdown_drain_timeout = kwargs.pop('shutdown_drain_timeout',
+                                                 None)
+        # Time the stages of every n-th message; see StageTimings.
+        stage_sample_interval = kwargs.pop('stage_sample_interval', 0)
+        # Trace every n-th message; see TraceLog.
+        trace_sample_interval = kwargs.pop('trace_sample_interval', 0)
+        # Serve Prometheus metrics on localhost:metrics_port, if set.
+        metrics_port = kwargs.pop('metrics_port', None)
+        # Bytes of message payloads the server may hold, and what to do once
+        # they're used up ("reject" or "shed"); see MemoryBudget.
+        memory_budget = MemoryBudget(kwargs.pop('memory_budget', None),
+                                     kwargs.pop('memory_policy', "reject"))
         super(CoreService, self).__init__(**kwargs)
 
         messaging_token = "app-token-" + str(uuid4())
         weave_env_token = kwargs.pop('auth_token')
 
-        self.dummy_service = DummyMessagingService(messaging_token,
-                                                   WeaveConnection.local())
         self.message_server_started = Event()
         self.shutdown_event = Event()
 
@@ -43,34 +72,117 @@ class CoreService(BackgroundProcessServiceStart, BaseService):
             ("MessagingServer", "https://github.com/HomeWeave/WeaveServer.git",
              messaging_token),
         ])
-        channel_registry = ChannelRegistry(app_registry)
+        channel_registry = ChannelRegistry(app_registry,
+                                           idle_timeout=channel_idle_timeout,
+                                           memory_budget=memory_budget)
         synonym_registry = SynonymRegistry()
 
         self.message_server = MessageServer(PORT, app_registry,
                                             channel_registry, synonym_registry,
-                                            self.message_server_started.set)
+                                            self.message_server_started.set,
+                                            stage_sample_interval,
+                                            trace_sample_interval)
         self.message_server_thread = Thread(target=self.message_server.run)
-        self.discovery_server = DiscoveryServer(PORT)
-        self.discovery_server_thread = Thread(target=self.discovery_server.run)
-        self.rpc_hub = MessagingRPCHub(self.dummy_service, channel_registry,
-                                       app_registry, synonym_registry)
+        # The RPC hub talks to the server directly rather than over a socket,
+        # if weavelib allows.
+        if InProcessConnection.is_supported():
+            hub_conn = InProcessConnection(self.message_server)
+        else:
+            hub_conn = WeaveConnection.local()
+        self.dummy_service = DummyMessagingService(messaging_token, hub_conn)
+        self.discovery_server = DiscoveryServer(
+            PORT, status_provider=self.get_load_status,
+            endpoints=discovery_endpoints, max_weight=discovery_max_weight)
+        self.discovery_server_started = Event()
+        self.discovery_server_thread = Thread(target=self.run_discovery_server)
+        self.rpc_hub = MessagingRPCHub(
+            self.dummy_service, channel_registry, app_registry,
+            synonym_registry, self.message_server.stage_timings,
+            self.message_server.trace_log,
+            self.message_server.get_connection_memory)
+
+        self.metrics_server = None
+        self.metrics_server_thread = None
+        if metrics_port:
+            self.metrics_server = MetricsServer(
+                metrics_port, MetricsExporter(self.message_server,
+                                              self.rpc_hub))
+            self.metrics_server_thread = Thread(target=self.metrics_server.run)
+
+        self.channel_reclaim_thread = None
+        if channel_idle_timeout:
+            self.channel_reclaim_thread = Thread(
+                target=self.reclaim_idle_channels,
+                args=(channel_registry, channel_idle_timeout))
+
+        self.snapshot_manager = None
+        self.snapshot_thread = None
+        if snapshot_path:
+            self.snapshot_manager = SnapshotManager(
+                snapshot_path, app_registry, channel_registry,
+                synonym_registry, self.rpc_hub,
+                include_messages=snapshot_messages,
+                exclude_prefixes=[SYSTEM_REGISTRY_BASE_QUEUE])
+            self.snapshot_manager.load()
+            if self.snapshot_interval:
+                self.snapshot_thread = Thread(
+                    target=self.snapshot_manager.run_periodically,
+                    args=(self.snapshot_interval, self.shutdown_event))
 
     def before_service_start(self):
         """Need to override to prevent rpc_client connecting."""
 
     def on_service_start(self, *args, **kwargs):
+        # Components come up concurrently: the message server and discovery
+        # bind on their own threads while this one starts the RPC hub (which
+        # reaches the server in-process, or waits in the listening socket's
+        # backlog). notify_start() waits for all three.
         self.message_server_thread.start()
-        self.message_server_started.wait()
         self.discovery_server_thread.start()
+        if self.snapshot_thread:
+            self.snapshot_thread.start()
+        if self.channel_reclaim_thread:
+            self.channel_reclaim_thread.start()
+        if self.metrics_server_thread:
+            self.metrics_server_thread.start()
         self.dummy_service.start()
         self.rpc_hub.start()
+        self.discovery_server_started.wait()
+        self.message_server_started.wait()
         self.notify_start()
         self.shutdown_event.wait()
 
     def on_service_stop(self):
-        self.dummy_service.get_connection().close()
+        self.shutdown_event.set()
         self.discovery_server.stop()
         self.discovery_server_thread.join()
-        self.message_server.shutdown()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server_thread.join()
+        self.message_server.shutdown(drain_timeout=self.shutdown_drain_timeout)
         self.message_server_thread.join()
-        self.shutdown_event.set()
+        self.dummy_service.get_connection().close()
+        if self.snapshot_thread:
+            self.snapshot_thread.join()
+        if self.channel_reclaim_thread:
+            self.channel_reclaim_thread.join()
+        if self.snapshot_manager:
+            self.snapshot_manager.save()
+
+    def run_discovery_server(self):
+        try:
+            self.discovery_server.run(self.discovery_server_started.set)
+        finally:
+            # Don't hold up startup if it fails to bind.
+            self.discovery_server_started.set()
+
+    def get_load_status(self):
+        channel_registry = self.message_server.channel_registry
+        return {
+            "connections": self.message_server.get_connection_count(),
+            "queue_depth": channel_registry.get_total_depth(),
+        }
+
+    def reclaim_idle_channels(self, channel_registry, idle_timeout):
+        while not self.shutdown_event.wait(idle_timeout / 2):
+            channel_registry.reclaim_idle_channels()
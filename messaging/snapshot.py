@@ -0,0 +1,88 @@
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotManager(object):
+    VERSION = 1
+
+    def __init__(self, path, app_registry, channel_registry, synonym_registry,
+                 rpc_hub, include_messages=False, exclude_prefixes=()):
+        self.path = path
+        self.app_registry = app_registry
+        self.channel_registry = channel_registry
+        self.synonym_registry = synonym_registry
+        self.rpc_hub = rpc_hub
+        self.include_messages = include_messages
+        self.exclude_prefixes = exclude_prefixes
+        self.save_lock = Lock()
+
+    def take(self):
+        return {
+            "version": self.VERSION,
+            "time": time.time(),
+            "apps": self.app_registry.to_json(),
+            "channels": self.channel_registry.to_json(
+                include_messages=self.include_messages,
+                exclude_prefixes=self.exclude_prefixes),
+            "synonyms": self.synonym_registry.to_json(),
+            "rpcs": self.rpc_hub.to_json(),
+        }
+
+    def restore(self, snapshot):
+        if snapshot.get("version") != self.VERSION:
+            logger.warning("Ignoring snapshot with version: %s",
+                           snapshot.get("version"))
+            return False
+
+        # Apps first: channels are looked up by their owner's URL.
+        self.app_registry.restore(snapshot["apps"])
+        self.channel_registry.restore(snapshot["channels"])
+        self.synonym_registry.restore(snapshot["synonyms"])
+        self.rpc_hub.restore(snapshot["rpcs"])
+        return True
+
+    def save(self):
+        start = time.time()
+        snapshot = self.take()
+
+        # Write to a temporary file and rename so that a crash mid-write never
+        # leaves a truncated snapshot behind. The snapshot has app tokens, so
+        # it is only readable by the owner.
+        tmp_path = self.path + ".tmp"
+        with self.save_lock:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as out:
+                json.dump(snapshot, out, separators=(",", ":"))
+            os.replace(tmp_path, self.path)
+
+        logger.info("Saved snapshot to %s in %.3fs", self.path,
+                    time.time() - start)
+
+    def load(self):
+        start = time.time()
+        try:
+            with open(self.path) as inp:
+                snapshot = json.load(inp)
+        except FileNotFoundError:
+            return False
+        except (IOError, ValueError):
+            logger.exception("Unable to read snapshot: %s", self.path)
+            return False
+
+        res = self.restore(snapshot)
+        logger.info("Restored snapshot from %s in %.3fs", self.path,
+                    time.time() - start)
+        return res
+
+    def run_periodically(self, interval, stop_event):
+        while not stop_event.wait(interval):
+            try:
+                self.save()
+            except (IOError, OSError):
+                logger.exception("Unable to save snapshot.")
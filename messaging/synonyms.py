@@ -5,20 +5,54 @@ from weavelib.exceptions import ObjectAlreadyExists
 
 
 class SynonymRegistry(object):
+    # generation is bumped whenever a mapping changes, so that callers caching
+    # translations (see MessageServer) can tell when to drop them without
+    # taking synonym_lock.
     def __init__(self):
         self.synonym_lock = RLock()
         self.synonyms = {}
+        self.generation = 0
 
     def register(self, synonym, target):
-        synonym = os.path.join("/synonyms", synonym.lstrip('/'))
+        return self.register_all([(synonym, target)])[0]
+
+    def register_all(self, pairs):
+        # Registers all (synonym, target) pairs, or none of them if any
+        # synonym is taken.
+        names = [os.path.join("/synonyms", synonym.lstrip('/'))
+                 for synonym, _ in pairs]
         with self.synonym_lock:
-            if synonym in self.synonyms:
-                raise ObjecObjectAlreadyExists(synonym)
+            added = {}
+            for synonym, (_, target) in zip(names, pairs):
+                existing = added.get(synonym, self.synonyms.get(synonym))
+                # Re-registering the same mapping (e.g. after a warm start) is
+                # harmless.
+                if existing is not None and existing != target:
+                    raise ObjectAlreadyExists(synonym)
+                added[synonym] = target
 
-            self.synonyms[synonym] = target
-            return synonym
+            self.synonyms.update(added)
+            self.generation += 1
+            return names
 
     def translate(self, synonym):
+        # Follows chains of synonyms to the channel they eventually name. A
+        # cycle resolves to the name where it was detected, which won't be a
+        # channel.
+        with self.synonym_lock:
+            seen = set()
+            while synonym in self.synonyms and synonym not in seen:
+                seen.add(synonym)
+                synonym = self.synonyms[synonym]
+            return synonym
+
+    def to_json(self):
+        with self.synonym_lock:
+            return {"synonyms": dict(self.synonyms)}
+
+    def restore(self, obj):
         with self.synonym_lock:
-            return self.synonyms.get(synonym, synonym)
+            for synonym, target in obj.get("synonyms", {}).items():
+                self.synonyms.setdefault(synonym, target)
+            self.generation += 1
 
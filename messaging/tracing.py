@@ -0,0 +1,87 @@
+import time
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from uuid import uuid4
+
+
+class TraceLog(object):
+    # Follows messages carrying a TRACE header. A push without one gets a new
+    # trace ID every sample_interval-th time (0 turns that off); a push with
+    # one is traced if the ID hashes into the sample, so every server sees the
+    # same decision for it. Events of the most recent MAX_TRACES traced IDs
+    # are kept in memory.
+    MAX_TRACES = 1000
+    MAX_EVENTS = 64  # Per trace.
+
+    def __init__(self, sample_interval=0):
+        self.sample_interval = sample_interval
+        self.counter = 0
+        self.traces = OrderedDict()  # trace ID -> [event]
+        self.lock = Lock()
+
+    def start(self, msg):
+        # Called on push. Returns the message's trace ID, if it has or gets
+        # one.
+        trace_id = msg.headers.get("TRACE")
+        if trace_id is None:
+            if not self.sample_interval:
+                return None
+            self.counter += 1
+            if self.counter % self.sample_interval:
+                return None
+            trace_id = msg.headers["TRACE"] = uuid4().hex
+            self.add(trace_id)
+            return trace_id
+
+        trace_id = str(trace_id)
+        if self.sample_interval and trace_id not in self.traces and \
+                zlib.crc32(trace_id.encode()) % self.sample_interval == 0:
+            self.add(trace_id)
+        return trace_id
+
+    def add(self, trace_id):
+        with self.lock:
+            if trace_id not in self.traces:
+                self.traces[trace_id] = []
+                if len(self.traces) > self.MAX_TRACES:
+                    self.traces.popitem(last=False)
+
+    def record(self, trace_id, event, **fields):
+        # Does nothing unless the trace was sampled.
+        fields.update(event=event, time=time.time())
+        with self.lock:
+            events = self.traces.get(trace_id)
+            if events is not None and len(events) < self.MAX_EVENTS:
+                events.append(fields)
+
+    def set_sample_interval(self, sample_interval):
+        self.sample_interval = max(0, int(sample_interval))
+
+    def get_trace(self, trace_id):
+        with self.lock:
+            events = self.traces.get(trace_id)
+            return None if events is None else list(events)
+
+    def query(self, channel_prefix="", min_duration=0, limit=100):
+        # Most recent traces first: those with an event on a channel under
+        # channel_prefix that took at least min_duration seconds from their
+        # first event to their last.
+        with self.lock:
+            traces = [(trace_id, list(events)) for trace_id, events in
+                      reversed(self.traces.items()) if events]
+
+        res = []
+        for trace_id, events in traces:
+            duration = events[-1]["time"] - events[0]["time"]
+            if duration < min_duration:
+                continue
+            if channel_prefix and not any(
+                    x.get("channel", "").startswith(channel_prefix)
+                    for x in events):
+                continue
+            res.append({"trace_id": trace_id, "duration": duration,
+                        "events": events})
+            if len(res) >= limit:
+                break
+        return res
@@ -35,7 +35,8 @@ setup(
     entry_points={
         'console_scripts': [
             'weave-launch = app:handle_launch',
-            'weave-main = app:handle_main'
+            'weave-main = app:handle_main',
+            'weave-loadgen = messaging.loadgen:main',
         ]
     },
     cmdclass={'install': CleanInstall}
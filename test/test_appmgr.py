@@ -1,13 +1,18 @@
-from threading import Thread, Event
+import socket
+from threading import Thread, Event, local
 
 import pytest
 
 from weavelib.exceptions import Unauthorized, AuthenticationFailed
-from weavelib.messaging import WeaveConnection, Sender, Receiver
+from weavelib.exceptions import ObjectNotFound, ObjectAlreadyExists
+from weavelib.messaging import WeaveConnection, Sender, Receiver, Message
+from weavelib.messaging import read_message, serialize_message
 from weavelib.rpc import find_rpc, RPCClient, RPCServer, ServerAPI, ArgParameter
 
+import messaging.appmgr
 from messaging.application_registry import ApplicationRegistry
-from messaging.appmgr import MessagingRPCHub
+from messaging.appmgr import MessagingRPCHub, SYSTEM_REGISTRY_BASE_QUEUE
+from messaging.appmgr import get_rpc_request_queue
 from messaging.queue_manager import ChannelRegistry
 from messaging.server import MessageServer
 from messaging.service import DummyMessagingService
@@ -193,3 +198,372 @@ class TestMessagingRPCHub(object):
 
         client.stop()
 
+    def test_call_reply_matched_by_cookie(self):
+        # Two sessions call the hub's RPC server at once through the "call"
+        # operation. Each reply is pushed with its call's COOKIE, which routes
+        # it to the session that made the call.
+        sock = socket.create_connection(("localhost", PORT))
+        rfile = sock.makefile('rb')
+        wfile = sock.makefile('wb')
+        request_queue = get_rpc_request_queue(SYSTEM_REGISTRY_BASE_QUEUE)
+        for session_id, limit in (("s1", 1), ("s2", 2)):
+            invocation = {"command": "list_channels", "id": session_id,
+                          "args": ["/", "", limit], "kwargs": {}}
+            msg = Message("call", {"invocation": invocation})
+            msg.headers.update(SESS=session_id, COOKIE="cookie-" + session_id,
+                               AUTH=TEST_APP_TOKEN, C=request_queue)
+            wfile.write((serialize_message(msg) + "\n").encode())
+        wfile.flush()
+
+        replies = {}
+        for _ in range(2):
+            msg = read_message(rfile)
+            replies[msg.headers["SESS"]] = msg.task["result"]
+        sock.close()
+
+        assert len(replies["s1"]["channels"]) == 1
+        assert len(replies["s2"]["channels"]) == 2
+
+
+class TestMessagingRPCHubConcurrency(object):
+    def setup_method(self):
+        self.app_registry = ApplicationRegistry([
+            ("MessagingServer", MESSAGING_SERVER_URL, MESSAGING_APP_TOKEN),
+        ])
+        self.channel_registry = ChannelRegistry(self.app_registry)
+        service = DummyMessagingService(MESSAGING_APP_TOKEN,
+                                        WeaveConnection.local())
+        self.rpc_hub = MessagingRPCHub(service, self.channel_registry,
+                                       self.app_registry, SynonymRegistry())
+
+    def call_as(self, monkeypatch, app_urls, func):
+        # Runs func(app_url) for every app in its own thread, as that app.
+        caller = local()
+        monkeypatch.setattr(messaging.appmgr, "get_rpc_caller",
+                            lambda: {"app_url": caller.app_url,
+                                     "app_type": "plugin"})
+        errors = []
+
+        def run(app_url):
+            caller.app_url = app_url
+            try:
+                func(app_url)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=run, args=(x,)) for x in app_urls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_register_rpc(self, monkeypatch):
+        urls = ["url" + str(i) for i in range(20)]
+        for url in urls:
+            self.app_registry.register_plugin(url, url)
+
+        api = ServerAPI("api", "desc", [ArgParameter("x", "x", str)],
+                        lambda x: x)
+        apis = {"api": api.info}
+
+        def register(app_url):
+            for i in range(5):
+                self.rpc_hub.register_rpc("rpc" + str(i), "desc", apis, [])
+
+        assert self.call_as(monkeypatch, urls, register) == []
+        assert len(self.rpc_hub.rpc_registry) == 100
+        assert self.channel_registry.count_channels("/plugins") == 200
+        for url in urls:
+            assert self.rpc_hub.rpc_info(url, "rpc4")["app_url"] == url
+
+        def unregister(app_url):
+            for i in range(5):
+                self.rpc_hub.unregister_rpc("rpc" + str(i))
+
+        assert self.call_as(monkeypatch, urls, unregister) == []
+        assert self.rpc_hub.rpc_registry == {}
+        assert self.channel_registry.count_channels("/plugins") == 0
+        assert self.rpc_hub.app_queues == {}
+
+    def test_app_calls_run_in_order(self, monkeypatch):
+        for url in ("busy-url", "other-url"):
+            self.app_registry.register_plugin(url, url)
+        entered, release = Event(), Event()
+        created = []
+        create_app_queue = self.rpc_hub.create_app_queue
+
+        def slow_create_app_queue(owner_app, queue_name, *args, **kwargs):
+            if queue_name == "q0":
+                entered.set()
+                release.wait()
+            created.append(queue_name)
+            return create_app_queue(owner_app, queue_name, *args, **kwargs)
+
+        monkeypatch.setattr(self.rpc_hub, "create_app_queue",
+                            slow_create_app_queue)
+
+        caller = local()
+        monkeypatch.setattr(messaging.appmgr, "get_rpc_caller",
+                            lambda: {"app_url": caller.app_url,
+                                     "app_type": "plugin"})
+        errors = []
+
+        def run(app_url, name):
+            caller.app_url = app_url
+            try:
+                self.rpc_hub.register_queue(name, "fifo", {}, [], [])
+            except Exception as e:
+                errors.append(e)
+
+        # A burst of calls from one app queues up behind the first.
+        threads = []
+        for index in range(10):
+            thread = Thread(target=run, args=("busy-url", "q" + str(index)))
+            thread.start()
+            threads.append(thread)
+            if index == 0:
+                entered.wait()
+            while len(self.rpc_hub.app_queues["busy-url"]) <= index:
+                release.wait(0.01)
+
+        # Other apps and reads go on meanwhile.
+        run("other-url", "q")
+        assert self.rpc_hub.list_channels("/channels", "", 10)["channels"] \
+            == ["/channels/other-url/q"]
+
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert created == ["q", "q0"] + ["q" + str(i) for i in range(1, 10)]
+        assert self.rpc_hub.app_queues == {}
+
+    def make_bundle(self, synonym_target):
+        api = ServerAPI("api", "desc", [ArgParameter("x", "x", str)],
+                        lambda x: x)
+        return {
+            "queues": [
+                {"channel_name": "q1", "queue_type": "fifo"},
+                {"channel_name": "q2", "queue_type": {"type": "multicast"},
+                 "schema": {"type": "string"}, "push_whitelist": ["other"]},
+            ],
+            "rpcs": [{"name": "rpc", "apis": {"api": api.info}}],
+            "synonyms": [{"synonym": "/q1", "target": synonym_target}],
+        }
+
+    def test_register_bundle(self, monkeypatch):
+        self.app_registry.register_plugin("plugin", "plugin-url")
+        results = []
+
+        def register(app_url):
+            bundle = self.make_bundle("/channels/plugin-url/q1")
+            results.append(self.rpc_hub.register_bundle(**bundle))
+
+        assert self.call_as(monkeypatch, ["plugin-url"], register) == []
+        assert results == [{
+            "queues": ["/channels/plugin-url/q1", "/channels/plugin-url/q2"],
+            "rpcs": {
+                "rpc": {
+                    "request_queue": "/plugins/plugin-url/rpcs/rpc/request",
+                    "response_queue": "/plugins/plugin-url/rpcs/rpc/response",
+                }
+            },
+            "synonyms": ["/synonyms/q1"],
+        }]
+        assert self.rpc_hub.rpc_info("plugin-url", "rpc")
+        assert self.rpc_hub.synonym_registry.translate("/synonyms/q1") == \
+            "/channels/plugin-url/q1"
+
+    def test_register_bundle_is_atomic(self, monkeypatch):
+        self.app_registry.register_plugin("plugin", "plugin-url")
+        self.app_registry.register_plugin("other", "other-url")
+        self.channel_registry.create_queue(
+            "/channels/other-url/q", self.app_registry.get_app_by_url(
+                "other-url"), {}, {}, "fifo")
+
+        def register(app_url):
+            # Synonyms can only point to the app's own channels.
+            bundle = self.make_bundle("/channels/other-url/q")
+            self.rpc_hub.register_bundle(**bundle)
+
+        errors = self.call_as(monkeypatch, ["plugin-url"], register)
+        assert [type(x) for x in errors] == [Unauthorized]
+        assert self.channel_registry.list_channels("/") == \
+            ["/channels/other-url/q"]
+        assert ("plugin-url", "rpc") not in self.rpc_hub.rpc_registry
+
+        # Nothing was left behind, so the same bundle can be retried.
+        def register_again(app_url):
+            bundle = self.make_bundle("/channels/plugin-url/q1")
+            self.rpc_hub.register_bundle(**bundle)
+            with pytest.raises(ObjectAlreadyExists):
+                self.rpc_hub.register_bundle(**bundle)
+
+        assert self.call_as(monkeypatch, ["plugin-url"], register_again) == []
+        assert self.channel_registry.count_channels("/channels/plugin-url") \
+            == 2
+
+    def test_failed_bundle_keeps_restored_channels(self, monkeypatch):
+        self.app_registry.register_plugin("plugin", "plugin-url")
+        self.app_registry.register_plugin("other", "other-url")
+        self.channel_registry.create_queue(
+            "/channels/other-url/q", self.app_registry.get_app_by_url(
+                "other-url"), {}, {}, "fifo")
+
+        def register(app_url):
+            bundle = self.make_bundle("/channels/plugin-url/q1")
+            del bundle["queues"][1]
+            self.rpc_hub.register_bundle(**bundle)
+
+        assert self.call_as(monkeypatch, ["plugin-url"], register) == []
+        channels = self.channel_registry.to_json()
+        rpcs = self.rpc_hub.to_json()
+
+        # A restarted server restores the bundle from its snapshot.
+        self.setup_method()
+        self.app_registry.register_plugin("plugin", "plugin-url")
+        self.app_registry.register_plugin("other", "other-url")
+        self.channel_registry.restore(channels)
+        self.rpc_hub.restore(rpcs)
+        restored = self.channel_registry.list_channels("/")
+
+        def register_bad(app_url):
+            bundle = self.make_bundle("/channels/other-url/q")
+            self.rpc_hub.register_bundle(**bundle)
+
+        errors = self.call_as(monkeypatch, ["plugin-url"], register_bad)
+        assert [type(x) for x in errors] == [Unauthorized]
+        assert self.channel_registry.list_channels("/") == restored
+        assert self.rpc_hub.rpc_info("plugin-url", "rpc")
+
+        # They are still up for adoption.
+        assert self.call_as(monkeypatch, ["plugin-url"], register) == []
+        assert self.channel_registry.list_channels("/") == restored
+
+    def test_failed_register_rpc_keeps_restored_rpc(self, monkeypatch):
+        self.app_registry.register_plugin("plugin", "plugin-url")
+        api = ServerAPI("api", "desc", [ArgParameter("x", "x", str)],
+                        lambda x: x)
+
+        def register(app_url):
+            self.rpc_hub.register_rpc("rpc", "desc", {"api": api.info}, [])
+
+        assert self.call_as(monkeypatch, ["plugin-url"], register) == []
+        channels = self.channel_registry.to_json()
+        rpcs = self.rpc_hub.to_json()
+
+        # A restarted server restores the RPC from its snapshot.
+        self.setup_method()
+        self.app_registry.register_plugin("plugin", "plugin-url")
+        self.channel_registry.restore(channels)
+        self.rpc_hub.restore(rpcs)
+
+        def fail(*args):
+            raise ObjectNotFound("Failed.")
+
+        with monkeypatch.context() as patched:
+            patched.setattr(messaging.appmgr, "create_rpc_queues", fail)
+            errors = self.call_as(patched, ["plugin-url"], register)
+        assert [type(x) for x in errors] == [ObjectNotFound]
+
+        # Still up for adoption.
+        assert self.call_as(monkeypatch, ["plugin-url"], register) == []
+        assert self.rpc_hub.rpc_info("plugin-url", "rpc")
+
+    def test_set_stage_sampling(self, monkeypatch):
+        self.app_registry.register_plugin("plugin", "plugin-url")
+
+        def set_sampling(app_url):
+            self.rpc_hub.set_stage_sampling(10)
+
+        errors = self.call_as(monkeypatch, ["plugin-url"], set_sampling)
+        assert [type(x) for x in errors] == [Unauthorized]
+        assert self.rpc_hub.get_stage_timings()["sample_interval"] == 0
+
+        monkeypatch.setattr(messaging.appmgr, "get_rpc_caller",
+                            lambda: {"app_url": MESSAGING_SERVER_URL,
+                                     "app_type": "system"})
+        assert self.rpc_hub.set_stage_sampling(10)
+        assert self.rpc_hub.get_stage_timings() == {
+            "sample_interval": 10, "samples": 0, "stages_us": {}
+        }
+
+    def test_acl_rules_of_nested_app_urls(self, monkeypatch):
+        outer, inner = "https://github.com/x", "https://github.com/x/y.git"
+        self.app_registry.register_plugin("outer", outer)
+        self.app_registry.register_plugin("inner", inner)
+        monkeypatch.setattr(messaging.appmgr, "get_rpc_caller",
+                            lambda: {"app_url": outer, "app_type": "plugin"})
+
+        for pattern in ["/channels/{}/*".format(inner),
+                        "/channels/{}/queue".format(inner),
+                        "/channels/{}/*".format(outer),
+                        "/channels/https://github.com/xy/queue",
+                        "/channels/{}".format(outer)]:
+            with pytest.raises(Unauthorized):
+                self.rpc_hub.add_acl_rule(pattern, "other", ["push"])
+
+        assert self.rpc_hub.add_acl_rule("/channels/{}/queue".format(outer),
+                                         "other", ["push"])
+        assert self.rpc_hub.add_acl_rule("/channels/{}/x/*".format(outer),
+                                         "other", ["push"])
+
+    def test_channel_stats_of_own_channels(self, monkeypatch):
+        outer, inner = "https://github.com/x", "https://github.com/x/y.git"
+        self.app_registry.register_plugin("outer", outer)
+        self.app_registry.register_plugin("inner", inner)
+        outer_app = self.app_registry.get_app_by_url(outer)
+        inner_app = self.app_registry.get_app_by_url(inner)
+        own = "/channels/{}/queue".format(outer)
+        nested = "/channels/{}/queue".format(inner)
+        self.channel_registry.create_queue(own, outer_app, {}, {}, "fifo")
+        self.channel_registry.create_queue(nested, inner_app, {}, {}, "fifo")
+        monkeypatch.setattr(messaging.appmgr, "get_rpc_caller",
+                            lambda: {"app_url": outer, "app_type": "plugin"})
+
+        for prefix in ["/", "/channels", "/channels/https://github.com/xy"]:
+            with pytest.raises(Unauthorized):
+                self.rpc_hub.channel_stats(prefix)
+        assert list(self.rpc_hub.channel_stats(
+            "/channels/{}".format(outer))) == [own]
+
+        monkeypatch.setattr(messaging.appmgr, "get_rpc_caller",
+                            lambda: {"app_url": MESSAGING_SERVER_URL,
+                                     "app_type": "system"})
+        assert sorted(self.rpc_hub.channel_stats("/channels")) == \
+            sorted([own, nested])
+
+    def test_unregister_keeps_nested_app_channels(self, monkeypatch):
+        outer, inner = "https://github.com/x", "https://github.com/x/y.git"
+        for url in (outer, inner):
+            self.app_registry.register_plugin(url, url)
+            app = self.app_registry.get_app_by_url(url)
+            self.channel_registry.create_queue("/channels/{}/q".format(url),
+                                               app, {}, {}, "fifo")
+
+        monkeypatch.setattr(messaging.appmgr, "get_rpc_caller",
+                            lambda: {"app_url": MESSAGING_SERVER_URL,
+                                     "app_type": "system"})
+        assert self.rpc_hub.unregister_plugin(outer)
+        assert self.channel_registry.list_channels("/channels") == \
+            ["/channels/{}/q".format(inner)]
+
+    def test_memory_usage(self):
+        owner_app = self.app_registry.get_app_by_url(MESSAGING_SERVER_URL)
+        for name, size in (("/a", 10), ("/b", 30), ("/c", 20)):
+            channel = self.channel_registry.create_queue(name, owner_app, {},
+                                                         {}, "fifo")
+            msg = Message("enqueue", "x" * size)
+            msg.headers["SESS"] = "1"
+            channel.push(msg)
+
+        res = self.rpc_hub.get_memory_usage(2)
+        assert res["budget"]["used"] == 60
+        assert res["channels"] == [{"channel": "/b", "queued_bytes": 30},
+                                   {"channel": "/c", "queued_bytes": 20}]
+        assert res["connections"] == []
+
+    def test_rpc_info_not_found(self):
+        with pytest.raises(ObjectNotFound):
+            self.rpc_hub.rpc_info("url", "missing")
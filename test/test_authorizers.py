@@ -0,0 +1,172 @@
+import pytest
+
+from weavelib.exceptions import AuthenticationFailed, Unauthorized
+
+from messaging.application_registry import ApplicationRegistry, Plugin
+from messaging.authorizers import WhitelistAuthorizer, ChainedAuthorizer
+from messaging.authorizers import AllowAllAuthorizer, PrefixACLAuthorizer
+from messaging.queue_manager import ChannelRegistry
+
+
+def auth_headers(app_url):
+    return {"AUTH": {"app_url": app_url}}
+
+
+class TestAuthorizers(object):
+    def test_whitelist_with_string_is_not_substring_match(self):
+        authorizer = WhitelistAuthorizer("https://github.com/a/b.git")
+        assert authorizer.authorize("https://github.com/a/b.git", "push", "/")
+        assert not authorizer.authorize("b", "push", "/")
+
+    def test_chained_authorizer(self):
+        authorizer = ChainedAuthorizer([WhitelistAuthorizer(["a"]),
+                                        WhitelistAuthorizer(["b"])])
+        assert authorizer.authorize("a", "push", "/")
+        assert authorizer.authorize("b", "push", "/")
+        assert not authorizer.authorize("c", "push", "/")
+
+        authorizer = ChainedAuthorizer([WhitelistAuthorizer(["a"]),
+                                        AllowAllAuthorizer()])
+        assert authorizer.authorize("c", "push", "/")
+
+
+class TestPrefixACLAuthorizer(object):
+    def test_prefix_rule(self):
+        acl = PrefixACLAuthorizer()
+        acl.add_rule("/channels/a/*", "app1", ["push"])
+
+        assert acl.authorize("app1", "push", "/channels/a/b")
+        assert acl.authorize("app1", "push", "/channels/a/b/c")
+        assert not acl.authorize("app1", "push", "/channels/a")
+        assert not acl.authorize("app1", "pop", "/channels/a/b")
+        assert not acl.authorize("app2", "push", "/channels/a/b")
+        assert not acl.authorize("app1", "push", "/channels/ab/c")
+        assert not acl.authorize(None, "push", "/channels/a/b")
+
+    def test_exact_rule(self):
+        acl = PrefixACLAuthorizer()
+        acl.add_rule("/channels/a", "app1", ["push", "pop"])
+
+        assert acl.authorize("app1", "pop", "/channels/a")
+        assert not acl.authorize("app1", "pop", "/channels/a/b")
+
+    def test_app_url_placeholder(self):
+        acl = PrefixACLAuthorizer()
+        acl.add_rule("/channels/{app_url}/*", PrefixACLAuthorizer.ANY_APP,
+                     ["push"])
+        url = "https://github.com/x/y.git"
+
+        assert acl.authorize(url, "push", "/channels/" + url + "/queue")
+        assert not acl.authorize("https://github.com/x/z.git", "push",
+                                 "/channels/" + url + "/queue")
+
+    def test_remove_rule(self):
+        acl = PrefixACLAuthorizer()
+        acl.add_rule("/channels/a/*", "app1", ["push"])
+        assert acl.list_rules() == [{"pattern": "/channels/a/*",
+                                     "app_url": "app1",
+                                     "operations": ["push"]}]
+
+        assert acl.remove_rule("/channels/a/*", "app1")
+        assert not acl.remove_rule("/channels/a/*", "app1")
+        assert not acl.authorize("app1", "push", "/channels/a/b")
+        assert acl.list_rules() == []
+
+    def test_remove_rule_prunes_trie(self):
+        acl = PrefixACLAuthorizer()
+        acl.add_rule("/channels/a/b/*", "app1", ["push"])
+        acl.add_rule("/channels/{app_url}/c", "app1", ["push"])
+        acl.add_rule("/channels/a", "app2", ["pop"])
+
+        acl.remove_rule("/channels/a/b/*", "app1")
+        acl.remove_rule("/channels/{app_url}/c", "app1")
+        channels = acl.root.children["channels"]
+        assert channels.app_child is None
+        assert channels.children["a"].children == {}
+
+        acl.remove_rule("/channels/a", "app2")
+        assert acl.root.children == {}
+
+
+class TestChannelAuthCache(object):
+    def setup_method(self):
+        test_app = Plugin("test", "test", "test-token")
+        self.registry = ChannelRegistry(ApplicationRegistry())
+        self.queue = self.registry.create_queue(
+            "/queue", test_app, {}, {}, "fifo",
+            authorizers={"push": WhitelistAuthorizer(["a"])})
+
+    def test_decisions_are_cached(self):
+        self.queue.check_auth("push", auth_headers("a"))
+        with pytest.raises(Unauthorized):
+            self.queue.check_auth("push", auth_headers("b"))
+        with pytest.raises(AuthenticationFailed):
+            self.queue.check_auth("push", {})
+        self.queue.check_auth("pop", auth_headers("b"))
+
+        assert self.queue.auth_cache == {
+            ("a", "push"): True,
+            ("b", "push"): False,
+            (None, "push"): False,
+            ("b", "pop"): True,
+        }
+
+    def test_whitelist_update_invalidates_cache(self):
+        with pytest.raises(Unauthorized):
+            self.queue.check_auth("push", auth_headers("b"))
+
+        self.registry.update_channel_authorizers(
+            "/queue", {"push": WhitelistAuthorizer(["b"])})
+
+        self.queue.check_auth("push", auth_headers("b"))
+        with pytest.raises(Unauthorized):
+            self.queue.check_auth("push", auth_headers("a"))
+
+    def test_registry_invalidate(self):
+        self.queue.check_auth("push", auth_headers("a"))
+        self.registry.invalidate_auth_cache()
+        assert self.queue.auth_cache == {}
+
+    def test_invalidation_during_check(self):
+        queue = self.queue
+
+        class ChangingAuthorizer(object):
+            # The rules change while a decision is being made.
+            def authorize(self, app_url, op, channel_name):
+                queue.invalidate_auth_cache()
+                return True
+
+        self.registry.update_channel_authorizers(
+            "/queue", {"push": ChangingAuthorizer()})
+        queue.check_auth("push", auth_headers("b"))
+        assert queue.auth_cache == {}
+
+    def test_acl_rules_compose_with_whitelist(self):
+        with pytest.raises(Unauthorized):
+            self.queue.check_auth("push", auth_headers("b"))
+
+        self.registry.add_acl_rule("/*", "b", ["push"])
+        self.queue.check_auth("push", auth_headers("b"))
+        self.queue.check_auth("push", auth_headers("a"))
+
+        self.registry.remove_acl_rule("/*", "b")
+        with pytest.raises(Unauthorized):
+            self.queue.check_auth("push", auth_headers("b"))
+
+    def test_acl_is_chained_with_own_authorizers(self):
+        info = self.registry.get_channel_info("/queue")
+        authorizer = info.chained_authorizers["push"]
+        assert isinstance(authorizer, ChainedAuthorizer)
+        assert self.registry.acl in authorizer.authorizers
+        # Snapshots keep only the channel's own rules.
+        assert info.to_json()["authorizers"] == {
+            "push": {"type": "whitelist", "urls": ["a"]}
+        }
+
+        self.registry.add_acl_rule("/queue", "c", ["push"])
+        self.registry.update_channel_authorizers(
+            "/queue", {"push": WhitelistAuthorizer(["b"])})
+        self.queue.check_auth("push", auth_headers("b"))
+        self.queue.check_auth("push", auth_headers("c"))
+        with pytest.raises(Unauthorized):
+            self.queue.check_auth("push", auth_headers("a"))
@@ -5,7 +5,8 @@ from threading import Event, Thread
 import pytest
 import weavelib.netutils as netutils
 
-from messaging.discovery import DiscoveryServer
+from messaging.discovery import DiscoveryServer, InterfaceTable, RateLimiter
+from messaging.discovery import compute_weight
 
 
 class TestDiscoveryService(object):
@@ -35,19 +36,22 @@ class TestDiscoveryService(object):
     def test_no_machine_addresses(self):
         backup = netutils.iter_ipv4_addresses
         netutils.iter_ipv4_addresses = lambda: []
+        self.server.interfaces.refresh()
 
-        ip_addr, port = "<broadcast>", 23034
-        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        client.bind(('', 0))
-        client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        client.sendto("QUERY".encode('UTF-8'), (ip_addr, port))
-
-        client.settimeout(5)
-        data, _ = client.recvfrom(1024)
+        try:
+            ip_addr, port = "<broadcast>", 23034
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.bind(('', 0))
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            client.sendto("QUERY".encode('UTF-8'), (ip_addr, port))
 
-        assert data.decode() == "{}"
+            client.settimeout(5)
+            data, _ = client.recvfrom(1024)
 
-        netutils.iter_ipv4_addresses = backup
+            assert data.decode() == "{}"
+        finally:
+            netutils.iter_ipv4_addresses = backup
+            self.server.interfaces.refresh()
 
     def test_get_message_server_address(self):
         ip_addr, port = "<broadcast>", 23034
@@ -59,5 +63,142 @@ class TestDiscoveryService(object):
         client.settimeout(5)
         data, _ = client.recvfrom(1024)
 
-        obj = json.loads(data.decode())["host"]
-        assert obj in [x["addr"] for x in netutils.iter_ipv4_addresses()]
+        obj = json.loads(data.decode())
+        assert obj["host"] in [x["addr"]
+                               for x in netutils.iter_ipv4_addresses()]
+        assert obj["port"] == 11023
+        assert obj["id"] == self.server.instance_id
+        assert obj["endpoints"][0] == {"type": "tcp", "host": obj["host"],
+                                       "port": 11023}
+        assert 1 <= obj["weight"] <= DiscoveryServer.MAX_WEIGHT
+
+
+class TestLoadAwareReplies(object):
+    def setup_method(self):
+        self.servers = []
+
+    def teardown_method(self):
+        for server in self.servers:
+            server.close()
+
+    def make_server(self, monkeypatch, **kwargs):
+        monkeypatch.setattr(netutils, "relevant_ipv4_address",
+                            lambda addr: "10.0.0.5")
+        monkeypatch.setattr(netutils, "iter_ipv4_addresses", lambda: [])
+        server = DiscoveryServer(11023, **kwargs)
+        self.servers.append(server)
+        return server
+
+    def test_reply(self, monkeypatch):
+        calls = []
+
+        def status_provider():
+            calls.append(None)
+            return {"connections": 3, "queue_depth": 7, "cpu_load": 0.25}
+
+        server = self.make_server(monkeypatch,
+                                  status_provider=status_provider,
+                                  endpoints=[{"type": "unix",
+                                              "path": "/tmp/weave.sock"}],
+                                  instance_id="instance-1")
+        obj = json.loads(server.process(("10.0.0.9", 1234), "QUERY").decode())
+        assert obj == {
+            "host": "10.0.0.5",
+            "port": 11023,
+            "id": "instance-1",
+            "endpoints": [{"type": "tcp", "host": "10.0.0.5", "port": 11023},
+                          {"type": "unix", "path": "/tmp/weave.sock"}],
+            "load": {"connections": 3, "queue_depth": 7, "cpu_load": 0.25},
+            "weight": 75,
+        }
+
+        obj = json.loads(server.process(("10.0.0.9", 1234), "QUERY").decode())
+        assert obj["weight"] == 75
+        assert len(calls) == 1  # The status is cached.
+
+        server = self.make_server(monkeypatch,
+                                  status_provider=status_provider,
+                                  max_weight=10)
+        obj = json.loads(server.process(("10.0.0.9", 1234), "QUERY").decode())
+        assert obj["weight"] == 8
+
+    def test_reply_fits_client_buffer(self, monkeypatch):
+        endpoints = [{"type": "unix", "path": "/run/weave/{}.sock".format(i)}
+                     for i in range(10)]
+        server = self.make_server(monkeypatch, endpoints=endpoints)
+        obj = json.loads(server.process(("10.0.0.9", 1234), "QUERY").decode())
+        assert obj["endpoints"][1:] == endpoints
+
+        endpoints = [{"type": "unix", "path": "/run/weave/{}.sock".format(i)}
+                     for i in range(100)]
+        server = self.make_server(monkeypatch, endpoints=endpoints,
+                                  status_provider=lambda: {"connections": 3})
+        data = server.process(("10.0.0.9", 1234), "QUERY")
+        assert len(data) <= DiscoveryServer.MAX_REPLY_SIZE
+        obj = json.loads(data.decode())
+        assert obj["host"] == "10.0.0.5"
+        assert obj["load"]["connections"] == 3
+        assert obj["endpoints"][0]["type"] == "tcp"
+        assert 1 < len(obj["endpoints"]) < 101
+        assert obj["endpoints"][1:] == endpoints[:len(obj["endpoints"]) - 1]
+
+        # Load figures go too if they don't fit.
+        server = self.make_server(monkeypatch, status_provider=lambda: {
+            "big": "x" * DiscoveryServer.MAX_REPLY_SIZE})
+        data = server.process(("10.0.0.9", 1234), "QUERY")
+        assert len(data) <= DiscoveryServer.MAX_REPLY_SIZE
+        assert json.loads(data.decode())["load"] == {}
+
+    def test_compute_weight(self):
+        assert compute_weight({"cpu_load": None}, 100) == 100
+        assert compute_weight({"cpu_load": 0.5}, 100) == 50
+        assert compute_weight({"cpu_load": 4.0}, 100) == 1
+
+
+class TestInterfaceTable(object):
+    def test_lookup_uses_subnets(self, monkeypatch):
+        monkeypatch.setattr(netutils, "iter_ipv4_addresses", lambda: [
+            {"addr": "10.0.0.5", "netmask": "255.255.255.0"},
+            {"addr": "192.168.1.2", "netmask": "255.255.0.0"},
+        ])
+        calls = []
+        monkeypatch.setattr(netutils, "relevant_ipv4_address",
+                            lambda addr: calls.append(addr))
+
+        table = InterfaceTable()
+        assert table.refresh()
+        assert not table.refresh()
+
+        assert table.lookup("10.0.0.77") == "10.0.0.5"
+        assert table.lookup("192.168.7.7") == "192.168.1.2"
+        assert table.lookup("172.16.0.1") is None
+        assert table.lookup("172.16.0.1") is None
+        assert calls == ["172.16.0.1"]
+
+    def test_refresh_on_change(self, monkeypatch):
+        interfaces = [{"addr": "10.0.0.5", "netmask": "255.255.255.0"}]
+        monkeypatch.setattr(netutils, "iter_ipv4_addresses",
+                            lambda: list(interfaces))
+        monkeypatch.setattr(netutils, "relevant_ipv4_address",
+                            lambda addr: None)
+
+        table = InterfaceTable()
+        table.refresh()
+        assert table.lookup("10.0.0.1") == "10.0.0.5"
+
+        interfaces[0] = {"addr": "10.0.0.6", "netmask": "255.255.255.0"}
+        assert table.refresh()
+        assert table.lookup("10.0.0.1") == "10.0.0.6"
+
+
+class TestRateLimiter(object):
+    def test_rate_limit(self):
+        limiter = RateLimiter(rate=2, burst=3)
+        assert [limiter.allow("a", 0) for _ in range(4)] == \
+            [True, True, True, False]
+        assert limiter.allow("b", 0)
+
+        assert limiter.allow("a", 0.5)
+        assert not limiter.allow("a", 0.5)
+        assert [limiter.allow("a", 10) for _ in range(4)] == \
+            [True, True, True, False]
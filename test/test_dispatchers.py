@@ -0,0 +1,176 @@
+import pytest
+
+from weavelib.exceptions import BadArguments, ProtocolError
+from weavelib.messaging import Message
+
+from messaging.application_registry import ApplicationRegistry, Plugin
+from messaging.queue_manager import ChannelRegistry
+
+
+def make_queue(dispatch=None):
+    test_app = Plugin("test", "test", "test-token")
+    registry = ChannelRegistry(ApplicationRegistry())
+    options = {"dispatch": dispatch} if dispatch else None
+    return registry.create_queue("/queue", test_app, {}, {}, "fifo",
+                                 options=options)
+
+
+def push(queue, task):
+    msg = Message("enqueue", task)
+    msg.headers["SESS"] = "producer"
+    queue.push(msg)
+
+
+def pop(queue, session_id, out, **headers):
+    msg = Message("dequeue")
+    msg.headers["SESS"] = session_id
+    msg.headers.update(headers)
+    queue.pop(msg, out)
+
+
+class Consumer(object):
+    def __init__(self, queue, session_id, **headers):
+        self.queue = queue
+        self.session_id = session_id
+        self.headers = headers
+        self.received = []
+
+    def pop(self):
+        pop(self.queue, self.session_id, self.on_message, **self.headers)
+
+    def on_message(self, task, headers):
+        self.received.append(task)
+
+
+class TestDispatchers(object):
+    def test_bad_dispatch_policy(self):
+        with pytest.raises(BadArguments):
+            make_queue("bad-policy")
+
+    def test_round_robin_is_default(self):
+        queue = make_queue()
+        consumers = [Consumer(queue, "s" + str(i)) for i in range(3)]
+
+        for consumer in consumers:
+            consumer.pop()
+
+        for i in range(9):
+            push(queue, i)
+            # Everyone re-pops immediately; fast consumers must not starve
+            # others.
+            for consumer in consumers:
+                if consumer.session_id not in queue.requestors_by_session_id:
+                    consumer.pop()
+
+        assert [len(x.received) for x in consumers] == [3, 3, 3]
+        assert queue.get_delivery_counts() == {"s0": 3, "s1": 3, "s2": 3}
+
+    def test_weighted(self):
+        queue = make_queue("weighted")
+        big = Consumer(queue, "big", CAPACITY="3")
+        small = Consumer(queue, "small")
+
+        for _ in range(40):
+            big.pop()
+            small.pop()
+            push(queue, "x")
+
+        assert len(big.received) == 30
+        assert len(small.received) == 10
+
+    def test_weighted_late_joiner_does_not_catch_up(self):
+        queue = make_queue("weighted")
+        early = Consumer(queue, "early")
+        for _ in range(10):
+            early.pop()
+            push(queue, "x")
+
+        late = Consumer(queue, "late")
+        for _ in range(10):
+            early.pop()
+            late.pop()
+            push(queue, "y")
+
+        # The two take turns rather than "late" getting the next ten.
+        assert early.received.count("y") == 5
+        assert late.received == ["y"] * 5
+        assert queue.get_stats()["deliveries"] == {"early": 15, "late": 5}
+
+    def test_weighted_bad_capacity(self):
+        queue = make_queue("weighted")
+        with pytest.raises(ProtocolError):
+            Consumer(queue, "s1", CAPACITY="lots").pop()
+        with pytest.raises(ProtocolError):
+            Consumer(queue, "s1", CAPACITY="0").pop()
+
+    def test_least_outstanding(self):
+        queue = make_queue("least_outstanding")
+        # Two sessions of a busy worker, one of an idle worker.
+        busy1 = Consumer(queue, "b1", CONSUMER="busy")
+        busy2 = Consumer(queue, "b2", CONSUMER="busy")
+        idle = Consumer(queue, "i1", CONSUMER="idle")
+
+        busy1.pop()
+        push(queue, "1")
+        assert busy1.received == ["1"]
+
+        # busy1 has not come back yet, so "busy" has one message outstanding.
+        busy2.pop()
+        idle.pop()
+        push(queue, "2")
+        assert idle.received == ["2"]
+
+        # Once busy1 finishes, both workers are even; oldest waiter wins.
+        busy1.pop()
+        idle.pop()
+        push(queue, "3")
+        assert busy2.received == ["3"]
+
+        assert queue.get_delivery_counts() == {"busy": 2, "idle": 1}
+
+    def test_queued_messages_count_as_delivered(self):
+        queue = make_queue()
+        push(queue, "1")
+        push(queue, "2")
+
+        consumer = Consumer(queue, "s1")
+        consumer.pop()
+        consumer.pop()
+
+        assert consumer.received == ["1", "2"]
+        assert queue.get_delivery_counts() == {"s1": 2}
+
+    def test_remove_requestor(self):
+        queue = make_queue()
+        consumer1 = Consumer(queue, "s1")
+        consumer2 = Consumer(queue, "s2")
+        consumer1.pop()
+        consumer2.pop()
+
+        queue.remove_requestor("s1")
+        push(queue, "1")
+
+        assert consumer1.received == []
+        assert consumer2.received == ["1"]
+
+    def test_disconnect_mid_message(self):
+        queue = make_queue("least_outstanding")
+        gone = Consumer(queue, "g1", CONSUMER="gone")
+        busy = Consumer(queue, "b1", CONSUMER="busy")
+
+        gone.pop()
+        push(queue, "1")
+        busy.pop()
+        push(queue, "2")
+
+        # "gone" leaves without coming back for more; it no longer counts as
+        # having a message outstanding, and its counters are dropped.
+        queue.remove_requestor("g1")
+        assert queue.dispatcher.outstanding == {"busy": 1}
+        assert queue.get_delivery_counts() == {"busy": 1}
+
+        other = Consumer(queue, "o1", CONSUMER="other")
+        other.pop()
+        busy.pop()
+        push(queue, "3")
+        assert other.received == ["3"]
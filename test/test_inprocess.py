@@ -0,0 +1,153 @@
+from threading import Thread, Event
+
+import pytest
+from weavelib.exceptions import ObjectNotFound, SchemaValidationFailed
+from weavelib.messaging import Message, Sender, Receiver
+
+from messaging.application_registry import ApplicationRegistry, Plugin
+from messaging.inprocess import InProcessConnection
+from messaging.queue_manager import ChannelRegistry
+from messaging.server import MessageServer
+from messaging.synonyms import SynonymRegistry
+
+
+class TestInProcessConnection(object):
+    @classmethod
+    def setup_class(cls):
+        event = Event()
+        test_app = Plugin("test", "test", "test-token")
+        apps = ApplicationRegistry()
+        registry = ChannelRegistry(apps)
+        registry.create_queue("/fifo", test_app, {"type": "string"}, {},
+                              "fifo")
+        registry.create_queue("/multicast", test_app, {"type": "string"}, {},
+                              "multicast")
+
+        cls.server = MessageServer(11023, apps, registry, SynonymRegistry(),
+                                   event.set)
+        cls.server_thread = Thread(target=cls.server.run)
+        cls.server_thread.start()
+        event.wait()
+        cls.conn = InProcessConnection(cls.server)
+        cls.conn.connect()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.conn.close()
+        cls.server.shutdown()
+        cls.server_thread.join()
+
+    def test_push_pop(self):
+        msgs = []
+        sender = Sender(self.conn, "/fifo")
+        receiver = Receiver(self.conn, "/fifo")
+        sender.start()
+        receiver.start()
+        receiver.on_message = lambda msg, hdrs: msgs.append(msg) or \
+            receiver.stop()
+
+        sender.send("hello")
+        thread = Thread(target=receiver.run)
+        thread.start()
+        thread.join()
+
+        assert msgs == ["hello"]
+        assert self.server.channel_registry.get_stats("/fifo")["/fifo"][
+            "pops"] == 1
+
+    def test_errors(self):
+        sender = Sender(self.conn, "/fifo")
+        sender.start()
+        with pytest.raises(SchemaValidationFailed):
+            sender.send({"not": "a string"})
+
+        sender = Sender(self.conn, "/unknown")
+        sender.start()
+        with pytest.raises(ObjectNotFound):
+            sender.send("hello")
+
+    def test_close_removes_waiters(self):
+        conn = InProcessConnection(self.server)
+        conn.connect()
+        receiver = Receiver(conn, "/multicast")
+        receiver.start()
+        receiver.on_message = lambda msg, hdrs: None
+        Thread(target=receiver.run, daemon=True).start()
+
+        channel = self.server.channel_registry.get_channel("/multicast")
+        for _ in range(100):
+            if channel.get_requestors_size():
+                break
+            Event().wait(0.05)
+        assert channel.get_requestors_size() == 1
+
+        receiver.stop()
+        conn.close()
+        assert channel.get_requestors_size() == 0
+
+    def test_sessions_are_handled_in_parallel(self, monkeypatch):
+        conn = InProcessConnection(self.server)
+        entered, release = Event(), Event()
+        handled = []
+
+        def handle_message(server_conn, msg, out_queue):
+            if msg.headers["SESS"] == "slow":
+                entered.set()
+                release.wait()
+            handled.append(msg.headers["SESS"])
+
+        monkeypatch.setattr(self.server, "handle_message", handle_message)
+
+        def send(session_id):
+            msg = Message("push", "hello")
+            msg.headers["SESS"] = session_id
+            conn.send(msg)
+
+        thread = Thread(target=send, args=("slow",))
+        thread.start()
+        entered.wait()
+
+        # Another session isn't held up by the slow one.
+        send("fast")
+        assert handled == ["fast"]
+
+        release.set()
+        thread.join()
+        assert handled == ["fast", "slow"]
+        assert conn.session_locks == {}
+
+    def test_channel_removed_while_sessions_send(self):
+        registry = self.server.channel_registry
+        test_app = Plugin("test", "test", "test-token")
+        registry.create_queue("/removed", test_app, {}, {}, "fifo")
+        conn = InProcessConnection(self.server)
+        conn.connect()
+        stop = Event()
+
+        def send(session_id):
+            msg = Message("push", "hello")
+            msg.headers.update({"SESS": session_id, "C": "/removed"})
+            conn.send(msg)
+
+        def keep_sending(session_id):
+            while not stop.is_set():
+                send(session_id)
+
+        threads = [Thread(target=keep_sending, args=(x,)) for x in "ab"]
+        for thread in threads:
+            thread.start()
+        for _ in range(50):
+            registry.remove_channel("/removed")
+            registry.create_queue("/removed", test_app, {}, {}, "fifo")
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        # Both sessions push to the channel that exists now.
+        channel = registry.get_channel("/removed")
+        size = channel.get_queue_size()
+        send("a")
+        send("b")
+        assert channel.get_queue_size() == size + 2
+        conn.close()
+        registry.remove_channel("/removed")
@@ -0,0 +1,205 @@
+import socket
+from threading import Event, Thread
+
+import pytest
+from weavelib.exceptions import BadArguments
+from weavelib.messaging import Message, read_message, serialize_message
+
+from messaging.application_registry import ApplicationRegistry, Plugin
+from messaging.appmgr import SYSTEM_REGISTRY_BASE_QUEUE, create_rpc_queues
+from messaging.appmgr import get_rpc_response_queue
+from messaging.loadgen import LoadGenerator, LoadStats, load_scenario
+from messaging.loadgen import REGISTRY_REQUEST_QUEUE
+from messaging.queue_manager import ChannelRegistry
+from messaging.server import MessageServer
+from messaging.synonyms import SynonymRegistry
+
+
+class TestScenario(object):
+    def test_defaults_and_count(self):
+        scenario = load_scenario({
+            "channels": [
+                {"register": "load/{}", "count": 2, "rate": 10},
+                {"channel": "/channels/x", "queue_type": "multicast",
+                 "producers": 3, "consumers": 0, "payload_size": 100},
+            ]
+        })
+
+        assert scenario["duration"] == 60
+        assert scenario["auth_token"] is None
+        assert [x.get("register") or x.get("channel")
+                for x in scenario["channels"]] == \
+            ["load/0", "load/1", "/channels/x"]
+        assert scenario["channels"][0]["rate"] == 10
+        assert scenario["channels"][2] == {
+            "channel": "/channels/x", "queue_type": "multicast",
+            "producers": 3, "consumers": 0, "rate": None,
+            "payload_size": 100,
+        }
+
+    def test_partitioned_keys(self):
+        scenario = load_scenario({
+            "channels": [
+                {"register": "load/a", "queue_type": "partitioned"},
+                {"register": "load/b", "queue_type": "partitioned",
+                 "keys": 4},
+            ]
+        })
+
+        assert [x["keys"] for x in scenario["channels"]] == [16, 4]
+
+    @pytest.mark.parametrize("obj", [
+        {},
+        {"channels": []},
+        {"channels": [{"producers": 1}]},
+        {"channels": [{"channel": "/a", "queue_type": "unknown"}]},
+        {"channels": [{"channel": "/a", "rate": 0}]},
+        {"channels": [{"channel": "/a", "queue_type": "partitioned",
+                       "keys": 0}]},
+        {"duration": -1, "channels": [{"channel": "/a"}]},
+    ])
+    def test_invalid(self, obj):
+        with pytest.raises(BadArguments):
+            load_scenario(obj)
+
+
+class TestLoadStats(object):
+    def test_take_and_merge(self):
+        stats = LoadStats()
+        stats.record_push(100)
+        stats.record_delivery(200)
+        stats.record_error("Unauthorized")
+
+        interval = stats.take()
+        assert (interval.sent, interval.delivered) == (1, 1)
+        assert stats.sent == 0
+
+        stats.record_push(300)
+        total = LoadStats()
+        total.merge(interval)
+        total.merge(stats.take())
+
+        res = total.to_json(2)
+        assert res["sent"] == 2
+        assert res["sent_per_second"] == 1
+        assert res["errors"] == {"Unauthorized": 1}
+        assert res["push_latency_us"]["max"] == 300
+
+
+class TestLoadGenerator(object):
+    def setup_method(self):
+        event = Event()
+        self.test_app = Plugin("test", "test", "test-token")
+        apps = ApplicationRegistry([("test", "test", "test-token")])
+        self.registry = ChannelRegistry(apps)
+        self.registry.create_queue("/load/fifo", self.test_app, {}, {},
+                                   "fifo")
+        self.registry.create_queue("/load/multicast", self.test_app, {}, {},
+                                   "multicast")
+
+        self.server = MessageServer(11023, apps, self.registry,
+                                    SynonymRegistry(), event.set)
+        self.server_thread = Thread(target=self.server.run)
+        self.server_thread.start()
+        event.wait()
+
+    def teardown_method(self):
+        self.server.shutdown()
+        self.server_thread.join()
+
+    def test_run(self):
+        scenario = load_scenario({
+            "duration": 0.5,
+            "report_interval": 0.2,
+            "channels": [
+                {"channel": "/load/fifo", "producers": 2, "consumers": 2,
+                 "rate": 100},
+                {"channel": "/load/multicast", "queue_type": "multicast",
+                 "consumers": 2, "rate": 100},
+            ]
+        })
+        generator = LoadGenerator("localhost", 11023, scenario)
+        generator.DRAIN_WAIT = 0.2
+        reports = []
+
+        summary = generator.run(report=reports.append)
+
+        assert len(reports) >= 2
+        assert summary["errors"] == {}
+        assert summary["sent"] > 50
+        # Every fifo message once, every multicast message to 2 subscribers.
+        assert summary["delivered"] > summary["sent"]
+
+    def serve_registry(self, calls):
+        # Stands in for the RPC hub: answers one register_queue call.
+        create_rpc_queues(SYSTEM_REGISTRY_BASE_QUEUE, self.test_app, {}, {},
+                          self.registry, "test", [])
+        sock = socket.create_connection(("localhost", 11023))
+        rfile = sock.makefile('rb')
+        sock.sendall(b'SESS p\nOP pop\nAUTH test-token\nC ' +
+                     REGISTRY_REQUEST_QUEUE.encode() + b'\n\n')
+        request = read_message(rfile)
+        invocation = request.task["invocation"]
+        calls.append(invocation)
+
+        name, queue_type = invocation["args"][:2]
+        channel = "/channels/test/" + name
+        self.registry.create_queue(channel, self.test_app, {}, {}, queue_type)
+        reply = Message("push", {"id": invocation["id"], "result": channel})
+        reply.headers.update(
+            SESS="p", AUTH="test-token", COOKIE=request.headers["COOKIE"],
+            C=get_rpc_response_queue(SYSTEM_REGISTRY_BASE_QUEUE))
+        sock.sendall((serialize_message(reply) + "\n").encode())
+        read_message(rfile)
+        sock.close()
+
+    def test_register_partitioned(self):
+        calls = []
+        registry_thread = Thread(target=self.serve_registry, args=(calls,))
+        registry_thread.start()
+        scenario = load_scenario({
+            "duration": 0.5,
+            "report_interval": 0.5,
+            "auth_token": "test-token",
+            "channels": [
+                {"register": "keyed", "queue_type": "partitioned",
+                 "producers": 2, "consumers": 2, "rate": 100, "keys": 4},
+            ]
+        })
+        generator = LoadGenerator("localhost", 11023, scenario)
+        generator.DRAIN_WAIT = 0.2
+
+        summary = generator.run(report=lambda x: None)
+        registry_thread.join()
+
+        assert calls[0]["command"] == "register_queue"
+        assert calls[0]["args"][0].startswith("loadgen/")
+        assert calls[0]["args"][1] == "partitioned"
+        assert scenario["channels"][0]["channel"] == \
+            "/channels/test/" + calls[0]["args"][0]
+        # Pushes carry a KEY, so none are rejected.
+        assert summary["errors"] == {}
+        assert summary["sent"] > 50
+        assert summary["delivered"] > 0
+
+    def test_stops_with_unresponsive_server(self):
+        # The server accepts connections but never replies to the pushes.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("localhost", 0))
+        listener.listen(8)
+        scenario = load_scenario({
+            "duration": 0.2,
+            "report_interval": 0.2,
+            "channels": [{"channel": "/load/fifo", "producers": 2,
+                          "consumers": 0, "rate": 100}],
+        })
+        generator = LoadGenerator("localhost", listener.getsockname()[1],
+                                  scenario)
+
+        thread = Thread(target=generator.run, args=(lambda x: None,),
+                        daemon=True)
+        thread.start()
+        thread.join(5)
+        stopped = not thread.is_alive()
+        listener.close()
+        assert stopped
@@ -0,0 +1,142 @@
+import pytest
+from weavelib.exceptions import BadArguments, InternalError
+from weavelib.messaging import Message
+
+from messaging.application_registry import ApplicationRegistry, Plugin
+from messaging.memory import MemoryBudget
+from messaging.queue_manager import ChannelRegistry
+
+
+def make_message(task, **headers):
+    msg = Message("enqueue", task)
+    msg.headers["SESS"] = "1"
+    msg.headers.update(headers)
+    return msg
+
+
+def make_registry(limit=None, policy="reject"):
+    test_app = Plugin("test", "test", "test-token")
+    registry = ChannelRegistry(ApplicationRegistry(),
+                               memory_budget=MemoryBudget(limit, policy))
+    return registry, test_app
+
+
+class TestMemoryBudget(object):
+    def test_unlimited(self):
+        budget = MemoryBudget()
+        budget.reserve(100)
+        budget.check(10 ** 12)
+        budget.release(10 ** 12 + 60)
+        assert budget.to_json() == {"limit": None, "policy": "reject",
+                                    "used": 40, "peak": 10 ** 12 + 100,
+                                    "rejected": 0, "shed": 0}
+
+    def test_reject(self):
+        budget = MemoryBudget(100)
+        budget.reserve(40)
+        budget.check(50)
+        # check() reserved the 50 bytes, so this doesn't fit any more.
+        with pytest.raises(InternalError):
+            budget.check(50)
+        budget.check(10)
+        with pytest.raises(InternalError):
+            budget.check(1)
+        assert budget.used == 100
+        assert budget.rejected == 2
+
+    def test_shed_to_low_watermark(self):
+        budget = MemoryBudget(100, "shed")
+        budget.reserve(100)
+        requested = []
+
+        def shedder(nbytes):
+            requested.append(nbytes)
+            budget.release(nbytes)
+            return nbytes
+
+        budget.shedder = shedder
+        budget.check(10)
+        assert requested == [20]
+        assert budget.used == 90
+        assert budget.shed == 20
+
+    def test_bad_policy(self):
+        with pytest.raises(BadArguments):
+            MemoryBudget(100, "unknown")
+
+
+class TestChannelMemory(object):
+    def test_accounting(self):
+        registry, test_app = make_registry()
+        fifo = registry.create_queue("/a/fifo", test_app, {}, {}, "fifo")
+        sessionized = registry.create_queue("/a/sessionized", test_app, {},
+                                            {}, "sessionized")
+        partitioned = registry.create_queue("/a/partitioned", test_app, {},
+                                            {}, "partitioned")
+        budget = registry.memory_budget
+
+        fifo.push(make_message("x" * 10))
+        fifo.push(make_message("x" * 20))
+        sessionized.push(make_message("x" * 25, COOKIE="c"))
+        partitioned.push(make_message("x" * 40, KEY="k"))
+        assert budget.used == 95
+        assert registry.get_memory_usage() == [
+            ("/a/partitioned", 40), ("/a/fifo", 30), ("/a/sessionized", 25)
+        ]
+        assert registry.get_stats("/a/fifo")["/a/fifo"]["queued_bytes"] == 30
+
+        fifo.pop(make_message(None), lambda task, headers: None)
+        sessionized.pop(make_message(None, COOKIE="c"),
+                        lambda task, headers: None)
+        assert budget.used == 60
+
+        registry.remove_channel("/a/partitioned")
+        assert budget.used == 20
+        assert budget.peak == 95
+
+    def test_direct_delivery(self):
+        registry, test_app = make_registry(25)
+        fifo = registry.create_queue("/a/fifo", test_app, {}, {}, "fifo")
+        multicast = registry.create_queue("/a/multicast", test_app, {}, {},
+                                          "multicast")
+        received = []
+
+        # Bytes reserved for a push are given back if nothing queues it.
+        fifo.pop(make_message(None), lambda task, headers: received.append(1))
+        fifo.push(make_message("x" * 20))
+        multicast.push(make_message("x" * 20))
+        assert received == [1]
+        assert registry.memory_budget.used == 0
+        assert registry.memory_budget.peak == 20
+
+    def test_reject(self):
+        registry, test_app = make_registry(25)
+        fifo = registry.create_queue("/a/fifo", test_app, {}, {}, "fifo")
+
+        fifo.push(make_message("x" * 20))
+        with pytest.raises(InternalError):
+            fifo.push(make_message("x" * 10))
+        assert fifo.get_queue_size() == 1
+        assert fifo.metrics.pushes == 1
+        assert fifo.metrics.rejected == 1
+        assert fifo.get_stats()["rejected"] == 1
+
+    def test_shed_from_largest(self):
+        registry, test_app = make_registry(100, "shed")
+        small = registry.create_queue("/a/small", test_app, {}, {}, "fifo")
+        large = registry.create_queue("/a/large", test_app, {}, {},
+                                      "partitioned")
+
+        small.push(make_message("x" * 20))
+        for index in range(4):
+            large.push(make_message("x" * 20, KEY=str(index)))
+
+        large.push(make_message("latest" + "x" * 14, KEY="0"))
+
+        # Down to 90 bytes: two of the large channel's messages go.
+        assert registry.memory_budget.used == 80
+        assert small.get_queue_size() == 1
+        assert large.get_queue_size() == 3
+        assert large.metrics.drops == 2
+        assert any(msg.task.startswith("latest")
+                   for msg in large.dump_messages())
@@ -1,6 +1,8 @@
 import random
 import socket
+import time
 from copy import deepcopy
+from queue import Queue
 from threading import Thread, Event, Semaphore
 
 import pytest
@@ -8,13 +10,15 @@ from weavelib.exceptions import ObjectNotFound, ObjectAlreadyExists
 from weavelib.exceptions import SchemaValidationFailed, ProtocolError
 from weavelib.exceptions import BadOperation, InternalError, ObjectClosed
 from weavelib.exceptions import AuthenticationFailed
-from weavelib.messaging import Sender, Receiver, read_message
+from weavelib.messaging import Sender, Receiver, Message, read_message
 from weavelib.messaging import ensure_ok_message, WeaveConnection
 
-from messaging.server import MessageServer
+from messaging.memory import MemoryBudget
+from messaging.server import MessageServer, Connection, OutboundQueue
 from messaging.application_registry import ApplicationRegistry, Plugin
 from messaging.queue_manager import ChannelRegistry
 from messaging.synonyms import SynonymRegistry
+from messaging.appmgr import create_rpc_queues
 
 
 import logging
@@ -87,8 +91,15 @@ class TestMessageServer(object):
         registry.create_queue('/multicast/2', test_app, {"type": "string"}, {},
                               'multicast')
 
+        registry.create_queue('/rpc/request', test_app, {"type": "string"}, {},
+                              'fifo',
+                              options={"response_channel": "/rpc/response"})
+        registry.create_queue('/rpc/response', test_app, {}, {},
+                              'sessionized')
+
         synonym_registry = SynonymRegistry()
         synonym_registry.register("/multi", "/multicast/2")
+        synonym_registry.register("/multi-alias", "/synonyms/multi")
 
         cls.server = MessageServer(11023, apps, registry, synonym_registry,
                                    event.set)
@@ -357,6 +368,92 @@ class TestMessageServer(object):
         assert msgs[-1] == "test"
         assert not sem.acquire(timeout=2)
 
+    def test_multicast_with_chained_synonym(self):
+        msgs = []
+        sem = Semaphore(0)
+        receiver = Receiver(self.conn, "/synonyms/multi")
+        receiver.on_message = make_receiver(1, msgs, sem, receiver)
+        receiver.start()
+        Thread(target=receiver.run).start()
+
+        sender = Sender(self.conn, "/synonyms/multi-alias")
+        sender.start()
+        sender.send("test")
+
+        assert sem.acquire(timeout=10)
+        assert msgs[-1] == "test"
+
+    def test_call(self):
+        def provide():
+            receiver = Receiver(self.conn, "/rpc/request")
+            sender = Sender(self.conn, "/rpc/response")
+            receiver.start()
+            sender.start()
+
+            def on_message(msg, headers):
+                sender.send(msg.upper(), headers={"COOKIE": headers["COOKIE"]})
+                receiver.stop()
+            receiver.on_message = on_message
+            receiver.run()
+
+        provider = Thread(target=provide)
+        provider.start()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(("localhost", WeaveConnection.PORT))
+        wfile = sock.makefile('wb', WeaveConnection.WRITE_BUF_SIZE)
+        rfile = sock.makefile('rb', WeaveConnection.READ_BUF_SIZE)
+        wfile.write(b'MSG "hello"\nSESS 1\nCOOKIE call-1\nOP call\n'
+                    b'C /rpc/request\n\n')
+        wfile.flush()
+
+        # A single response: the reply itself.
+        msg = read_message(rfile)
+        sock.close()
+        provider.join()
+
+        assert msg.operation == "inform"
+        assert msg.task == "HELLO"
+        assert msg.headers["SESS"] == "1"
+
+    def test_second_call_on_busy_session(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(("localhost", WeaveConnection.PORT))
+        wfile = sock.makefile('wb', WeaveConnection.WRITE_BUF_SIZE)
+        rfile = sock.makefile('rb', WeaveConnection.READ_BUF_SIZE)
+        wfile.write(b'MSG "a"\nSESS 1\nCOOKIE busy-1\nOP call\n'
+                    b'C /rpc/request\n\n')
+        wfile.write(b'MSG "b"\nSESS 1\nCOOKIE busy-2\nOP call\n'
+                    b'C /rpc/request\n\n')
+        wfile.flush()
+
+        with pytest.raises(ProtocolError):
+            ensure_ok_message(read_message(rfile))
+
+        # The first call is still waiting on its reply.
+        conn = WeaveConnection.local()
+        conn.connect()
+        receiver = Receiver(conn, "/rpc/request")
+        receiver.start()
+        sender = Sender(conn, "/rpc/response")
+        sender.start()
+
+        def on_message(task, headers):
+            sender.send(task.upper(), headers={"COOKIE": headers["COOKIE"]})
+            receiver.stop()
+        receiver.on_message = on_message
+        receiver.run()
+
+        msg = read_message(rfile)
+        sock.close()
+        conn.close()
+        assert msg.task == "A"
+
+    def test_call_on_non_rpc_channel(self):
+        with pytest.raises(BadOperation):
+            send_raw('MSG "x"\nSESS 1\nCOOKIE c\nOP call\nC /test.fifo/simple'
+                     '\n\n')
+
     @pytest.mark.parametrize("queue_name",
                              ["/test.fifo/test-disconnect",
                               "/test.sessionized/test-disconnect"])
@@ -458,3 +555,259 @@ class TestMessageServerClosure(object):
         thread.join()
         t1.join()
         t2.join()
+
+    def test_shutdown_is_fast_and_rejects_waiters(self):
+        event = Event()
+        test_app = Plugin("test", "test", "test-token")
+        registry = ChannelRegistry(ApplicationRegistry())
+        registry.create_queue("/shutdown", test_app, {"type": "string"}, {},
+                              "fifo")
+
+        server = MessageServer(11023, ApplicationRegistry(), registry,
+                               SynonymRegistry(), event.set)
+        thread = Thread(target=server.run)
+        thread.start()
+        event.wait()
+
+        conn = WeaveConnection()
+        conn.connect()
+
+        errors = []
+        waiting = Event()
+        receiver = Receiver(conn, "/shutdown")
+        receiver.start()
+        original = receiver.receive
+
+        def receive():
+            waiting.set()
+            try:
+                original()
+            except ObjectClosed as e:
+                errors.append(e)
+
+        receiver.receive = receive
+        receiver_thread = Thread(target=receiver.receive)
+        receiver_thread.start()
+        waiting.wait()
+        time.sleep(0.1)  # Let the pop reach the server.
+
+        start = time.monotonic()
+        server.shutdown(drain_timeout=0.5)
+        thread.join()
+        receiver_thread.join()
+        conn.close()
+
+        assert time.monotonic() - start < 1
+        assert len(errors) == 1
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.removed = []
+        self.active = True
+        self.evicted = False
+
+    def remove_requestor(self, session_id):
+        self.removed.append(session_id)
+
+
+class TestConnection(object):
+    def test_close_waiters(self):
+        channel = FakeChannel()
+        response_queue = Queue()
+        conn = Connection(None, None, None, response_queue)
+        conn.add_waiter("s1", channel)
+        conn.add_waiter("s2", channel)
+
+        conn.close_waiters(ObjectClosed("Server shutting down."))
+
+        assert sorted(channel.removed) == ["s1", "s2"]
+        assert conn.pop_waiters == {}
+        msgs = [response_queue.get(), response_queue.get()]
+        assert sorted(x.headers["SESS"] for x in msgs) == ["s1", "s2"]
+
+    def test_close_tells_served_sessions(self):
+        channel = FakeChannel()
+        conn = Connection(None, None, None, Queue())
+        conn.add_waiter("s1", channel)
+        conn.add_waiter("s2", channel)
+        conn.on_served("s1", channel)
+
+        conn.close_waiters(ObjectClosed("Server shutting down."))
+        assert channel.removed == ["s2"]
+
+        conn.remove_all_waiters()
+        assert channel.removed == ["s2", "s1"]
+
+    def test_dropped_channels_forgotten(self):
+        conn = Connection(None, None, None, Queue())
+        kept, evicted, removed = FakeChannel(), FakeChannel(), FakeChannel()
+        conn.on_served("s1", kept)
+        conn.on_served("s2", evicted)
+        conn.on_served("s3", removed)
+        conn.get_cached_channel("/q", 1)
+
+        evicted.evicted = True
+        removed.active = False
+        conn.get_cached_channel("/q", 2)
+        assert conn.served_sessions == {"s1": kept}
+
+    def test_one_call_per_session(self):
+        conn = Connection(None, None, None, Queue())
+        first, second = FakeChannel(), FakeChannel()
+        assert conn.add_call_waiter("s1", first)
+        assert not conn.add_call_waiter("s1", second)
+        assert conn.pop_waiters == {"s1": first}
+
+        conn.remove_waiter("s1")
+        assert conn.add_call_waiter("s1", second)
+
+    def test_stale_channel_not_cached(self):
+        conn = Connection(None, None, None, Queue())
+        old, new = FakeChannel(), FakeChannel()
+
+        # One session resolves the channel, another sees the registries
+        # change before the first one caches it.
+        assert conn.get_cached_channel("/q", 1) is None
+        assert conn.get_cached_channel("/q", 2) is None
+        conn.cache_channel("/q", old, 1)
+        assert conn.get_cached_channel("/q", 2) is None
+
+        conn.cache_channel("/q", new, 2)
+        assert conn.get_cached_channel("/q", 2) is new
+
+    def test_drain(self):
+        response_queue = Queue()
+        conn = Connection(None, None, None, response_queue)
+        response_queue.put("msg")
+
+        assert not conn.drain(time.monotonic() + 0.05)
+
+        response_queue.get()
+        response_queue.task_done()
+        assert conn.drain(time.monotonic() + 0.05)
+
+    def test_put_after_discard(self):
+        budget = MemoryBudget()
+        response_queue = OutboundQueue(budget)
+        conn = Connection(None, None, None, response_queue)
+        response_queue.put(Message("inform", "x" * 10))
+        assert budget.used == 10
+
+        response_queue.discard()
+        assert budget.used == 0
+
+        # A late delivery neither holds budget nor keeps drain() waiting.
+        response_queue.put(Message("inform", "x" * 10))
+        assert budget.used == 0
+        assert response_queue.empty()
+        assert conn.drain(time.monotonic() + 0.05)
+
+
+class TestStageTimings(object):
+    def test_push_stages(self):
+        event = Event()
+        test_app = Plugin("test", "test", "test-token")
+        registry = ChannelRegistry(ApplicationRegistry())
+        registry.create_queue("/timed", test_app, {"type": "string"}, {},
+                              "fifo")
+
+        server = MessageServer(11023, ApplicationRegistry(), registry,
+                               SynonymRegistry(), event.set,
+                               stage_sample_interval=1)
+        thread = Thread(target=server.run)
+        thread.start()
+        event.wait()
+
+        try:
+            send_raw('MSG "x"\nSESS 1\nOP push\nC /timed\n\n')
+
+            # The writer records its stage after the reply is sent.
+            deadline = time.monotonic() + 5
+            while "write" not in server.stage_timings.to_json()["stages_us"]:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+
+            stages = server.stage_timings.to_json()["stages_us"]
+            assert sorted(stages) == sorted([
+                "read", "resolve", "preprocess", "validate_schema",
+                "check_auth", "dispatch", "writer_queue", "write"])
+            assert all(x["count"] == 1 for x in stages.values())
+        finally:
+            server.shutdown()
+            thread.join()
+
+
+class TestTracing(object):
+    def setup_method(self):
+        event = Event()
+        self.test_app = Plugin("test", "test", "test-token")
+        apps = ApplicationRegistry([("test", "test", "test-token")])
+        self.registry = ChannelRegistry(apps)
+        self.server = MessageServer(11023, apps, self.registry,
+                                    SynonymRegistry(), event.set,
+                                    trace_sample_interval=1)
+        self.thread = Thread(target=self.server.run)
+        self.thread.start()
+        event.wait()
+        self.sockets = []
+
+    def teardown_method(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.shutdown()
+        self.thread.join()
+
+    def connect(self):
+        sock = socket.create_connection(("localhost", 11023))
+        self.sockets.append(sock)
+        return sock, sock.makefile('rb')
+
+    def wait_for_events(self, trace_id, count):
+        # Writes are recorded after the reply is sent.
+        deadline = time.monotonic() + 5
+        while len(self.server.trace_log.get_trace(trace_id)) < count:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        return [(x["event"], x.get("channel"), x.get("operation"))
+                for x in self.server.trace_log.get_trace(trace_id)]
+
+    def test_push_pop(self):
+        self.registry.create_queue("/traced", self.test_app, {}, {}, "fifo")
+        consumer, consumer_file = self.connect()
+        producer, producer_file = self.connect()
+
+        consumer.sendall(b'SESS c\nOP pop\nC /traced\n\n')
+        time.sleep(0.1)
+        producer.sendall(b'MSG "x"\nSESS p\nOP push\nC /traced\n\n')
+
+        trace_id = read_message(producer_file).headers["TRACE"]
+        assert read_message(consumer_file).headers["TRACE"] == trace_id
+        assert sorted(self.wait_for_events(trace_id, 4)) == sorted([
+            ("enqueue", "/traced", None), ("dispatch", "/traced", None),
+            ("write", None, "result"), ("write", None, "inform")])
+
+    def test_call(self):
+        create_rpc_queues("/rpc", self.test_app, {}, {}, self.registry,
+                          "test", [])
+        provider, provider_file = self.connect()
+        caller, caller_file = self.connect()
+
+        provider.sendall(b'SESS p\nOP pop\nAUTH test-token\n' +
+                         b'C /rpc/request\n\n')
+        time.sleep(0.1)
+        caller.sendall(b'MSG "x"\nSESS c\nOP call\nCOOKIE 1\nTRACE t1\n' +
+                       b'C /rpc/request\n\n')
+
+        request = read_message(provider_file)
+        assert request.headers["TRACE"] == "t1"
+        # The provider doesn't pass TRACE on.
+        provider.sendall(b'MSG "y"\nSESS p\nOP push\nAUTH test-token\n' +
+                         b'COOKIE 1\nC /rpc/response\n\n')
+
+        reply = read_message(caller_file)
+        assert reply.task == "y"
+        assert reply.headers["TRACE"] == "t1"
+        events = self.wait_for_events("t1", 5)
+        assert ("dispatch", "/rpc/request", None) in events
+        assert ("dispatch", "/rpc/response", None) in events
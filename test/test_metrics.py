@@ -0,0 +1,118 @@
+import json
+
+from weavelib.messaging import Message
+
+from messaging.application_registry import ApplicationRegistry, Plugin
+from messaging.metrics import LatencyHistogram, StageTimings, payload_size
+from messaging.queue_manager import ChannelRegistry
+
+
+def make_message(task, **headers):
+    msg = Message("enqueue", task)
+    msg.headers["SESS"] = "1"
+    msg.headers.update(headers)
+    return msg
+
+
+class TestLatencyHistogram(object):
+    def test_empty(self):
+        assert LatencyHistogram().to_json() == {
+            "count": 0, "mean": 0, "max": 0, "p50": 0, "p90": 0, "p99": 0,
+            "p999": 0
+        }
+
+    def test_bucket_round_trip(self):
+        histogram = LatencyHistogram()
+        for index in range(len(histogram.counts)):
+            value = histogram.bucket_value(index)
+            assert histogram.bucket_index(value) == index
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for value in range(1, 10001):
+            histogram.record(value)
+
+        assert histogram.total == 10000
+        assert histogram.max == 10000
+        for percent, expected in ((50, 5000), (90, 9000), (99, 9900)):
+            assert abs(histogram.percentile(percent) - expected) <= \
+                expected * 0.07
+
+    def test_clamps_values(self):
+        histogram = LatencyHistogram()
+        histogram.record(-5)
+        histogram.record(LatencyHistogram.MAX_VALUE * 2)
+        assert histogram.total == 2
+        assert histogram.max == LatencyHistogram.MAX_VALUE
+
+    def test_merge(self):
+        merged, odd, even = (LatencyHistogram() for _ in range(3))
+        for value in range(1, 1001):
+            merged.record(value)
+            (odd if value % 2 else even).record(value)
+
+        odd.merge(even)
+        assert odd.to_json() == merged.to_json()
+
+
+class TestStageTimings(object):
+    def test_disabled(self):
+        timings = StageTimings()
+        assert all(timings.start() is None for _ in range(100))
+        assert timings.to_json() == {"sample_interval": 0, "samples": 0,
+                                     "stages_us": {}}
+
+    def test_sampling(self):
+        timings = StageTimings(3)
+        clocks = [timings.start() for _ in range(9)]
+        assert [x is not None for x in clocks] == [False, False, True] * 3
+
+        for clock in filter(None, clocks):
+            clock.lap("read")
+            clock.lap("write")
+
+        res = timings.to_json()
+        assert res["samples"] == 3
+        assert sorted(res["stages_us"]) == ["read", "write"]
+        assert res["stages_us"]["read"]["count"] == 3
+
+        timings.set_sample_interval(0)
+        timings.reset()
+        assert timings.start() is None
+        assert timings.to_json()["stages_us"] == {}
+
+
+class TestChannelStats(object):
+    def test_payload_size(self):
+        assert payload_size(None) == 0
+        assert payload_size("abc") == 3
+        assert payload_size({"a": 1}) == len('{"a":1}')
+        task = {"a": [1, 2.5, None, True, False], "b": {}, "c": ["x", []]}
+        assert payload_size(task) == len(json.dumps(task,
+                                                    separators=(",", ":")))
+
+    def test_stats(self):
+        test_app = Plugin("test", "test", "test-token")
+        registry = ChannelRegistry(ApplicationRegistry())
+        fifo = registry.create_queue("/a/fifo", test_app, {}, {}, "fifo")
+        multicast = registry.create_queue("/a/multicast", test_app, {}, {},
+                                          "multicast")
+        registry.create_queue("/b/fifo", test_app, {}, {}, "fifo")
+
+        fifo.push(make_message("hello"))
+        fifo.push(make_message("world"))
+        fifo.pop(make_message(None), lambda task, headers: None)
+        multicast.push(make_message("dropped"))
+
+        stats = registry.get_stats("/a")
+        assert set(stats.keys()) == {"/a/fifo", "/a/multicast"}
+
+        fifo_stats = stats["/a/fifo"]
+        assert fifo_stats["pushes"] == 2
+        assert fifo_stats["pops"] == 1
+        assert fifo_stats["bytes"] == 10
+        assert fifo_stats["depth"] == 1
+        assert fifo_stats["waiters"] == 0
+        assert fifo_stats["latency_us"]["count"] == 1
+
+        assert stats["/a/multicast"]["drops"] == 1
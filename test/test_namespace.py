@@ -0,0 +1,89 @@
+import pytest
+
+from weavelib.exceptions import ObjectNotFound
+
+from messaging.application_registry import ApplicationRegistry, Plugin
+from messaging.namespace import ChannelNamespace
+from messaging.queue_manager import ChannelRegistry
+
+
+NAMES = [
+    "/channels/a/q1",
+    "/channels/a/q2",
+    "/channels/a/q2/sub",
+    "/channels/ab/q1",
+    "/plugins/a/rpcs/r1/request",
+    "/plugins/a/rpcs/r1/response",
+    "/plugins/b/rpcs/r1/request",
+]
+
+
+class TestChannelNamespace(object):
+    def setup_method(self):
+        self.namespace = ChannelNamespace()
+        for name in reversed(NAMES):
+            assert self.namespace.add(name)
+
+    def test_add_duplicate(self):
+        assert not self.namespace.add("/channels/a/q1")
+
+    def test_list(self):
+        assert self.namespace.list("/") == NAMES
+        assert self.namespace.list("/channels/a") == NAMES[:3]
+        assert self.namespace.list("/channels/a/") == NAMES[:3]
+        assert self.namespace.list("/channels/x") == []
+
+    def test_list_paginated(self):
+        assert self.namespace.list("/", None, 2) == NAMES[:2]
+        assert self.namespace.list("/", NAMES[1], 2) == NAMES[2:4]
+        assert self.namespace.list("/", NAMES[3], 10) == NAMES[4:]
+        assert self.namespace.list("/", NAMES[-1], 10) == []
+
+        # Cursor outside of the prefix.
+        assert self.namespace.list("/plugins", "/channels/zzz") == NAMES[4:]
+        assert self.namespace.list("/channels", "/plugins/a") == []
+
+    def test_count(self):
+        assert self.namespace.count("/") == len(NAMES)
+        assert self.namespace.count("/channels/a") == 3
+        assert self.namespace.count("/plugins") == 3
+        assert self.namespace.count("/nothing") == 0
+
+    def test_remove(self):
+        assert self.namespace.remove("/channels/a/q2")
+        assert not self.namespace.remove("/channels/a/q2")
+        assert not self.namespace.remove("/channels/a")
+        assert self.namespace.list("/channels/a") == ["/channels/a/q1",
+                                                      "/channels/a/q2/sub"]
+
+    def test_remove_prefix(self):
+        removed = self.namespace.remove_prefix("/plugins/a")
+        assert removed == NAMES[4:6]
+        assert self.namespace.count("/plugins") == 1
+        assert "a" not in self.namespace.root.children[""] \
+            .children["plugins"].children
+
+        assert self.namespace.remove_prefix("/") == NAMES[:4] + NAMES[6:]
+        assert self.namespace.count("/") == 0
+
+    def test_remove_prefix_with_exclusions(self):
+        removed = self.namespace.remove_prefix("/channels",
+                                               ["/channels/a/q2", "/plugins"])
+        assert removed == ["/channels/a/q1", "/channels/ab/q1"]
+        assert self.namespace.list("/") == NAMES[1:3] + NAMES[4:]
+
+
+class TestChannelRegistryPrefixes(object):
+    def test_remove_channels(self):
+        test_app = Plugin("test", "test", "test-token")
+        registry = ChannelRegistry(ApplicationRegistry())
+        for name in NAMES:
+            registry.create_queue(name, test_app, {}, {}, "fifo")
+
+        assert registry.count_channels("/channels/a") == 3
+        assert registry.remove_channels("/channels/a") == NAMES[:3]
+        assert registry.list_channels("/channels") == ["/channels/ab/q1"]
+
+        with pytest.raises(ObjectNotFound):
+            registry.get_channel("/channels/a/q1")
+        assert registry.get_channel("/channels/ab/q1")
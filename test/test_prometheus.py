@@ -0,0 +1,87 @@
+from threading import Thread
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import pytest
+from weavelib.messaging import Message
+
+from messaging.application_registry import ApplicationRegistry, Plugin
+from messaging.prometheus import MetricsExporter, MetricsServer
+from messaging.prometheus import format_labels
+from messaging.queue_manager import ChannelRegistry
+from messaging.server import MessageServer
+from messaging.synonyms import SynonymRegistry
+
+
+def parse_samples(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+class TestMetricsExporter(object):
+    def setup_method(self):
+        test_app = Plugin("test", "test", "test-token")
+        apps = ApplicationRegistry([("test", "test", "test-token")])
+        registry = ChannelRegistry(apps)
+        registry.create_queue("/a/fifo", test_app, {}, {}, "fifo")
+        registry.create_queue('/b/"quoted"', test_app, {}, {}, "fifo")
+        registry.create_queue("/lazy", test_app, {}, {}, "fifo", lazy=True)
+
+        msg = Message("enqueue", "hello")
+        msg.headers["SESS"] = "1"
+        registry.get_channel("/a/fifo").push(msg)
+
+        self.server = MessageServer(11023, apps, registry, SynonymRegistry(),
+                                    lambda: None, stage_sample_interval=1)
+        clock = self.server.stage_timings.start()
+        clock.lap("read")
+        self.exporter = MetricsExporter(self.server)
+
+    def teardown_method(self):
+        self.server.server_close()
+
+    def test_format_labels(self):
+        assert format_labels(a='x"y\\z\n') == '{a="x\\"y\\\\z\\n"}'
+
+    def test_render(self):
+        samples = parse_samples(self.exporter.render())
+
+        assert samples["weave_connections"] == 0
+        assert samples['weave_channel_depth{channel="/a/fifo"}'] == 1
+        assert samples['weave_channel_pushes_total{channel="/a/fifo"}'] == 1
+        assert samples['weave_channel_bytes_total{channel="/a/fifo"}'] == 5
+        assert samples['weave_channel_depth{channel="/b/\\"quoted\\""}'] == 0
+        assert 'weave_channel_depth{channel="/lazy"}' not in samples
+        assert samples['weave_channel_delivery_latency_microseconds_count' +
+                       '{channel="/a/fifo"}'] == 0
+        assert samples['weave_registry_entries{registry="channels"}'] == 3
+        assert samples['weave_registry_entries{registry="loaded_channels"}'] \
+            == 2
+        assert samples['weave_registry_entries{registry="apps"}'] == 1
+        assert samples['weave_stage_latency_microseconds_count' +
+                       '{stage="read"}'] == 1
+        assert 'weave_stage_latency_microseconds{stage="read",' + \
+            'quantile="0.99"}' in samples
+
+    def test_http(self):
+        metrics_server = MetricsServer(0, self.exporter)
+        thread = Thread(target=metrics_server.run)
+        thread.start()
+        url = "http://127.0.0.1:{}".format(metrics_server.server_address[1])
+
+        try:
+            with urlopen(url + "/metrics") as response:
+                assert response.headers["Content-Type"].startswith(
+                    "text/plain; version=0.0.4")
+                body = response.read().decode()
+            assert "# TYPE weave_channel_depth gauge" in body
+
+            with pytest.raises(HTTPError):
+                urlopen(url + "/other")
+        finally:
+            metrics_server.shutdown()
+            thread.join()
@@ -1,18 +1,23 @@
+import json
+
 import pytest
 
 from weavelib.exceptions import SchemaValidationFailed, ObjectAlreadyExists
 from weavelib.exceptions import ObjectNotFound, InternalError, ObjectClosed
-from weavelib.exceptions import BadArguments
+from weavelib.exceptions import BadArguments, ProtocolError
+from weavelib.messaging import Message
 
 from messaging.application_registry import ApplicationRegistry, Plugin
 from messaging.queue_manager import ChannelRegistry
 from messaging.queues import SessionizedQueue, RoundRobinQueue
+from messaging.queues import PartitionedQueue, ChannelEvicted
 
 
 class TestChannelRegistry(object):
     @pytest.mark.parametrize("queue_type,expected_cls",
                              [("sessionized", SessionizedQueue),
-                              ("fifo", RoundRobinQueue)])
+                              ("fifo", RoundRobinQueue),
+                              ("partitioned", PartitionedQueue)])
     def test_create_queue_simple(self, queue_type, expected_cls):
         test_app = Plugin("test", "test", "test-token")
         apps = ApplicationRegistry()
@@ -58,6 +63,23 @@ class TestChannelRegistry(object):
         with pytest.raises(ObjectNotFound):
             registry.get_channel("test_queue")
 
+    def test_remove_channel(self):
+        test_app = Plugin("test", "test", "test-token")
+        registry = ChannelRegistry(ApplicationRegistry())
+        registry.create_queue("queue1", test_app, {}, {}, "fifo")
+        snapshot = registry.channel_map
+        generation = registry.generation
+
+        assert registry.remove_channel("queue1")
+        assert registry.generation != generation
+        with pytest.raises(ObjectNotFound):
+            registry.get_channel("queue1")
+        with pytest.raises(ObjectNotFound):
+            registry.remove_channel("queue1")
+
+        # Published maps are never mutated.
+        assert "queue1" in snapshot
+
     def test_queue_connect_fail(self):
         backup = RoundRobinQueue.connect
         RoundRobinQueue.connect = lambda self: False
@@ -92,3 +114,270 @@ class TestChannelRegistry(object):
 
         with pytest.raises(ObjectClosed):
             registry.create_queue("queue3", test_app, {}, {}, "fifo")
+
+
+class TestSessionizedReplies(object):
+    def setup_method(self):
+        test_app = Plugin("test", "test", "test-token")
+        registry = ChannelRegistry(ApplicationRegistry())
+        self.queue = registry.create_queue("/response", test_app, {}, {},
+                                           "sessionized")
+        self.received = []
+        self.received_headers = []
+
+    def make_message(self, session_id, cookie, task=None):
+        msg = Message("call", task)
+        msg.headers.update({"SESS": session_id, "COOKIE": cookie})
+        return msg
+
+    def on_reply(self, task, headers):
+        self.received.append(task)
+        self.received_headers.append(headers)
+
+    def test_reply_skips_cookie_queue(self):
+        self.queue.expect_reply(self.make_message("s1", "c1"), self.on_reply)
+        assert self.queue.get_requestors_size() == 1
+
+        self.queue.push(self.make_message("provider", "c1", "reply"))
+        assert self.received == ["reply"]
+        assert not self.queue.queues
+        assert self.queue.is_idle()
+
+        # The reply waiter is gone; later pushes are queued as usual.
+        self.queue.push(self.make_message("provider", "c1", "late"))
+        assert self.received == ["reply"]
+        assert self.queue.get_queue_size() == 1
+
+    def test_reply_auth_is_serialized(self):
+        # Replies carry the provider's app info, as JSON, like popped ones.
+        auth = {"app_url": "provider-url", "app_type": "plugin"}
+        self.queue.expect_reply(self.make_message("s1", "c1"), self.on_reply)
+        msg = self.make_message("provider", "c1", "reply")
+        msg.headers["AUTH"] = auth
+        self.queue.push(msg)
+
+        self.queue.pop(self.make_message("s2", "c2"), self.on_reply)
+        msg = self.make_message("provider", "c2", "popped")
+        msg.headers["AUTH"] = auth
+        self.queue.push(msg)
+
+        assert self.received == ["reply", "popped"]
+        assert [x["AUTH"] for x in self.received_headers] == \
+            [json.dumps(auth)] * 2
+
+    def test_cookie_in_use(self):
+        self.queue.expect_reply(self.make_message("s1", "c1"), self.on_reply)
+        with pytest.raises(ProtocolError):
+            self.queue.expect_reply(self.make_message("s2", "c1"),
+                                    self.on_reply)
+
+        self.queue.pop(self.make_message("s3", "c2"), self.on_reply)
+        with pytest.raises(ProtocolError):
+            self.queue.expect_reply(self.make_message("s4", "c2"),
+                                    self.on_reply)
+
+    def test_session_busy(self):
+        self.queue.expect_reply(self.make_message("s1", "c1"), self.on_reply)
+        with pytest.raises(ProtocolError):
+            self.queue.expect_reply(self.make_message("s1", "c2"),
+                                    self.on_reply)
+
+        # The first call is still waiting, and nothing was left behind.
+        self.queue.push(self.make_message("provider", "c1", "reply"))
+        assert self.received == ["reply"]
+        assert self.queue.is_idle()
+
+    def test_cancel_reply(self):
+        self.queue.expect_reply(self.make_message("s1", "c1"), self.on_reply)
+        self.queue.cancel_reply("s1")
+        assert self.queue.is_idle()
+
+        self.queue.expect_reply(self.make_message("s2", "c2"), self.on_reply)
+        self.queue.remove_requestor("s2")
+        assert self.queue.is_idle()
+
+
+class TestPartitionedQueue(object):
+    def setup_method(self):
+        test_app = Plugin("test", "test", "test-token")
+        registry = ChannelRegistry(ApplicationRegistry())
+        self.queue = registry.create_queue("/partitioned", test_app, {}, {},
+                                           "partitioned",
+                                           options={"partitions": 8})
+        self.received = {}
+
+    def push(self, key, task):
+        msg = Message("enqueue", task)
+        msg.headers.update({"SESS": "producer", "KEY": key})
+        self.queue.push(msg)
+
+    def pop(self, session_id):
+        def out(task, headers):
+            self.received.setdefault(session_id, []).append(
+                (headers["KEY"], task))
+
+        msg = Message("dequeue")
+        msg.headers["SESS"] = session_id
+        self.queue.pop(msg, out)
+
+    def test_bad_partition_count(self):
+        test_app = Plugin("test", "test", "test-token")
+        registry = ChannelRegistry(ApplicationRegistry())
+        with pytest.raises(BadArguments):
+            registry.create_queue("/p", test_app, {}, {}, "partitioned",
+                                  options={"partitions": 0})
+
+    def test_push_without_key(self):
+        msg = Message("enqueue", "x")
+        msg.headers["SESS"] = "producer"
+        with pytest.raises(ProtocolError):
+            self.queue.push(msg)
+
+    def test_rebalance_on_join_and_leave(self):
+        self.pop("s1")
+        assert self.queue.get_assignments() == {"s1": list(range(8))}
+
+        self.pop("s2")
+        assignments = self.queue.get_assignments()
+        assert len(assignments["s1"]) == len(assignments["s2"]) == 4
+
+        self.queue.remove_requestor("s1")
+        assert self.queue.get_assignments() == {"s2": list(range(8))}
+
+    def test_per_key_order(self):
+        keys = ["device-" + str(i) for i in range(20)]
+        for i in range(5):
+            for key in keys:
+                self.push(key, i)
+
+        sessions = ["s1", "s2", "s3"]
+        while self.queue.get_queue_size():
+            for session_id in sessions:
+                self.pop(session_id)
+
+        by_key = {}
+        for session_id, items in self.received.items():
+            for key, task in items:
+                by_key.setdefault(key, []).append((session_id, task))
+
+        for key in keys:
+            # Every key is consumed by one session, in push order.
+            assert len({x[0] for x in by_key[key]}) == 1
+            assert [x[1] for x in by_key[key]] == list(range(5))
+
+        assert len(self.received) == 3
+
+    def test_inflight_partition_not_handed_over(self):
+        self.pop("s1")
+        self.push("k", 1)
+        self.push("k", 2)
+        assert self.received["s1"] == [("k", 1)]
+
+        # s2 takes over half the partitions, possibly "k"'s, while s1 is still
+        # processing message 1. Message 2 must wait for s1 to come back.
+        self.pop("s2")
+        assert "s2" not in self.received
+
+        self.pop("s1")
+        delivered = self.received.get("s2", []) + self.received["s1"][1:]
+        assert delivered == [("k", 2)]
+
+
+class TestIdleChannels(object):
+    def setup_method(self):
+        self.test_app = Plugin("test", "test", "test-token")
+        self.registry = ChannelRegistry(ApplicationRegistry(), idle_timeout=10)
+
+    def make_idle(self, channel):
+        channel.last_active -= 20
+
+    def test_lazy_create(self):
+        assert self.registry.create_queue("/q", self.test_app, {}, {}, "fifo",
+                                          lazy=True) is None
+        assert "/q" not in self.registry.channel_map
+
+        queue = self.registry.get_channel("/q")
+        assert isinstance(queue, RoundRobinQueue)
+        assert self.registry.channel_map["/q"] is queue
+
+        with pytest.raises(ObjectAlreadyExists):
+            self.registry.create_queue("/q", self.test_app, {}, {}, "fifo")
+
+    def test_reclaim_idle_channel(self):
+        queue = self.registry.create_queue("/q", self.test_app, {}, {}, "fifo")
+        assert self.registry.reclaim_idle_channels() == 0
+
+        generation = self.registry.generation
+        self.make_idle(queue)
+        assert self.registry.reclaim_idle_channels() == 1
+        assert "/q" not in self.registry.channel_map
+        assert self.registry.generation != generation
+        assert self.registry.list_channels("/") == ["/q"]
+
+        msg = Message("enqueue", "x")
+        msg.headers["SESS"] = "1"
+        with pytest.raises(ChannelEvicted):
+            queue.push(msg)
+
+        new_queue = self.registry.get_channel("/q")
+        assert new_queue is not queue
+        assert new_queue.channel_info is queue.channel_info
+
+    def test_busy_channels_are_not_reclaimed(self):
+        queue = self.registry.create_queue("/q", self.test_app, {}, {}, "fifo")
+        msg = Message("enqueue", "x")
+        msg.headers["SESS"] = "1"
+        queue.push(msg)
+        self.make_idle(queue)
+        assert self.registry.reclaim_idle_channels() == 0
+
+        queue.pop(msg, lambda task, headers: None)
+        queue.pop(msg, lambda task, headers: None)
+        self.make_idle(queue)
+        assert self.registry.reclaim_idle_channels() == 0
+
+        queue.remove_requestor("1")
+        assert self.registry.reclaim_idle_channels() == 1
+
+    def test_remove_reclaimed_channel(self):
+        self.registry.create_queue("/q", self.test_app, {}, {}, "fifo",
+                                   lazy=True)
+        assert self.registry.remove_channel("/q")
+        with pytest.raises(ObjectNotFound):
+            self.registry.get_channel("/q")
+
+    @pytest.mark.parametrize("pop_first", [True, False])
+    def test_sessionized_queue_idle_after_reply(self, pop_first):
+        queue = self.registry.create_queue("/q", self.test_app, {}, {},
+                                           "sessionized")
+        received = []
+        pop_msg = Message("dequeue")
+        pop_msg.headers.update(SESS="1", COOKIE="c1")
+        push_msg = Message("enqueue", "reply")
+        push_msg.headers.update(SESS="2", COOKIE="c1")
+
+        def pop():
+            queue.pop(pop_msg, lambda task, headers: received.append(task))
+
+        if pop_first:
+            pop()
+            queue.push(push_msg)
+        else:
+            queue.push(push_msg)
+            pop()
+
+        assert received == ["reply"]
+        assert queue.queues == {}
+        assert queue.session_id_to_cookie_map == {}
+        assert queue.try_evict()
+
+    def test_multicast_push_after_eviction(self):
+        multicast = self.registry.create_queue("/m", self.test_app, {}, {},
+                                               "multicast")
+        self.make_idle(multicast)
+        assert self.registry.reclaim_idle_channels() == 1
+
+        msg = Message("enqueue", "x")
+        msg.headers["SESS"] = "1"
+        with pytest.raises(ChannelEvicted):
+            multicast.push(msg)
@@ -0,0 +1,95 @@
+import pytest
+from jsonschema import Draft4Validator, ValidationError
+
+from messaging.application_registry import Plugin
+from messaging.queue_manager import AcceptAllValidator, QueueInfo
+from messaging.schema import SchemaValidator
+
+
+def api_schema(name, arg_type):
+    return {
+        "type": "object",
+        "properties": {
+            "command": {"enum": [name]},
+            "args": {"type": "array", "items": {"type": arg_type}},
+        },
+        "required": ["command", "args"],
+    }
+
+
+def make_schema(count):
+    return {
+        "type": "object",
+        "properties": {
+            "invocation": {
+                "discriminator": {"propertyName": "command"},
+                "anyOf": [api_schema("api" + str(i),
+                                     "string" if i % 2 else "integer")
+                          for i in range(count)],
+            }
+        }
+    }
+
+
+class TestSchemaValidator(object):
+    def test_discriminated(self):
+        schema = make_schema(60)
+        Draft4Validator.check_schema(schema)
+        validator = SchemaValidator(schema)
+        assert len(validator.discriminated) == 1
+
+        validator.validate({"invocation": {"command": "api1", "args": ["x"]}})
+        validator.validate({"invocation": {"command": "api2", "args": [1]}})
+
+        with pytest.raises(ValidationError) as excinfo:
+            validator.validate({"invocation": {"command": "api1",
+                                               "args": [1]}})
+        # The error is about the invoked API, not about the anyOf.
+        assert excinfo.value.validator == "type"
+
+        with pytest.raises(ValidationError) as excinfo:
+            validator.validate({"invocation": {"command": "missing",
+                                               "args": []}})
+        assert "missing" in excinfo.value.message
+
+    def test_same_result_as_anyof(self):
+        validator = SchemaValidator(make_schema(5))
+        plain = Draft4Validator(make_schema(5))
+        for invocation in ({"command": "api3", "args": ["a"]},
+                           {"command": "api3", "args": [3]},
+                           {"command": "api9", "args": []},
+                           {"args": []},
+                           {"command": 4, "args": []},
+                           "not-an-object"):
+            instance = {"invocation": invocation}
+            try:
+                validator.validate(instance)
+                valid = True
+            except ValidationError:
+                valid = False
+            assert valid == plain.is_valid(instance), invocation
+
+    def test_not_indexable(self):
+        schema = make_schema(2)
+        invocation = schema["properties"]["invocation"]
+        invocation["anyOf"].append({"type": "object"})
+
+        validator = SchemaValidator(schema)
+        assert validator.discriminated == {}
+        validator.validate({"invocation": {"command": "other"}})
+
+    def test_plain_schema(self):
+        validator = SchemaValidator({"type": "string"})
+        validator.validate("x")
+        with pytest.raises(ValidationError):
+            validator.validate(1)
+
+    def test_empty_schema_needs_no_validator(self):
+        test_app = Plugin("test", "test", "test-token")
+        info = QueueInfo("/q", test_app, {}, {}, "fifo")
+        assert isinstance(info.request_validator, AcceptAllValidator)
+
+        info.request_schema = {"type": "string"}
+        assert isinstance(info.request_validator, SchemaValidator)
+        assert info.request_validator.get_error("x") is None
+        assert info.request_validator.get_error(1) is not None
@@ -0,0 +1,95 @@
+import os
+
+from weavelib.messaging import Message, WeaveConnection
+
+from messaging.application_registry import ApplicationRegistry
+from messaging.appmgr import MessagingRPCHub, RPCInfo, get_rpc_base_queue
+from messaging.authorizers import WhitelistAuthorizer
+from messaging.queue_manager import ChannelRegistry
+from messaging.service import DummyMessagingService
+from messaging.snapshot import SnapshotManager
+from messaging.synonyms import SynonymRegistry
+
+
+MESSAGING_SERVER_URL = "https://github.com/HomeWeave/WeaveServer.git"
+
+
+def make_registries(path):
+    app_registry = ApplicationRegistry([
+        ("MessagingServer", MESSAGING_SERVER_URL, "app-token"),
+    ])
+    channel_registry = ChannelRegistry(app_registry)
+    synonym_registry = SynonymRegistry()
+    service = DummyMessagingService("app-token", WeaveConnection.local())
+    rpc_hub = MessagingRPCHub(service, channel_registry, app_registry,
+                              synonym_registry)
+    manager = SnapshotManager(path, app_registry, channel_registry,
+                              synonym_registry, rpc_hub, include_messages=True,
+                              exclude_prefixes=["/_system"])
+    return app_registry, channel_registry, synonym_registry, rpc_hub, manager
+
+
+class TestSnapshotManager(object):
+    def test_save_and_restore(self, tmpdir):
+        path = os.path.join(str(tmpdir), "snapshot.json")
+        apps, channels, synonyms, rpc_hub, manager = make_registries(path)
+
+        token = apps.register_plugin("plugin", "plugin-url")
+        plugin = apps.get_app_by_url("plugin-url")
+        fifo = channels.create_queue(
+            "/channels/plugin-url/q", plugin, {"type": "string"}, {}, "fifo",
+            authorizers={"push": WhitelistAuthorizer(["plugin-url"])},
+            options={"dispatch": "weighted"})
+        channels.create_queue("/_system/registry/request", plugin, {}, {},
+                              "fifo")
+        channels.add_acl_rule("/channels/plugin-url/*", "other", ["pop"])
+        synonyms.register("/q", "/channels/plugin-url/q")
+        rpc_hub.rpc_registry[("plugin-url", "rpc")] = RPCInfo(
+            "plugin-url", "rpc", "desc", {}, get_rpc_base_queue("plugin-url",
+                                                                "rpc"), {}, {})
+
+        msg = Message("enqueue", "hello")
+        msg.headers["SESS"] = "1"
+        fifo.on_push(msg)
+
+        manager.save()
+        assert oct(os.stat(path).st_mode & 0o777) == oct(0o600)
+
+        apps2, channels2, synonyms2, rpc_hub2, manager2 = make_registries(path)
+        assert manager2.load()
+
+        assert apps2.get_app_info(token)["app_url"] == "plugin-url"
+        assert list(channels2.channel_infos) == ["/channels/plugin-url/q"]
+
+        restored = channels2.get_channel("/channels/plugin-url/q")
+        assert restored.channel_info.options == {"dispatch": "weighted"}
+        assert restored.channel_info.authorizers["push"].authorize(
+            "plugin-url", "push", "/channels/plugin-url/q")
+        assert channels2.acl.authorize("other", "pop",
+                                       "/channels/plugin-url/q")
+        assert [x.task for x in restored.dump_messages()] == ["hello"]
+        assert synonyms2.translate("/synonyms/q") == "/channels/plugin-url/q"
+        assert ("plugin-url", "rpc") in rpc_hub2.rpc_registry
+
+    def test_owner_adopts_restored_channel(self, tmpdir):
+        path = os.path.join(str(tmpdir), "snapshot.json")
+        apps, channels, _, _, manager = make_registries(path)
+        apps.register_plugin("plugin", "plugin-url")
+        plugin = apps.get_app_by_url("plugin-url")
+        channels.create_queue("/channels/plugin-url/q", plugin, {}, {}, "fifo")
+        manager.save()
+
+        apps2, channels2, _, _, manager2 = make_registries(path)
+        manager2.load()
+        plugin = apps2.get_app_by_url("plugin-url")
+        restored = channels2.get_channel("/channels/plugin-url/q")
+
+        queue = channels2.create_queue("/channels/plugin-url/q", plugin,
+                                       {"type": "string"}, {}, "fifo")
+        assert queue is restored
+        assert queue.channel_info.request_schema == {"type": "string"}
+
+    def test_missing_snapshot(self, tmpdir):
+        path = os.path.join(str(tmpdir), "missing.json")
+        manager = make_registries(path)[-1]
+        assert not manager.load()
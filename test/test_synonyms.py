@@ -0,0 +1,57 @@
+import pytest
+from weavelib.exceptions import ObjectAlreadyExists
+
+from messaging.synonyms import SynonymRegistry
+
+
+class TestSynonymRegistry(object):
+    def test_register_translate(self):
+        registry = SynonymRegistry()
+        assert registry.register("/q", "/channels/a/q") == "/synonyms/q"
+        assert registry.translate("/synonyms/q") == "/channels/a/q"
+        assert registry.translate("/channels/a/q") == "/channels/a/q"
+
+    def test_register_existing(self):
+        registry = SynonymRegistry()
+        registry.register("/q", "/channels/a/q")
+        registry.register("/q", "/channels/a/q")
+        with pytest.raises(ObjectAlreadyExists):
+            registry.register("/q", "/channels/b/q")
+
+    def test_chained_synonyms(self):
+        registry = SynonymRegistry()
+        registry.register("/a", "/synonyms/b")
+        registry.register("/b", "/synonyms/c")
+        registry.register("/c", "/channels/x/c")
+        assert registry.translate("/synonyms/a") == "/channels/x/c"
+
+    def test_synonym_cycle(self):
+        registry = SynonymRegistry()
+        registry.register("/a", "/synonyms/b")
+        registry.register("/b", "/synonyms/a")
+        assert registry.translate("/synonyms/a") in ("/synonyms/a",
+                                                     "/synonyms/b")
+
+    def test_generation(self):
+        registry = SynonymRegistry()
+        generation = registry.generation
+        registry.register("/q", "/channels/a/q")
+        assert registry.generation != generation
+
+        generation = registry.generation
+        registry.translate("/synonyms/q")
+        assert registry.generation == generation
+
+    def test_register_all(self):
+        registry = SynonymRegistry()
+        registry.register("/taken", "/channels/a/x")
+
+        with pytest.raises(ObjectAlreadyExists):
+            registry.register_all([("/q1", "/channels/a/q1"),
+                                   ("/taken", "/channels/a/q2")])
+        assert registry.translate("/synonyms/q1") == "/synonyms/q1"
+
+        assert registry.register_all([("/q1", "/channels/a/q1"),
+                                      ("/taken", "/channels/a/x")]) == \
+            ["/synonyms/q1", "/synonyms/taken"]
+        assert registry.translate("/synonyms/q1") == "/channels/a/q1"
@@ -0,0 +1,82 @@
+import zlib
+
+from weavelib.messaging import Message
+
+from messaging.tracing import TraceLog
+
+
+def make_message(**headers):
+    msg = Message("enqueue", "task")
+    msg.headers.update(headers)
+    return msg
+
+
+def sampled_id(interval, sampled=True):
+    # A trace ID that TraceLog(interval) samples (or doesn't).
+    for i in range(1000):
+        trace_id = "trace-" + str(i)
+        if (zlib.crc32(trace_id.encode()) % interval == 0) == sampled:
+            return trace_id
+
+
+class TestTraceLog(object):
+    def test_disabled(self):
+        trace_log = TraceLog()
+        assert trace_log.start(make_message()) is None
+        assert trace_log.start(make_message(TRACE="abc")) == "abc"
+
+        trace_log.record("abc", "enqueue")
+        assert trace_log.get_trace("abc") is None
+
+    def test_assigns_ids(self):
+        trace_log = TraceLog(2)
+        messages = [make_message() for _ in range(4)]
+        ids = [trace_log.start(x) for x in messages]
+
+        assert [x is not None for x in ids] == [False, True, False, True]
+        assert messages[1].headers["TRACE"] == ids[1]
+        assert "TRACE" not in messages[0].headers
+
+        trace_log.record(ids[1], "enqueue", channel="/a")
+        assert [x["event"] for x in trace_log.get_trace(ids[1])] == \
+            ["enqueue"]
+
+    def test_propagated_ids(self):
+        trace_log = TraceLog(4)
+        sampled = sampled_id(4)
+        unsampled = sampled_id(4, sampled=False)
+
+        assert trace_log.start(make_message(TRACE=sampled)) == sampled
+        assert trace_log.start(make_message(TRACE=unsampled)) == unsampled
+        trace_log.record(sampled, "enqueue")
+        trace_log.record(unsampled, "enqueue")
+
+        assert len(trace_log.get_trace(sampled)) == 1
+        assert trace_log.get_trace(unsampled) is None
+
+    def test_bounded(self):
+        trace_log = TraceLog(1)
+        trace_log.MAX_TRACES = 2
+        trace_log.MAX_EVENTS = 3
+        ids = [trace_log.start(make_message()) for _ in range(3)]
+        for _ in range(5):
+            trace_log.record(ids[2], "write")
+
+        assert trace_log.get_trace(ids[0]) is None
+        assert len(trace_log.get_trace(ids[2])) == 3
+
+    def test_query(self):
+        trace_log = TraceLog(1)
+        ids = [trace_log.start(make_message()) for _ in range(3)]
+        trace_log.record(ids[0], "enqueue", channel="/a/1")
+        trace_log.record(ids[1], "enqueue", channel="/b/1")
+        trace_log.record(ids[2], "enqueue", channel="/a/2")
+        trace_log.traces[ids[0]][0]["time"] -= 1
+        trace_log.record(ids[0], "write")
+
+        assert [x["trace_id"] for x in trace_log.query()] == ids[::-1]
+        assert [x["trace_id"] for x in trace_log.query("/a")] == \
+            [ids[2], ids[0]]
+        assert [x["trace_id"] for x in trace_log.query(min_duration=0.5)] \
+            == [ids[0]]
+        assert len(trace_log.query(limit=1)) == 1